@@ -31,10 +31,11 @@ def get_img_tr(in_files, TRa):
 
     """
 
-    from nibabel import load
-    img = load(in_files)
-    hdr = img.get_header()
-    tr = float(hdr.get_zooms()[3])
+    from CPAC.utils.utils import get_nifti_header_info
+    tr = get_nifti_header_info(in_files)['tr']
+    if tr is None:
+        raise Exception('Unable to read the TR of %s: it is not a 4D '\
+                        'image' % in_files)
     if tr > 10:
         tr = float(float(tr) / 1000.0)
     if not (TRa == None):
@@ -1,9 +1,19 @@
 from utils import timeseries_bootstrap, \
+                  timeseries_bootstrap_weights, \
+                  weighted_normalized_timeseries, \
+                  weighted_correlation, \
+                  correlation_affinity, \
                   standard_bootstrap, \
                   cluster_timeseries, \
                   adjacency_matrix, \
+                  coassignment_dtype, \
+                  accumulate_coassignment, \
                   cluster_matrix_average, \
-                  individual_stability_matrix
+                  bootstrap_stability_counts, \
+                  individual_stability_matrix, \
+                  write_stability_counts, \
+                  read_stability_counts, \
+                  unpack_stability_counts
 
 from basc import create_basc, \
                  nifti_individual_stability, \
@@ -15,8 +25,18 @@ __all__ = ['create_basc', \
            'nifti_individual_stability', \
            'group_stability_matrix', \
            'timeseries_bootstrap', \
+           'timeseries_bootstrap_weights', \
+           'weighted_normalized_timeseries', \
+           'weighted_correlation', \
+           'correlation_affinity', \
            'standard_bootstrap', \
            'cluster_timeseries', \
            'adjacency_matrix', \
+           'coassignment_dtype', \
+           'accumulate_coassignment', \
            'cluster_matrix_average', \
-           'individual_stability_matrix']
\ No newline at end of file
+           'bootstrap_stability_counts', \
+           'individual_stability_matrix', \
+           'write_stability_counts', \
+           'read_stability_counts', \
+           'unpack_stability_counts']
\ No newline at end of file
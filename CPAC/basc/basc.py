@@ -8,7 +8,8 @@ def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, strat
     Parameters
     ----------
     indiv_stability_list : list of strings
-        A length `N` list of file paths to numpy matrices of shape (`V`, `V`), `N` subjects, `V` voxels
+        A length `N` list of file paths to individual stability matrices of shape (`V`, `V`), `N` subjects, `V` voxels,
+        either written by `write_stability_counts` or as numpy matrices
     n_bootstraps : integer
         Number of bootstrap datasets
     k_clusters : integer
@@ -31,27 +32,48 @@ def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, strat
     if stratification is not None:
         print 'Applying stratification to group dataset'
                 
-    from CPAC.basc import standard_bootstrap, adjacency_matrix, cluster_timeseries, cluster_matrix_average
+    from CPAC.basc import standard_bootstrap, coassignment_dtype, accumulate_coassignment, cluster_timeseries, cluster_matrix_average, \
+                          read_stability_counts, unpack_stability_counts
     import numpy as np
 
-    indiv_stability_set = np.asarray([np.load(ism_file) for ism_file in indiv_stability_list])
-#    indiv_stability_set = indiv_stability_list
-    print 'Individual stability list dimensions:', indiv_stability_set.shape
-    
-    V = indiv_stability_set.shape[2]
+    # The individual stability matrices stay memory mapped, and only the packed counts of the subjects drawn
+    # in a bootstrap are summed
+    indiv_stability_set = [read_stability_counts(ism_file) for ism_file in indiv_stability_list]
+    nSubjects = len(indiv_stability_set)
+    V = indiv_stability_set[0][1]
+    # Packed counts and dense matrices can't be summed together
+    ism_formats = ['dense matrix' if counts.ndim == 2 else 'packed counts' for counts, _, _ in indiv_stability_set]
+    for ism_file, ism_format, (_, ism_V, _) in zip(indiv_stability_list, ism_formats, indiv_stability_set):
+        if (ism_format, ism_V) != (ism_formats[0], V):
+            raise ValueError('Individual stability matrix %s is a %s of %i voxels, but %s is a %s of %i voxels' % \
+                             (ism_file, ism_format, ism_V, indiv_stability_list[0], ism_formats[0], V))
+    print 'Individual stability list dimensions:', (nSubjects, V, V)
+    
+    J_counts = np.zeros(indiv_stability_set[0][0].shape)
+    J_buf = np.empty_like(J_counts)
+    if stratification is not None:
+        stratification = np.asarray(stratification)
     
-    G = np.zeros((V,V))
+    # Count the co-assignments of each bootstrap, and normalize once all are in
+    G = np.zeros((V,V), dtype=coassignment_dtype(n_bootstraps))
     for bootstrap_i in range(n_bootstraps):
         if stratification is not None:
             strata = np.unique(stratification)
-            J = np.zeros((V,V))
-            for stratum in strata:
-                J += standard_bootstrap(indiv_stability_set[np.where(stratification == stratum)]).sum(0)
-            J /= indiv_stability_set.shape[0]
+            sample = np.concatenate([standard_bootstrap(np.where(stratification == stratum)[0]) for stratum in strata])
         else:
-            J = standard_bootstrap(indiv_stability_set).mean(0)
-        G += adjacency_matrix(cluster_timeseries(J, k_clusters, similarity_metric = 'data')[:,np.newaxis])
-    G /= n_bootstraps
+            sample = standard_bootstrap(np.arange(nSubjects))
+        
+        # Mean stability matrix of the bootstrap dataset, with each subject weighted by how often it was drawn
+        J_counts[...] = 0
+        for subject_i, n_draws in enumerate(np.bincount(sample, minlength=nSubjects)):
+            if n_draws:
+                counts, ism_V, ism_bootstraps = indiv_stability_set[subject_i]
+                np.multiply(counts, n_draws/float(ism_bootstraps), out=J_buf)
+                J_counts += J_buf
+        J = unpack_stability_counts(J_counts, V, nSubjects)
+        
+        accumulate_coassignment(G, cluster_timeseries(J, k_clusters, similarity_metric = 'data'))
+    G = G/float(n_bootstraps)
 
 
     clusters_G = cluster_timeseries(G, k_clusters, similarity_metric = 'data')
@@ -70,7 +92,8 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
     Parameters
     ----------
     indiv_stability_list : list of strings
-        A length `N` list of file paths to numpy matrices of shape (`V`, `V`), `N` subjects, `V` voxels
+        A length `N` list of file paths to individual stability matrices of shape (`V`, `V`), `N` subjects, `V` voxels,
+        either written by `write_stability_counts` or as numpy matrices
     clusters_G : array_like
         Length `V` array of cluster assignments for each voxel
         
@@ -83,19 +106,19 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
     """
     import os
     import numpy as np
-    from CPAC.basc import cluster_matrix_average, ndarray_to_vol
+    from CPAC.basc import cluster_matrix_average, ndarray_to_vol, read_stability_counts, unpack_stability_counts
     
-    indiv_stability_set = np.asarray([np.load(ism_file) for ism_file in indiv_stability_list])
-
-    nSubjects = indiv_stability_set.shape[0]
-    nVoxels = indiv_stability_set.shape[1]
+    nSubjects = len(indiv_stability_list)
+    nVoxels = clusters_G.shape[0]
 
     cluster_ids = np.unique(clusters_G)
     nClusters = cluster_ids.shape[0]
     
+    # Expand one subject's stability matrix at a time
     cluster_voxel_scores = np.zeros((nClusters, nSubjects, nVoxels))
-    for i in range(nSubjects):
-        cluster_voxel_scores[:,i] = cluster_matrix_average(indiv_stability_set[i], clusters_G)
+    for i, ism_file in enumerate(indiv_stability_list):
+        counts, V, n_bootstraps = read_stability_counts(ism_file)
+        cluster_voxel_scores[:,i] = cluster_matrix_average(unpack_stability_counts(counts, V, n_bootstraps), clusters_G)
     
     icvs = []
     icvs_idx = 0
@@ -105,7 +128,7 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
  
     return icvs
 
-def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5):
+def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5, n_jobs = 1, random_state = None):
     """
     Calculate the individual stability matrix for a single subject by using Circular Block Bootstrapping method
     for time-series data.
@@ -124,15 +147,20 @@ def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clus
         Size of the time-series block when performing circular block bootstrap
     affinity_threshold : float, optional
         Minimum threshold for similarity matrix based on correlation to create an edge
+    n_jobs : integer, optional
+        Number of processes to split the bootstraps across
+    random_state : integer, optional
+        Seed of the bootstraps, for results that are reproducible whatever the number of processes
         
     Returns
     -------
-    ism : array_like
-        Individual stability matrix of shape (`V`, `V`), `V` voxels
+    ism_file : string
+        Individual stability matrix of shape (`V`, `V`), `V` voxels, as the bootstrap counts of its upper triangle
+        (see `write_stability_counts`)
     """
     print 'Calculating individual stability matrix of:', subject_file
 
-    from CPAC.basc import individual_stability_matrix
+    from CPAC.basc import individual_stability_matrix, write_stability_counts
     from CPAC.utils import safe_shape
     import nibabel as nb
     import numpy as np
@@ -149,9 +177,9 @@ def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clus
     Y = data[roi_mask_file].T
     print '(%i timepoints, %i voxels) and %i bootstraps' % (Y.shape[0], Y.shape[1], n_bootstraps)
     
-    ism = individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size=cbb_block_size, affinity_threshold=affinity_threshold)
-    ism_file = os.path.join(os.getcwd(), 'individual_stability_matrix.npy')
-    np.save(ism_file, ism)
+    ism_counts = individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size=cbb_block_size, affinity_threshold=affinity_threshold, n_jobs=n_jobs, random_state=random_state, return_counts=True)
+    ism_file = os.path.join(os.getcwd(), 'individual_stability_matrix.ism')
+    write_stability_counts(ism_file, ism_counts, n_bootstraps)
     
     print 'Saving individual stability matrix %s for %s' % (ism_file, subject_file)
     
@@ -238,6 +266,10 @@ def create_basc(name='basc'):
             Number of clusters at both the individiual and group level
         inputspec.affinity_threshold : list (floats)
             Minimum threshold for similarity matrix based on correlation to create an edge
+        inputspec.n_jobs : integer (optional)
+            Number of processes to split each subject's timeseries bootstraps across
+        inputspec.random_state : integer (optional)
+            Seed of the timeseries bootstraps
             
     Workflow Outputs::
     
@@ -288,8 +320,12 @@ def create_basc(name='basc'):
                                                        'dataset_bootstraps',
                                                        'timeseries_bootstraps',
                                                        'k_clusters',
-                                                       'affinity_threshold']),
+                                                       'affinity_threshold',
+                                                       'n_jobs',
+                                                       'random_state']),
                         name='inputspec')
+    inputspec.inputs.n_jobs = 1
+    inputspec.inputs.random_state = None
     outputspec = pe.Node(util.IdentityInterface(fields=['gsm',
                                                         'gsclusters',
                                                         'gsmap',
@@ -305,7 +341,9 @@ def create_basc(name='basc'):
                                                 'n_bootstraps',
                                                 'k_clusters',
                                                 'cbb_block_size',
-                                                'affinity_threshold'],
+                                                'affinity_threshold',
+                                                'n_jobs',
+                                                'random_state'],
                                    output_names=['individual_stability_matrices'],
                                    function=nifti_individual_stability),
                      name='individual_stability_matrices',
@@ -356,6 +394,10 @@ def create_basc(name='basc'):
                  nis, 'k_clusters')
     basc.connect(inputspec, 'affinity_threshold',
                  nis, 'affinity_threshold')
+    basc.connect(inputspec, 'n_jobs',
+                 nis, 'n_jobs')
+    basc.connect(inputspec, 'random_state',
+                 nis, 'random_state')
     
     basc.connect(inputspec, 'dataset_bootstraps',
                  gsm, 'n_bootstraps')
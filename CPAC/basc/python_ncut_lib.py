@@ -40,9 +40,9 @@
 import sys
 from numpy import array,reshape,shape,matrix,ones,zeros,sqrt,sort,arange
 from numpy import nonzero,fromfile,tile,append,prod,double,argsort,sign
-from numpy import kron,multiply,divide,abs,reshape,asarray
+from numpy import kron,multiply,divide,abs,reshape,asarray,repeat,diff
 from scipy import rand
-from scipy.sparse import csc_matrix, spdiags
+from scipy.sparse import csc_matrix, spdiags, isspmatrix_csr
 from scipy.sparse.linalg.eigen.arpack import eigsh
 from scipy.linalg import norm, svd, LinAlgError
 
@@ -94,12 +94,22 @@ def ncut( W, nbEigenValues ):
 	dr=dr+offset
 
 	# calculation of the normalized LaPlacian
-	W=W+spdiags(dr,[0],m,m,"csc")
 	Dinvsqrt=spdiags((1.0/sqrt(d+eps)),[0],m,m,"csc")
-	P=Dinvsqrt*(W*Dinvsqrt);
+	if isspmatrix_csr(W):
+		# scale the rows and columns of a CSR matrix in place, rather than
+		# through two sparse matrix products
+		dinvsqrt=asarray(1.0/sqrt(d+eps)).ravel()
+		P=W+spdiags(dr,[0],m,m,"csr")
+		P.data*=dinvsqrt[P.indices]
+		P.data*=repeat(dinvsqrt,diff(P.indptr))
+	else:
+		W=W+spdiags(dr,[0],m,m,"csc")
+		P=Dinvsqrt*(W*Dinvsqrt);
 	
 	# perform the eigen decomposition
-	eigen_val,eigen_vec=eigsh(P,nbEigenValues,maxiter=maxiterations,tol=eigsErrorTolerence,which='LA')
+	# start from a vector of the numpy random generator rather than ARPACK's
+	# own random state, so that seeding numpy makes the result reproducible
+	eigen_val,eigen_vec=eigsh(P,nbEigenValues,maxiter=maxiterations,tol=eigsErrorTolerence,which='LA',v0=rand(m))
 	
 	# sort the eigen_vals so that the first
 	# is the largest
@@ -1,10 +1,18 @@
 import numpy as np
 
 from ..utils import timeseries_bootstrap, \
+                    timeseries_bootstrap_weights, \
+                    weighted_correlation, \
+                    correlation_affinity, \
                     standard_bootstrap, \
                     cluster_timeseries, \
                     adjacency_matrix, \
-                    individual_stability_matrix
+                    coassignment_dtype, \
+                    accumulate_coassignment, \
+                    individual_stability_matrix, \
+                    write_stability_counts, \
+                    read_stability_counts, \
+                    unpack_stability_counts
 
 def test_timeseries_bootstrap():
     """
@@ -46,6 +54,34 @@ def test_sample_bootstrap():
                        [ 8, 18, 28, 38, 48]])
     np.testing.assert_equal(actual, desired)
 
+def test_weighted_correlation():
+    """
+    Tests that the bootstrap correlation from timepoint weights matches the correlation of the resampled time-series
+    """
+    x = np.random.randn(40, 6) + 3
+    
+    np.random.seed(27)
+    sample = timeseries_bootstrap(x, 5)
+    np.random.seed(27)
+    weights = timeseries_bootstrap_weights(x.shape[0], 5)
+    
+    np.testing.assert_equal(weights.sum(), x.shape[0])
+    np.testing.assert_allclose(weighted_correlation(x - x.mean(0), weights), np.corrcoef(sample.T), atol=1e-12)
+
+def test_correlation_affinity():
+    """
+    Tests that the blocked sparse affinity matrix matches the thresholded dense correlation matrix
+    """
+    x = np.random.randn(40, 30)
+    xn = (x - x.mean(0))/np.sqrt(((x - x.mean(0))**2).sum(0))
+    
+    desired = np.dot(xn.T, xn)
+    desired[desired < 0.2] = 0
+    actual = correlation_affinity(xn, 0.2, block_size = 7)
+    
+    np.testing.assert_allclose(actual.toarray(), desired, atol=1e-12)
+    np.testing.assert_equal(actual.nnz, (desired != 0).sum())
+
 def test_adjacency_matrix():
     """
     Tests the adjacency_matrix of BASC workflow
@@ -58,6 +94,80 @@ def test_adjacency_matrix():
                        [0, 0, 0, 1, 0],
                        [1, 0, 0, 0, 1]])
     np.testing.assert_equal(actual, desired)
+
+def test_accumulate_coassignment():
+    """
+    Tests that the integer co-assignment counts match the sum of the adjacency matrices
+    """
+    labels = np.random.randint(0, 4, size=(6, 50))
+    
+    desired = np.zeros((50,50))
+    actual = np.zeros((50,50), dtype=coassignment_dtype(labels.shape[0]))
+    for x in labels:
+        desired += adjacency_matrix(x[:,np.newaxis])
+        accumulate_coassignment(actual, x, block_size = 3)
+    
+    np.testing.assert_equal(actual, desired)
+    np.testing.assert_equal(actual.dtype, np.uint16)
+
+def test_stability_counts_file():
+    """
+    Tests that an individual stability matrix written as packed upper-triangle counts reads back the same
+    """
+    import os
+    import tempfile
+    
+    labels = np.random.randint(0, 4, size=(300, 40))
+    counts = np.zeros((40,40), dtype=coassignment_dtype(labels.shape[0]))
+    for x in labels:
+        accumulate_coassignment(counts, x)
+    
+    fd, ism_file = tempfile.mkstemp(suffix='.ism')
+    os.close(fd)
+    try:
+        write_stability_counts(ism_file, counts, labels.shape[0])
+        packed, V, n_bootstraps = read_stability_counts(ism_file)
+        
+        np.testing.assert_equal(packed.dtype, np.uint16)
+        np.testing.assert_equal((V, n_bootstraps), (40, 300))
+        np.testing.assert_equal(unpack_stability_counts(packed, V, n_bootstraps), counts/300.)
+        del packed
+    finally:
+        os.remove(ism_file)
+
+
+def test_group_stability_matrix_mixed_files():
+    """
+    Tests that group_stability_matrix rejects individual stability matrices written in different formats or for
+    different numbers of voxels
+    """
+    import os
+    import shutil
+    import tempfile
+    from ..basc import group_stability_matrix
+    
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ism_files = {}
+        for name, V in [('a.ism', 40), ('b.ism', 30)]:
+            labels = np.random.randint(0, 4, size=(10, V))
+            counts = np.zeros((V,V), dtype=coassignment_dtype(labels.shape[0]))
+            for x in labels:
+                accumulate_coassignment(counts, x)
+            ism_files[name] = write_stability_counts(os.path.join(tmp_dir, name), counts, labels.shape[0])
+            ism_files[name.replace('.ism', '.npy')] = os.path.join(tmp_dir, name.replace('.ism', '.npy'))
+            np.save(ism_files[name.replace('.ism', '.npy')], counts/10.)
+        
+        # The error names the conflicting file
+        for names in [('a.ism', 'a.npy'), ('a.npy', 'a.ism'), ('a.ism', 'b.ism'), ('a.npy', 'b.npy')]:
+            try:
+                group_stability_matrix([ism_files[name] for name in names], 2, 3)
+            except ValueError as e:
+                assert ism_files[names[1]] in str(e)
+            else:
+                assert False
+    finally:
+        shutil.rmtree(tmp_dir)
     
 def generate_blobs():
     np.random.seed(27)
@@ -94,6 +204,18 @@ def test_individual_stability_matrix():
     
     assert False
     
+def test_individual_stability_matrix_n_jobs():
+    """
+    Tests that individual_stability_matrix gives the same result with any number of processes for a given seed.
+    """
+    
+    blobs = generate_blobs()[::10]
+    ism = individual_stability_matrix(blobs.T, 6, 3, random_state = 5)
+    ism_parallel = individual_stability_matrix(blobs.T, 6, 3, n_jobs = 4, random_state = 5)
+    
+    np.testing.assert_equal(ism, ism_parallel)
+    assert ism.min() >= 0 and ism.max() <= 1
+    
 def test_group_stability_matrix():
     """
     Tests group_stability_matrix method.  This creates a dataset of blobs varying only by additive zero-mean gaussian
@@ -1,7 +1,16 @@
+import struct
+
 import numpy as np
 
 
-def timeseries_bootstrap(tseries, block_size):
+# Compact individual stability matrix files start with this magic string, followed by the dtype of the
+# counts, the number of voxels and the number of bootstraps, and are padded to ISM_HEADER_SIZE bytes
+ISM_MAGIC = '\x93BASCISM'
+ISM_HEADER = struct.Struct('<8s4sQQ')
+ISM_HEADER_SIZE = 64
+
+
+def timeseries_bootstrap(tseries, block_size, random_state=None):
     """
     Generates a bootstrap sample derived from the input time-series.  Utilizes Circular-block-bootstrap method described in [1]_.
     
@@ -11,6 +20,9 @@ def timeseries_bootstrap(tseries, block_size):
         A matrix of shapes (`M`, `N`) with `M` timepoints and `N` variables
     block_size : integer
         Size of the bootstrapped blocks 
+    random_state : numpy.random.RandomState, optional
+        Random number generator to draw the blocks from; by default the global
+        numpy generator
     
     Returns
     -------
@@ -42,19 +54,178 @@ def timeseries_bootstrap(tseries, block_size):
            [ 4, 14, 24, 34, 44]])
 
     """
+    block_mask = bootstrap_indices(tseries.shape[0], block_size, random_state)
+    
+    return tseries[block_mask, :]
+
+
+def bootstrap_indices(n_timepoints, block_size, random_state=None):
+    """
+    Draws the time indices of a Circular-block-bootstrap sample (see `timeseries_bootstrap`).
+    
+    Parameters
+    ----------
+    n_timepoints : integer
+        Number of timepoints of the time-series
+    block_size : integer
+        Size of the bootstrapped blocks 
+    random_state : numpy.random.RandomState, optional
+        Random number generator to draw the blocks from; by default the global
+        numpy generator
+    
+    Returns
+    -------
+    block_mask : array_like
+        Integer array of the `n_timepoints` sampled time indices
+    """
     import numpy as np
     
-    k = np.ceil(float(tseries.shape[0])/block_size)
-    r_ind = np.floor(np.random.rand(1,k)*tseries.shape[0])
+    if random_state is None:
+        random_state = np.random
+    
+    k = int(np.ceil(float(n_timepoints)/block_size))
+    r_ind = np.floor(random_state.rand(1,k)*n_timepoints)
     
     blocks = np.dot(np.arange(0,block_size)[:,np.newaxis], np.ones([1,k]))
     block_offsets = np.dot(np.ones([block_size,1]), r_ind)
     
-    block_mask = (blocks + block_offsets).flatten('F')[:tseries.shape[0]]
+    block_mask = (blocks + block_offsets).flatten('F')[:n_timepoints]
+
+    block_mask = np.mod(block_mask, n_timepoints)
+    
+    return block_mask.astype('int')
+
+
+def timeseries_bootstrap_weights(n_timepoints, block_size, random_state=None):
+    """
+    Draws a Circular-block-bootstrap sample as the number of times each timepoint is sampled, rather than as a
+    resampled copy of the time-series.  It draws the same sample as `timeseries_bootstrap` from the same
+    random state.
+    
+    Parameters
+    ----------
+    n_timepoints : integer
+        Number of timepoints of the time-series
+    block_size : integer
+        Size of the bootstrapped blocks 
+    random_state : numpy.random.RandomState, optional
+        Random number generator to draw the blocks from; by default the global
+        numpy generator
+    
+    Returns
+    -------
+    weights : array_like
+        Integer array of the multiplicity of each timepoint in the sample, summing to `n_timepoints`
+    """
+    import numpy as np
+    
+    block_mask = bootstrap_indices(n_timepoints, block_size, random_state)
+    
+    return np.bincount(block_mask, minlength=n_timepoints)
+
+
+def weighted_normalized_timeseries(Y, weights, out=None):
+    """
+    Demeans and normalizes the variables of a time-series with each timepoint counted `weights` times, i.e. a
+    bootstrap sample, so that the correlation between variables i and j is the dot product of columns i and j.
+    Only the sampled timepoints are kept, each scaled by the square root of its weight, so the dot products
+    form `Y.T diag(weights) Y` without a resampled copy of the time-series.
+    
+    Parameters
+    ----------
+    Y : array_like
+        A matrix of shape (`N`, `V`) with `N` timepoints and `V` variables
+    weights : array_like
+        Multiplicity of each of the `N` timepoints
+    out : array_like, optional
+        Buffer of at least shape (`N`, `V`) and the dtype of `Y` to write the result into, e.g. reused across
+        bootstraps
+    
+    Returns
+    -------
+    Zn : array_like
+        A matrix of shape (`S`, `V`) for the `S` sampled timepoints, with unit-norm columns
+    """
+    sampled = np.flatnonzero(weights)
+    w = weights[sampled].astype('float64')
+    
+    if out is None:
+        Zn = Y.take(sampled, axis=0)
+    else:
+        Zn = Y.take(sampled, axis=0, out=out[:len(sampled)])
+    
+    # Remove the bootstrap means, weight and normalize
+    Zn -= np.dot(weights, Y)/w.sum()
+    Zn *= np.sqrt(w)[:,np.newaxis]
+    Zn /= np.sqrt(np.einsum('ij,ij->j', Zn, Zn))
+    
+    return Zn
+
+
+def weighted_correlation(Y, weights, out=None):
+    """
+    Correlation between the variables of a time-series with each timepoint counted `weights` times, i.e. the
+    correlation of a bootstrap sample computed on the original array (see `weighted_normalized_timeseries`).
+    
+    Parameters
+    ----------
+    Y : array_like
+        A matrix of shape (`N`, `V`) with `N` timepoints and `V` variables
+    weights : array_like
+        Multiplicity of each of the `N` timepoints
+    out : array_like, optional
+        Buffer of at least shape (`N`, `V`) for the normalized sampled timepoints
+    
+    Returns
+    -------
+    C : array_like
+        Correlation matrix of shape (`V`, `V`)
+    """
+    Zn = weighted_normalized_timeseries(Y, weights, out=out)
+    
+    return np.dot(Zn.T, Zn)
 
-    block_mask = np.mod(block_mask, tseries.shape[0])
+
+def correlation_affinity(Zn, affinity_threshold, block_size = 1000):
+    """
+    Sparse affinity matrix of the correlations that are at least `affinity_threshold`.  The correlations are
+    computed a block of rows at a time and only the suprathreshold entries are kept, straight into CSR, so the
+    dense `V` x `V` matrix is never formed.
+    
+    Parameters
+    ----------
+    Zn : array_like
+        A matrix of shape (`N`, `V`) of `V` demeaned variables with unit-norm columns
+    affinity_threshold : float
+        Minimum correlation to create an edge
+    block_size : integer, optional
+        Number of rows of the correlation matrix to compute at a time
+    
+    Returns
+    -------
+    C_X : scipy.sparse.csr_matrix
+        Affinity matrix of shape (`V`, `V`)
+    """
+    from scipy.sparse import csr_matrix
+    
+    V = Zn.shape[1]
+    row_nnz = np.zeros(V, dtype='int64')
+    indices = []
+    data = []
+    for start in range(0, V, block_size):
+        stop = min(start + block_size, V)
+        C_block = np.dot(Zn[:,start:stop].T, Zn)
+        keep = C_block >= affinity_threshold
+        if affinity_threshold <= 0:
+            keep &= C_block != 0
+        rows, cols = np.nonzero(keep)
+        row_nnz[start:stop] = keep.sum(1)
+        indices.append(cols.astype('int32'))
+        data.append(C_block[rows, cols])
+        del C_block, keep
     
-    return tseries[block_mask.astype('int'), :]
+    indptr = np.concatenate(([0], np.cumsum(row_nnz)))
+    return csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(V,V))
 
 
 def standard_bootstrap(dataset):
@@ -116,10 +287,7 @@ def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinit
         # Calculate empirical correlation matrix between samples
         Xn = X - X.mean(1)[:,np.newaxis]
         Xn = Xn/np.sqrt( (Xn**2.).sum(1)[:,np.newaxis] )
-        C_X = np.dot(Xn, Xn.T)
-        C_X[C_X < affinity_threshold] = 0
-        from scipy.sparse import lil_matrix
-        C_X = lil_matrix(C_X)
+        C_X = correlation_affinity(Xn.T, affinity_threshold)
     elif similarity_metric == 'data':
         C_X = X
     elif similarity_metric == 'k_neighbors':
@@ -175,20 +343,80 @@ def adjacency_matrix(cluster_pred):
            [1, 0, 0, 0, 1]])
 
     """
-    x = cluster_pred.copy()
+    x = np.asarray(cluster_pred).ravel()
     
-    if(len(x.shape) == 1):
-        x = x[:, np.newaxis]
-        
-    # Force the cluster indexing to be positive integers
-    if(x.min() <= 0):
-        x += -x.min() + 1
-        
-    A = np.dot(x**-1., x.T) == 1
+    # Compare the labels directly, rather than testing x_j/x_i == 1 in floating point
+    A = x[:, np.newaxis] == x[np.newaxis, :]
     
     return A
 
 
+def coassignment_dtype(n_counts):
+    """
+    Smallest unsigned integer type that can count up to `n_counts` co-assignments
+    
+    Parameters
+    ----------
+    n_counts : integer
+        Largest count to be stored, e.g. the number of bootstraps
+    
+    Returns
+    -------
+    dtype : numpy.dtype
+        uint16 if it fits, else uint32
+    """
+    if n_counts < 2**16:
+        return np.dtype('uint16')
+    return np.dtype('uint32')
+
+
+def accumulate_coassignment(counts, cluster_pred, block_size = 1000):
+    """
+    Add one to the count of each pair of samples assigned to the same cluster, in place.
+    
+    Equivalent to ``counts += adjacency_matrix(cluster_pred)``, but only the within-cluster pairs are
+    touched, through each cluster's index list, and no float or boolean (`N`, `N`) matrix is created.
+    
+    Parameters
+    ----------
+    counts : array_like
+        An integer matrix of shape (`N`, `N`) to add the co-assignments to
+    cluster_pred : array_like
+        Cluster labels of the `N` samples
+    block_size : integer, optional
+        Number of rows of a cluster to update at a time, which bounds the size of the temporaries
+    
+    Returns
+    -------
+    counts : array_like
+        The updated `counts`
+    
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from CPAC.basc import accumulate_coassignment
+    >>> counts = np.zeros((5,5), dtype='uint16')
+    >>> counts = accumulate_coassignment(counts, np.asarray([1, 2, 2, 3, 1]))
+    >>> counts = accumulate_coassignment(counts, np.asarray([1, 1, 2, 2, 2]))
+    >>> counts
+    array([[2, 1, 0, 0, 1],
+           [1, 2, 1, 0, 0],
+           [0, 1, 2, 1, 1],
+           [0, 0, 1, 2, 1],
+           [1, 0, 1, 1, 2]], dtype=uint16)
+    """
+    x = np.asarray(cluster_pred).ravel()
+    
+    # Group the sample indices by cluster
+    order = np.argsort(x, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(x[order])) + 1
+    for idx in np.split(order, bounds):
+        for start in range(0, idx.shape[0], block_size):
+            counts[np.ix_(idx[start:start+block_size], idx)] += 1
+    
+    return counts
+
+
 def cluster_matrix_average(M, cluster_assignments):
     """
     Calculate the average element value within a similarity matrix for each cluster assignment, a measure
@@ -237,7 +465,58 @@ def cluster_matrix_average(M, cluster_assignments):
     return s
 
 
-def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5):
+def bootstrap_stability_counts(Y, bootstrap_ids, k_clusters, cbb_block_size, affinity_threshold, random_state):
+    """
+    Cluster bootstrap samples of a single subject's time-series and count how often each pair of voxels
+    is assigned to the same cluster.
+    
+    Each bootstrap seeds the global numpy generator (which the ncut discretisation also draws from) with
+    (`random_state`, bootstrap id), so its sample and clustering are the same whichever process runs it
+    and whatever it ran before.  The caller's generator state is restored afterwards.
+    
+    Parameters
+    ----------
+    Y : array_like
+        A matrix of shape (`N`, `V`) with `N` timepoints and `V` voxels
+    bootstrap_ids : list of integers
+        Ids of the bootstrap samples to cluster
+    k_clusters : integer
+        Number of clusters
+    cbb_block_size : integer
+        Block size to use for the Circular Block Bootstrap algorithm
+    affinity_threshold : float
+        Minimum threshold for similarity matrix based on correlation to create an edge
+    random_state : integer
+        Seed shared by all bootstraps of the subject
+    
+    Returns
+    -------
+    counts : array_like
+        An unsigned integer matrix of shape (`V`, `V`) of the number of bootstraps in which voxels i and j are clustered together
+    """
+    N = Y.shape[0]
+    V = Y.shape[1]
+    counts = np.zeros((V,V), dtype=coassignment_dtype(len(bootstrap_ids)))
+    
+    # Bootstrap correlations are weighted sums over the time-series, without resampled copies.  The memory
+    # layout is fixed so that the sums round the same way in every process.
+    Yc = np.ascontiguousarray(Y, dtype='float64')
+    buf = np.empty_like(Yc)
+    
+    state = np.random.get_state()
+    try:
+        for bootstrap_i in bootstrap_ids:
+            np.random.seed([random_state, bootstrap_i])
+            w = timeseries_bootstrap_weights(N, cbb_block_size)
+            C_X = correlation_affinity(weighted_normalized_timeseries(Yc, w, out=buf), affinity_threshold)
+            accumulate_coassignment(counts, cluster_timeseries(C_X, k_clusters, similarity_metric = 'data'))
+    finally:
+        np.random.set_state(state)
+    
+    return counts
+
+
+def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5, n_jobs = 1, random_state = None, return_counts = False):
     """
     Calculate the individual stability matrix of a single subject by bootstrapping their time-series
     
@@ -253,6 +532,13 @@ def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = No
         Block size to use for the Circular Block Bootstrap algorithm
     affinity_threshold : float, optional
         Minimum threshold for similarity matrix based on correlation to create an edge
+    n_jobs : integer, optional
+        Number of processes to split the bootstraps across
+    random_state : integer, optional
+        Seed of the bootstraps; by default drawn from the global numpy generator.  Each bootstrap is seeded
+        from it and its own id, so the result does not depend on `n_jobs`
+    return_counts : boolean, optional
+        Return the integer number of bootstraps in which each pair of voxels is clustered together, rather than its fraction
     
     Returns
     -------
@@ -268,10 +554,142 @@ def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = No
     if(cbb_block_size is None):
         cbb_block_size = int(np.sqrt(N))
 
-    S = np.zeros((V,V))
-    for bootstrap_i in range(n_bootstraps):
-        Y_b = timeseries_bootstrap(Y, cbb_block_size)
-        S += adjacency_matrix(cluster_timeseries(Y_b.T, k_clusters, similarity_metric = 'correlation', affinity_threshold = affinity_threshold)[:,np.newaxis])
-    S /= n_bootstraps
+    if(random_state is None):
+        random_state = np.random.randint(0, 2**31 - 1)
+
+    # Each process counts co-assignments over its share of the bootstraps
+    n_jobs = max(1, min(n_jobs, n_bootstraps))
+    if n_jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = [pool.apply_async(bootstrap_stability_counts, (Y, bootstrap_ids, k_clusters, cbb_block_size, affinity_threshold, random_state))
+                       for bootstrap_ids in np.array_split(np.arange(n_bootstraps), n_jobs)]
+            counts = np.zeros((V,V), dtype=coassignment_dtype(n_bootstraps))
+            for result in results:
+                counts += result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        counts = bootstrap_stability_counts(Y, range(n_bootstraps), k_clusters, cbb_block_size, affinity_threshold, random_state)
+
+    if return_counts:
+        return counts
+
+    # Normalize the counts only once all bootstraps are in
+    S = counts/float(n_bootstraps)
+
+    return S
+
+
+def write_stability_counts(ism_file, counts, n_bootstraps):
+    """
+    Write an individual stability matrix as the bootstrap counts of its upper triangle (including the diagonal).
+    
+    The counts are stored row by row in the smallest unsigned integer type that holds `n_bootstraps`, after a
+    header with the dtype, the number of voxels and `n_bootstraps`.  A matrix of 10000 voxels takes 50 MB with
+    fewer than 256 bootstraps, rather than 800 MB as float64.
+    
+    Parameters
+    ----------
+    ism_file : string
+        Path of the file to write
+    counts : array_like
+        A symmetric integer matrix of shape (`V`, `V`) of the number of bootstraps in which voxels i and j are clustered together
+    n_bootstraps : integer
+        Number of bootstraps the counts are out of
+    
+    Returns
+    -------
+    ism_file : string
+        Path of the file written
+    """
+    V = counts.shape[0]
+    if n_bootstraps < 2**8:
+        dtype = np.dtype('uint8')
+    else:
+        dtype = coassignment_dtype(n_bootstraps)
+    
+    with open(ism_file, 'wb') as f:
+        f.write(ISM_HEADER.pack(ISM_MAGIC, dtype.str, V, n_bootstraps).ljust(ISM_HEADER_SIZE, '\0'))
+        for i in range(V):
+            counts[i, i:].astype(dtype).tofile(f)
+    
+    return ism_file
+
+
+def read_stability_counts(ism_file):
+    """
+    Memory map an individual stability matrix file.
+    
+    Files written by `write_stability_counts` give their packed upper-triangle counts and number of bootstraps.
+    Dense .npy matrices of stability fractions are also read, as counts out of 1.
+    
+    Parameters
+    ----------
+    ism_file : string
+        Path of the individual stability matrix file
+    
+    Returns
+    -------
+    counts : array_like
+        Packed upper triangle of length `V`*(`V`+1)/2, or the dense (`V`, `V`) matrix of a .npy file
+    V : integer
+        Number of voxels
+    n_bootstraps : integer
+        Number of bootstraps the counts are out of
+    """
+    with open(ism_file, 'rb') as f:
+        header = f.read(ISM_HEADER_SIZE)
+    
+    if not header.startswith(ISM_MAGIC):
+        counts = np.load(ism_file, mmap_mode='r')
+        return counts, counts.shape[0], 1
+    
+    magic, dtype, V, n_bootstraps = ISM_HEADER.unpack(header[:ISM_HEADER.size])
+    counts = np.memmap(ism_file, dtype=np.dtype(dtype.rstrip('\0')), mode='r', offset=ISM_HEADER_SIZE, shape=(V*(V+1)/2,))
+    
+    return counts, V, n_bootstraps
 
-    return S
\ No newline at end of file
+
+def unpack_stability_counts(counts, V, total = 1):
+    """
+    Expand packed upper-triangle counts into a dense symmetric matrix.
+    
+    Parameters
+    ----------
+    counts : array_like
+        Packed upper triangle of length `V`*(`V`+1)/2, as from `read_stability_counts`.  A dense (`V`, `V`) matrix is
+        only divided by `total`
+    V : integer
+        Number of voxels
+    total : number, optional
+        Number the counts are out of, e.g. n_bootstraps for the stability matrix, which they are divided by
+    
+    Returns
+    -------
+    S : array_like
+        A float64 matrix of shape (`V`, `V`)
+    
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from CPAC.basc import unpack_stability_counts
+    >>> unpack_stability_counts(np.array([4, 1, 0, 4, 3, 4]), 3, 4)
+    array([[ 1.  ,  0.25,  0.  ],
+           [ 0.25,  1.  ,  0.75],
+           [ 0.  ,  0.75,  1.  ]])
+    """
+    if counts.ndim == 2:
+        return counts/float(total)
+    
+    # The packed counts are the upper triangle in row order, which is also the order of a boolean mask of it; the
+    # same mask on the transpose fills the lower triangle
+    upper = np.triu(np.ones((V,V), dtype=bool))
+    S = np.empty((V,V))
+    S[upper] = counts
+    S.T[upper] = counts
+    S /= total
+    
+    return S
@@ -2,6 +2,8 @@ from utils import calc_cwas, \
                   mdmr
 
 from cwas import joint_mask, \
+                 pack_subjects_cube, \
+                 load_subjects_cube, \
                  nifti_cwas, \
                  create_cwas
 
@@ -9,4 +11,6 @@ __all__ = ['create_cwas',
            'calc_cwas',
            'mdmr',
            'joint_mask',
+           'pack_subjects_cube',
+           'load_subjects_cube',
            'nifti_cwas']
\ No newline at end of file
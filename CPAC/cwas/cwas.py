@@ -44,8 +44,122 @@ def joint_mask(subjects_file_list, mask_file):
     
     return img_file
 
+def pack_subjects_cube(subjects_file_list, mask_file):
+    """
+    Packs the masked time series of all the subjects into one memory mapped
+    array (the cube) and creates the joint mask (intersection) common to all 
+    the subjects and the provided mask
+    
+    Every subject is loaded only once here. The CWAS batches then read the
+    data from the cube instead of decompressing every subject again.
+    
+    Parameters
+    ----------
+    subjects_file_list : list of strings
+        A length `N` list of file paths of the nifti files of subjects
+    mask_file : string
+        Path to a mask file in nifti format
+    
+    Returns
+    -------
+    joint_mask : string
+        Path to joint mask file in nifti format
+    cube_file : string
+        Path to the .npz index of the cube. It holds the name of the float32
+        .npy data file (of shape (`sum T`, `V`), with the time series of 
+        each subject stacked along the first axis in the order of 
+        `subjects_file_list` and `V` voxels in the provided mask), the 
+        `offsets` and `ntpts` of each subject along the first axis and the
+        `columns` of the joint mask voxels.
+    
+    """
+    import nibabel as nb
+    import numpy as np
+    import os
+    
+    from CPAC.utils import safe_shape
+    
+    nii = nb.load(mask_file)
+    
+    mask = nii.get_data().astype('bool')
+    mask_indices = np.where(mask)
+    
+    # Number of timepoints from the headers to allocate the cube
+    ntpts   = np.array([ nb.load(subject_file).shape[-1] 
+                         for subject_file in subjects_file_list ])
+    offsets = np.concatenate(([0], np.cumsum(ntpts)[:-1]))
+    
+    cwd = os.getcwd()
+    data_file = os.path.join(cwd, 'subjects_cube.npy')
+    cube = np.lib.format.open_memmap(data_file, mode='w+', dtype=np.float32,
+                                     shape=(ntpts.sum(), mask.sum()))
+    
+    joint = mask.copy()
+    for i,subject_file in enumerate(subjects_file_list):
+        sdata = nb.load(subject_file).get_data()
+        if not safe_shape(sdata, mask): raise ValueError('Subject %s with volume shape %s conflicts \
+                                                          with mask shape %s' % ( subject_file,
+                                                                                  str(sdata.shape),
+                                                                                  str(mask.shape) ) )
+        sdata = sdata[mask_indices].astype(np.float32)
+        joint[mask_indices] *= sdata.astype(np.float64).sum(-1).astype('bool')
+        cube[offsets[i]:offsets[i]+ntpts[i]] = sdata.T
+        del sdata
+    
+    cube.flush()
+    del cube
+    
+    # Joint mask voxels within the cube
+    columns = np.where(joint[mask_indices])[0]
+    
+    print '... subject data packed into', data_file
+    
+    img = nb.Nifti1Image(joint, header=nii.get_header(), affine=nii.get_affine())
+    img_file = os.path.join(cwd, 'joint_mask.nii.gz')
+    img.to_filename(img_file)
+    
+    cube_file = os.path.join(cwd, 'subjects_cube_index.npz')
+    np.savez(cube_file, data_file=os.path.basename(data_file), 
+             offsets=offsets, ntpts=ntpts, columns=columns)
+    
+    return img_file, cube_file
+
+def load_subjects_cube(cube_file):
+    """
+    Reads the joint mask time series of every subject from a cube created by
+    `pack_subjects_cube`
+    
+    Parameters
+    ----------
+    cube_file : string
+        Path to the .npz index of the cube
+    
+    Returns
+    -------
+    subjects_data : list of ndarray
+        Data arrays of shape (`T`, `V`) for each subject, `V` voxels in the
+        joint mask
+    
+    """
+    import numpy as np
+    import os
+    
+    index = np.load(cube_file)
+    data_file = os.path.join(os.path.dirname(cube_file), 
+                             str(index['data_file']))
+    offsets = index['offsets']
+    ntpts   = index['ntpts']
+    columns = index['columns']
+    
+    cube = np.load(data_file, mmap_mode='r')
+    subjects_data = [ cube[offsets[i]:offsets[i]+ntpts[i]][:,columns].astype('float64') 
+                        for i in range(len(offsets)) ]
+    
+    return subjects_data
+
 def nifti_cwas(subjects_file_list, mask_file, regressor, cols, f_samples, 
-               voxel_range, strata=None):
+               voxel_range, strata=None, cube_file=None, 
+               max_exceedances=None, memmap_dmats=False, checkpoint_dir=None):
     """
     Performs CWAS for a group of subjects
     
@@ -66,6 +180,20 @@ def nifti_cwas(subjects_file_list, mask_file, regressor, cols, f_samples,
         Index ordering is based on the np.where(mask) command
     strata : ndarray (optional)
         todo
+    cube_file : string (optional)
+        Index of the subjects cube from `pack_subjects_cube`.  If specified, 
+        the subject data is read from the cube instead of the nifti files.
+    max_exceedances : integer (optional)
+        If specified, permutations of a voxel stop once this many permuted 
+        pseudo-F values exceed its observed one
+    memmap_dmats : boolean (optional)
+        Keep the distance matrices of the batch in a memory mapped file in 
+        the working directory instead of in memory (for batches that exceed
+        RAM)
+    checkpoint_dir : string (optional)
+        If specified, the results of the batch are saved to this directory
+        and a batch that was already completed with the same inputs is not 
+        computed again (to resume an interrupted run)
     
     Returns
     -------
@@ -82,6 +210,9 @@ def nifti_cwas(subjects_file_list, mask_file, regressor, cols, f_samples,
     import numpy as np
     import os
     from CPAC.cwas import calc_cwas
+    from CPAC.cwas.cwas import load_subjects_cube, cwas_fingerprint, \
+                               cwas_mask_fingerprint, load_cwas_checkpoint, \
+                               save_cwas_checkpoint
     
     #Check regressor is a column vector
     if(len(regressor.shape) == 1):
@@ -92,29 +223,243 @@ def nifti_cwas(subjects_file_list, mask_file, regressor, cols, f_samples,
     if(len(subjects_file_list) != regressor.shape[0]):
         raise ValueError('Number of subjects does not match regressor size')
     
-    #Load the data to produce the joint mask
-    mask = nb.load(mask_file).get_data().astype('bool')
-    mask_indices = np.where(mask)
-    #batch_indices = tuple([mask_index[voxel_range[0]:voxel_range[1]] for mask_index in mask_indices])
+    cwd = os.getcwd()
+    F_file = os.path.join(cwd, 'pseudo_F.npy')
+    p_file = os.path.join(cwd, 'significance_p.npy')
     
-    #Reload the data again to actually get the values, sacrificing CPU for smaller memory footprint
-    subjects_data = [ nb.load(subject_file).get_data().astype('float64')[mask_indices].T 
-                        for subject_file in subjects_file_list ]
-    #subjects_data = np.array(subjects_data)
+    if checkpoint_dir is not None:
+        mask_fingerprint = cwas_mask_fingerprint(mask_file)
+        fingerprint = cwas_fingerprint(mask_fingerprint, subjects_file_list, 
+                                       regressor, cols, f_samples, strata, 
+                                       max_exceedances)
+        files = load_cwas_checkpoint(checkpoint_dir, voxel_range, fingerprint,
+                                     mask_fingerprint)
+        if files is not None:
+            print '... batch voxel range', voxel_range, 'already completed'
+            np.save(F_file, np.load(files[0]))
+            np.save(p_file, np.load(files[1]))
+            return F_file, p_file, voxel_range
+    
+    if cube_file is not None:
+        subjects_data = load_subjects_cube(cube_file)
+    else:
+        #Load the data to produce the joint mask
+        mask = nb.load(mask_file).get_data().astype('bool')
+        mask_indices = np.where(mask)
+        #batch_indices = tuple([mask_index[voxel_range[0]:voxel_range[1]] for mask_index in mask_indices])
+        
+        #Reload the data again to actually get the values, sacrificing CPU for smaller memory footprint
+        subjects_data = [ nb.load(subject_file).get_data().astype('float64')[mask_indices].T 
+                            for subject_file in subjects_file_list ]
+        #subjects_data = np.array(subjects_data)
     print '... subject data loaded', len(subjects_data), 'batch voxel range', voxel_range
     
-    F_set, p_set = calc_cwas(subjects_data, regressor, cols, f_samples, voxel_range, strata)
+    dmats_file = None
+    if memmap_dmats:
+        dmats_file = os.path.join(cwd, 'subject_distances.npy')
+    
+    F_set, p_set = calc_cwas(subjects_data, regressor, cols, f_samples, voxel_range, strata, 
+                             max_exceedances, dmats_file)
+    
+    if dmats_file is not None:
+        os.remove(dmats_file)
     
     print '... writing cwas data to disk'
-    cwd = os.getcwd()
-    F_file = os.path.join(cwd, 'pseudo_F.npy')
-    p_file = os.path.join(cwd, 'significance_p.npy')
-
     np.save(F_file, F_set)
     np.save(p_file, p_set)
     
+    if checkpoint_dir is not None:
+        save_cwas_checkpoint(checkpoint_dir, voxel_range, F_set, p_set, 
+                             fingerprint, mask_fingerprint)
+    
     return F_file, p_file, voxel_range
 
+def cwas_fingerprint(*inputs):
+    """
+    Hash of the CWAS inputs, used to check that a checkpoint was created with
+    the same subjects, regressor and settings
+    """
+    import hashlib
+    import numpy as np
+    
+    md5 = hashlib.md5()
+    for inp in inputs:
+        if isinstance(inp, np.ndarray):
+            md5.update(str(inp.shape))
+            md5.update(np.ascontiguousarray(inp).tostring())
+        else:
+            md5.update(repr(inp))
+    return md5.hexdigest()
+
+def cwas_mask_fingerprint(mask_file):
+    """
+    Hash of the voxels of a (joint) mask, used to check that a checkpoint
+    holds the results of the same voxels.  The voxel ranges of the batches
+    index into this mask, so a run with another ROI or joint mask must not
+    reuse them.
+    """
+    import hashlib
+    import nibabel as nb
+    import numpy as np
+    
+    nii  = nb.load(mask_file)
+    mask = nii.get_data().astype('bool')
+    
+    md5 = hashlib.md5()
+    md5.update(str(mask.shape))
+    md5.update(np.asarray(nii.get_affine(), dtype='float64').tostring())
+    md5.update(np.packbits(mask.ravel()).tostring())
+    return md5.hexdigest()
+
+def cwas_checkpoint_files(checkpoint_dir, voxel_range):
+    """
+    Paths of the pseudo-F, p-value and manifest entry files of the checkpoint
+    of a batch of voxels
+    """
+    import os
+    
+    prefix = os.path.join(checkpoint_dir, 'cwas_batch_%09i_%09i' % tuple(voxel_range))
+    return prefix + '_pseudo_F.npy', prefix + '_significance_p.npy', prefix + '.json'
+
+def save_cwas_checkpoint(checkpoint_dir, voxel_range, F_set, p_set, fingerprint,
+                         mask_fingerprint=None):
+    """
+    Saves the results of a batch of voxels to the checkpoint directory
+    
+    The manifest entry (.json) of the batch is written last and atomically,
+    so a batch is only considered complete when its entry exists.  The entry
+    records the `fingerprint` of the inputs and the `mask_fingerprint` (see
+    `cwas_mask_fingerprint`) of the voxels of the batch.
+    """
+    import json
+    import numpy as np
+    import os
+    
+    F_file, p_file, entry_file = cwas_checkpoint_files(checkpoint_dir, voxel_range)
+    np.save(F_file, F_set)
+    np.save(p_file, p_set)
+    
+    entry = {'voxel_range': [int(v) for v in voxel_range],
+             'fingerprint': fingerprint,
+             'mask_fingerprint': mask_fingerprint,
+             'F_file': os.path.basename(F_file),
+             'p_file': os.path.basename(p_file)}
+    tmp_file = entry_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(entry, f)
+    os.rename(tmp_file, entry_file)
+    
+    return F_file, p_file
+
+def load_cwas_checkpoint(checkpoint_dir, voxel_range, fingerprint=None, 
+                         mask_fingerprint=None):
+    """
+    Results of a batch of voxels from the checkpoint directory
+    
+    Returns
+    -------
+    files : tuple or None
+        (`F_file`, `p_file`) of the batch or None if the batch has not been
+        completed (or was completed with different inputs than `fingerprint`
+        or another mask than `mask_fingerprint`)
+    """
+    import json
+    import os
+    
+    F_file, p_file, entry_file = cwas_checkpoint_files(checkpoint_dir, voxel_range)
+    if not os.path.exists(entry_file):
+        return None
+    with open(entry_file) as f:
+        entry = json.load(f)
+    if fingerprint is not None and entry['fingerprint'] != fingerprint:
+        return None
+    if mask_fingerprint is not None and \
+       entry.get('mask_fingerprint') != mask_fingerprint:
+        return None
+    
+    return F_file, p_file
+
+def cwas_checkpoint_status(checkpoint_dir, fingerprint=None):
+    """
+    Completed and pending batches of the CWAS run in a checkpoint directory
+    
+    Only the batches computed on the mask recorded in the manifest count as
+    completed, so results left over from a run with another mask are not 
+    reused.
+    
+    Parameters
+    ----------
+    checkpoint_dir : string
+        Directory given to `create_cwas_batches` and `nifti_cwas`
+    fingerprint : string (optional)
+        If specified, only the batches computed with these inputs (see 
+        `cwas_fingerprint`) count as completed
+    
+    Returns
+    -------
+    completed : list of tuples
+        (`F_file`, `p_file`, `voxel_range`) of every completed batch
+    pending : list of tuples
+        `voxel_range` of every batch in the manifest that is not completed
+    """
+    import json
+    import os
+    
+    with open(os.path.join(checkpoint_dir, 'cwas_manifest.json')) as f:
+        manifest = json.load(f)
+    
+    completed = []
+    pending = []
+    for voxel_range in manifest['batches']:
+        voxel_range = tuple(voxel_range)
+        files = load_cwas_checkpoint(checkpoint_dir, voxel_range, fingerprint,
+                                     manifest.get('mask_fingerprint'))
+        if files is None:
+            pending.append(voxel_range)
+        else:
+            completed.append(files + (voxel_range,))
+    
+    return completed, pending
+
+def merge_cwas_checkpoints(checkpoint_dir, mask_file, fingerprint=None):
+    """
+    Merges the batches completed so far in a checkpoint directory into
+    volumes. Voxels of pending batches are left as zeros.
+    
+    Parameters
+    ----------
+    checkpoint_dir : string
+        Directory given to `create_cwas_batches` and `nifti_cwas`
+    mask_file : string
+        Path to the joint mask the batches were computed on
+    fingerprint : string (optional)
+        If specified, only the batches computed with these inputs (see 
+        `cwas_fingerprint`) are merged
+    
+    Returns
+    -------
+    F_file : string
+    p_file : string
+    pending : list of tuples
+        `voxel_range` of the batches not yet completed
+    """
+    import json
+    import os
+    
+    with open(os.path.join(checkpoint_dir, 'cwas_manifest.json')) as f:
+        manifest = json.load(f)
+    if 'mask_fingerprint' in manifest and \
+       cwas_mask_fingerprint(mask_file) != manifest['mask_fingerprint']:
+        raise ValueError('Mask %s differs from the mask of the checkpoints '
+                         'in %s' % (mask_file, checkpoint_dir))
+    
+    completed, pending = cwas_checkpoint_status(checkpoint_dir, fingerprint)
+    print '... %i batches completed and %i pending' % (len(completed), len(pending))
+    
+    F_file, p_file = merge_cwas_batches(completed, mask_file)
+    
+    return F_file, p_file, pending
+
 def merge_cwas_batches(cwas_batches, mask_file):
     import numpy as np
     import nibabel as nb
@@ -125,14 +470,12 @@ def merge_cwas_batches(cwas_batches, mask_file):
         volume[np.where(mask==True)] = data
         return volume
     
-    F_files, p_files, voxel_range = zip(*cwas_batches)
-    end_voxel = np.array(voxel_range).max()
-    
     nii = nb.load(mask_file)
     mask = nii.get_data().astype('bool')
     
-    F_set = np.zeros(end_voxel)
-    p_set = np.zeros(end_voxel)
+    # Missing batches (of a partial run) are left as zeros
+    F_set = np.zeros(mask.sum())
+    p_set = np.zeros(mask.sum())
     for F_file, p_file, voxel_range in cwas_batches:
         F_batch = np.load(F_file)
         p_batch = np.load(p_file)
@@ -153,9 +496,12 @@ def merge_cwas_batches(cwas_batches, mask_file):
     
     return F_file, p_file
 
-def create_cwas_batches(mask_file, batches):
+def create_cwas_batches(mask_file, batches, checkpoint_dir=None):
+    import json
     import nibabel as nb
     import numpy as np
+    import os
+    from CPAC.cwas.cwas import cwas_mask_fingerprint
     mask = nb.load(mask_file).get_data().astype('bool')
     nVoxels = mask.sum()
     
@@ -169,6 +515,16 @@ def create_cwas_batches(mask_file, batches):
     # Add remainder voxels to last batch
     batch_list[-1] = (batch_list[-1][0], nVoxels)
     
+    # Manifest of all the batches, each batch adds its own entry when done
+    if checkpoint_dir is not None:
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        manifest = {'nvoxels': int(nVoxels), 
+                    'mask_fingerprint': cwas_mask_fingerprint(mask_file),
+                    'batches': [ [int(v) for v in vr] for vr in batch_list ]}
+        with open(os.path.join(checkpoint_dir, 'cwas_manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+    
     return batch_list
 
 
@@ -205,8 +561,20 @@ def create_cwas(name='cwas'):
             Number of permutation samples to draw from the pseudo F distribution
         inputspec.strata : None or ndarray
             todo
+        inputspec.max_exceedances : None or int
+            If set, permutations of a voxel stop once this many permuted 
+            pseudo F values exceed the observed one (sequential p-values).
+            None by default
+        inputspec.memmap_dmats : boolean
+            Keep the distance matrices of each batch in a memory mapped file
+            in its working directory rather than in memory.  False by default
         inputspec.parallel_nodes : integer
             Number of nodes to create and potentially parallelize over
+        inputspec.checkpoint_dir : None or string
+            Directory where each batch saves its results.  Rerunning with 
+            the same directory skips the batches already completed and 
+            `merge_cwas_checkpoints` can merge a partial run.  None (no
+            checkpoints) by default
         
     Workflow Outputs::
 
@@ -217,6 +585,8 @@ def create_cwas(name='cwas'):
             
     CWAS Procedure:
     
+    0. Pack the subjects data within the joint mask into one memory mapped 
+       array shared by all the batches
     1. Calculate spatial correlation of a voxel
     2. Correlate spatial z-score maps for every subject pair
     3. Convert matrix to distance matrix, `1-r`
@@ -245,8 +615,14 @@ def create_cwas(name='cwas'):
                                                        'cols', 
                                                        'f_samples', 
                                                        'strata', 
+                                                       'max_exceedances',
+                                                       'memmap_dmats',
+                                                       'checkpoint_dir',
                                                        'parallel_nodes']),
                         name='inputspec')
+    inputspec.inputs.max_exceedances = None
+    inputspec.inputs.memmap_dmats = False
+    inputspec.inputs.checkpoint_dir = None
     outputspec = pe.Node(util.IdentityInterface(fields=['F_map',
                                                         'p_map']),
                          name='outputspec')
@@ -254,7 +630,8 @@ def create_cwas(name='cwas'):
     cwas = pe.Workflow(name=name)
     
     ccb = pe.Node(util.Function(input_names=['mask_file',
-                                             'batches'],
+                                             'batches',
+                                             'checkpoint_dir'],
                                 output_names=['batch_list'],
                                 function=create_cwas_batches),
                   name='cwas_batches')
@@ -266,7 +643,11 @@ def create_cwas(name='cwas'):
                                                   'f_samples',
 #                                                  'compiled_func',
                                                   'voxel_range', 
-                                                  'strata'],
+                                                  'strata',
+                                                  'cube_file',
+                                                  'max_exceedances',
+                                                  'memmap_dmats',
+                                                  'checkpoint_dir'],
                                      output_names=['result_batch'],
                                      function=nifti_cwas),
                        name='cwas_batch',
@@ -281,11 +662,12 @@ def create_cwas(name='cwas'):
     
     jmask = pe.Node(util.Function(input_names=['subjects_file_list', 
                                                'mask_file'],
-                                  output_names=['joint_mask'],
-                                  function=joint_mask),
+                                  output_names=['joint_mask',
+                                                'cube_file'],
+                                  function=pack_subjects_cube),
                     name='joint_mask')
     
-    #Compute the joint mask
+    #Compute the joint mask and pack the subjects data
     cwas.connect(inputspec, 'subjects',
                  jmask, 'subjects_file_list')
     cwas.connect(inputspec, 'roi',
@@ -296,6 +678,8 @@ def create_cwas(name='cwas'):
                  ccb, 'mask_file')
     cwas.connect(inputspec, 'parallel_nodes',
                  ccb, 'batches')
+    cwas.connect(inputspec, 'checkpoint_dir',
+                 ccb, 'checkpoint_dir')
     
     #Compute CWAS over batches of voxels
     cwas.connect(jmask, 'joint_mask',
@@ -314,6 +698,14 @@ def create_cwas(name='cwas'):
                  ncwas, 'voxel_range')
     cwas.connect(inputspec, 'strata',
                  ncwas, 'strata')
+    cwas.connect(jmask, 'cube_file',
+                 ncwas, 'cube_file')
+    cwas.connect(inputspec, 'max_exceedances',
+                 ncwas, 'max_exceedances')
+    cwas.connect(inputspec, 'memmap_dmats',
+                 ncwas, 'memmap_dmats')
+    cwas.connect(inputspec, 'checkpoint_dir',
+                 ncwas, 'checkpoint_dir')
     
     #Merge the computed CWAS data
     cwas.connect(ncwas, 'result_batch',
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.sparse import csr_matrix
 from hats import *
 
 def permuted_index(n, strata=None):
@@ -36,16 +37,130 @@ def gower_center(yDis):
     return G
 
 def gower_center_many(dmats):
-    nobs    = np.sqrt(dmats.shape[0])
+    """
+    Gower center many distance matrices at once
+    
+    Parameters
+    ----------
+    dmats : ndarray
+        Matrix of shape (`nobs**2`, `ntests`) where each column is a
+        flattened `nobs` x `nobs` distance matrix
+    
+    Returns
+    -------
+    Gs : ndarray
+        Matrix of shape (`nobs**2`, `ntests`) where each column is the
+        flattened Gower centered matrix of the corresponding distance matrix
+    
+    Notes
+    -----
+    Double-centering `C.dot(A).dot(C)` is the same as subtracting the row and
+    column means of `A` and adding back the grand mean, so all the matrices
+    are centered together without any per-test matrix products.
+    """
+    nobs    = int(np.sqrt(dmats.shape[0]))
     ntests  = dmats.shape[1]
-    Gs      = np.zeros_like(dmats)
     
-    for i in range(ntests):
-        Dmat    = dmats[:,i].reshape(nobs,nobs)
-        Gs[:,i] = gower_center(Dmat).flatten()
+    Gs      = -0.5 * (dmats.reshape(nobs, nobs, ntests)**2)
+    Gs     -= Gs.mean(0)[np.newaxis,:,:]
+    Gs     -= Gs.mean(1)[:,np.newaxis,:]
+    
+    return Gs.reshape(nobs**2, ntests)
+
+def nobs_from_condensed(npairs):
+    """
+    Number of observations of a condensed (upper triangle) distance matrix
+    with `npairs` elements
+    """
+    nobs = int(round((1 + np.sqrt(1 + 8*npairs))/2))
+    if nobs*(nobs-1)/2 != npairs:
+        raise Exception("%i is not the size of a condensed distance matrix" % npairs)
+    return nobs
+
+def condense_symmetric(M):
+    """
+    Condensed form of a symmetric matrix for products with condensed Gower 
+    centered matrices
+    
+    The diagonal is followed by twice the upper triangle (row-major) so that
+    the dot product of two of these with `gower_center_condensed` equals the
+    trace of the product of the full matrices.
+    """
+    nobs = M.shape[0]
+    iu   = np.triu_indices(nobs, 1)
+    return np.concatenate((M.diagonal(), 2*M[iu]))
+
+def gower_center_condensed(dvecs):
+    """
+    Gower center many condensed distance matrices at once
+    
+    Parameters
+    ----------
+    dvecs : ndarray
+        Matrix of shape (`nobs*(nobs-1)/2`, `ntests`) where each column is 
+        the upper triangle (row-major, as in `scipy.spatial.distance`) of a 
+        distance matrix. Can be float32 and/or memory mapped.
+    
+    Returns
+    -------
+    Gs : ndarray
+        Matrix of shape (`nobs + nobs*(nobs-1)/2`, `ntests`) where each 
+        column is the diagonal followed by the upper triangle of the Gower 
+        centered matrix. Use with `condense_symmetric` hat matrices. It is
+        float32 for float32 `dvecs` (the centering itself is done in 
+        float64).
+    """
+    npairs  = dvecs.shape[0]
+    ntests  = dvecs.shape[1]
+    nobs    = nobs_from_condensed(npairs)
+    iu      = np.triu_indices(nobs, 1)
+    
+    A       = -0.5 * (np.asarray(dvecs, dtype=np.float64)**2)
+    
+    # Row means of the full matrices (the diagonal of A is zero) with an 
+    # observation x pair incidence matrix
+    pairs     = np.arange(npairs)
+    incidence = csr_matrix((np.ones(2*npairs), 
+                            (np.concatenate(iu), np.concatenate((pairs,pairs)))), 
+                           shape=(nobs, npairs))
+    row_means = incidence.dot(A)/nobs
+    grand_mean = row_means.mean(0)
+    
+    Gs = np.empty((nobs + npairs, ntests), 
+                  dtype=np.result_type(dvecs.dtype, np.float32))
+    Gs[:nobs] = grand_mean - 2*row_means
+    A -= row_means[iu[0]]
+    A -= row_means[iu[1]]
+    A += grand_mean
+    Gs[nobs:] = A
     
     return Gs
 
+def gower_center_tests(ys, tests, condensed=False):
+    """
+    Gower center the distance matrices of some of the tests
+    
+    Parameters
+    ----------
+    ys : ndarray
+        Distance matrices as given to `mdmr`, one test per column. Can be
+        memory mapped, only the columns of `tests` are read.
+    tests : slice or ndarray
+        Columns of `ys` to center
+    condensed : boolean (optional)
+        If True, the columns of ys are condensed distance matrices
+    
+    Returns
+    -------
+    Gs : ndarray
+        Gower centered matrices of the tests (see `gower_center_many` and
+        `gower_center_condensed`)
+    """
+    if condensed:
+        return gower_center_condensed(ys[:,tests])
+    else:
+        return gower_center_many(ys[:,tests])
+
 def gen_h2_perms(x, cols, perms):
     nperms  = perms.shape[0]
     nobs    = perms.shape[1]
@@ -69,6 +184,77 @@ def gen_ih_perms(x, cols, perms):
     
     return IHperms
 
+def gen_h2_ih_perms(x, cols, perms, condensed=False):
+    """
+    Permuted H2 and IH matrices built together
+    
+    Same as calling `gen_h2_perms` and `gen_ih_perms` except that the hat
+    matrix of each permuted design is computed only once and the hat matrix
+    of the columns that are not permuted is computed once for all
+    permutations.
+    
+    Parameters
+    ----------
+    x : ndarray
+        Design matrix (e.g. with 1st column as your intercept)
+    cols : list
+        Columns to be permuted
+    perms : ndarray
+        Matrix of shape (`nperms`, `nobs`) with the permuted indices
+    condensed : boolean (optional)
+        Return the matrices in the form of `condense_symmetric` for use with
+        condensed Gower centered matrices
+    
+    Returns
+    -------
+    H2perms : ndarray
+        Matrix of shape (`nobs**2`, `nperms`) or 
+        (`nobs + nobs*(nobs-1)/2`, `nperms`) if condensed
+    IHperms : ndarray
+        Matrix of the same shape as `H2perms`
+    """
+    nperms  = perms.shape[0]
+    nobs    = perms.shape[1]
+    I       = np.eye(nobs,nobs)
+    
+    if condensed:
+        flatten = condense_symmetric
+        nelems  = nobs + nobs*(nobs-1)/2
+    else:
+        flatten = lambda M: M.flatten()
+        nelems  = nobs**2
+    
+    other_cols = [ i for i in range(x.shape[1]) if i not in cols ]
+    Hother  = hatify(x[:,other_cols])
+    
+    H2perms = np.zeros((nelems, nperms))
+    IHperms = np.zeros((nelems, nperms))
+    for i in range(nperms):
+        H = gen_h(x, cols, perms[i,:])
+        H2perms[:,i] = flatten(H - Hother)
+        IHperms[:,i] = flatten(I - H)
+    
+    return H2perms, IHperms
+
+def calc_perm_blocksize(nobs, nperms, memory_limit=1.0):
+    """
+    Number of permutations to process at once so that the permuted H2 and IH
+    matrices fit within `memory_limit` (in GB)
+    """
+    nbytes      = np.dtype('float64').itemsize
+    block_size  = int( memory_limit * 1024.0**3 / (2 * nobs**2 * nbytes) )
+    return max(1, min(block_size, nperms))
+
+def calc_test_blocksize(nelems, ntests, memory_limit=1.0):
+    """
+    Number of tests to Gower center and test at once so that their centered
+    matrices, with `nelems` elements each, and the float64 temporaries of 
+    the centering fit within `memory_limit` (in GB)
+    """
+    nbytes      = np.dtype('float64').itemsize
+    block_size  = int( memory_limit * 1024.0**3 / (4 * nelems * nbytes) )
+    return max(1, min(block_size, ntests))
+
 def calc_ssq_fast(Hs, Gs, transpose=True):
     if transpose:
         ssq = Hs.T.dot(Gs)
@@ -99,22 +285,34 @@ def mdmr_single(yDis, *args, **kwrds):
 
 def fperms_to_pvals(fstats, F_perms):
     nperms,ntests = F_perms.shape
-    pvals = np.zeros(ntests)
-    for i in range(ntests):
-        j        = (F_perms[:,i] >= fstats[i]).sum().astype('float')
-        pvals[i] = j/nperms
+    j     = (F_perms >= fstats[np.newaxis,:]).sum(0).astype('float')
+    pvals = j/nperms
     return pvals
 
-def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
+def mdmr(ys, x, cols, perms, strata=None, debug_output=False, 
+         block_size=None, condensed=False, test_block_size=None):
     """
     Multivariate Distance Matrix Regression
     
     Parameters
     ----------
     ys : ndarray
+        Matrix of shape (`nobs**2`, `ntests`) where each column is a 
+        flattened distance matrix. All the tests share the same permutations.
     x : ndarray
     perms : integer or ndarray
     strata : list or ndarray
+    block_size : integer (optional)
+        Number of permutations for which the permuted hat matrices are held
+        in memory at once. By default, all permutations are done together.
+    condensed : boolean (optional)
+        If True, ys is of shape (`nobs*(nobs-1)/2`, `ntests`) where each 
+        column is the upper triangle of a distance matrix 
+        (see `gower_center_condensed`)
+    test_block_size : integer (optional)
+        Number of tests that are Gower centered and tested at once, so only
+        their centered matrices are in memory (see `calc_test_blocksize`).
+        By default, all tests are done together.
     
     Returns
     --------
@@ -135,14 +333,13 @@ def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
     
     ntests  = ys.shape[1]
     nobs    = x.shape[0]
-    if nobs != np.sqrt(ys.shape[0]):
+    if condensed:
+        ys_nobs = nobs_from_condensed(ys.shape[0])
+    else:
+        ys_nobs = np.sqrt(ys.shape[0])
+    if nobs != ys_nobs:
         raise Exception("# of observations incompatible between x and ys")
     
-    ## Distance matrix => Gower's centered matrix
-    # G is similar to matrix of inner products from distances used in Partha Niyogi's
-    # multidimensional scaling
-    Gs = gower_center_many(ys)
-    
     # Degrees of freedom
     df_among = len(cols)
     df_resid = nobs - x.shape[1]
@@ -154,13 +351,37 @@ def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
     perms  = add_original_index(perms)
     nperms = perms.shape[0]
     
-    # Permuted versions of H2 and IH
-    H2perms = gen_h2_perms(x, cols, perms)
-    IHperms = gen_ih_perms(x, cols, perms)
+    if block_size is None:
+        block_size = nperms
+    if test_block_size is None:
+        test_block_size = ntests
     
     # Permutations of Fstats
-    F_perms = ftest_fast(H2perms, IHperms, Gs,
-                         df_among, df_resid)
+    # Done in blocks of tests since the Gower centered matrices take up 
+    # `nobs**2` x `ntests`, so each test is centered (and read from ys) only
+    # once, and for each of them in blocks of permutations since the 
+    # permuted versions of H2 and IH take up `nobs**2` x `nperms` each. 
+    # These are generated once if they fit in one block, or else again for
+    # each block of tests
+    perm_blocks = [ (start, min(start + block_size, nperms)) 
+                    for start in range(0, nperms, block_size) ]
+    if len(perm_blocks) == 1:
+        H2perms, IHperms = gen_h2_ih_perms(x, cols, perms, condensed)
+    F_perms = np.zeros((nperms, ntests))
+    for tstart in range(0, ntests, test_block_size):
+        tend = min(tstart + test_block_size, ntests)
+        ## Distance matrix => Gower's centered matrix
+        # G is similar to matrix of inner products from distances used in 
+        # Partha Niyogi's multidimensional scaling
+        Gs = gower_center_tests(ys, slice(tstart, tend), condensed)
+        for start,end in perm_blocks:
+            # Permuted versions of H2 and IH
+            if len(perm_blocks) > 1:
+                H2perms, IHperms = gen_h2_ih_perms(x, cols, perms[start:end], 
+                                                   condensed)
+            F_perms[start:end,tstart:tend] = ftest_fast(H2perms, IHperms, Gs, 
+                                                        df_among, df_resid)
+        del Gs
     
     # F-values
     Fs = F_perms[0,:]
@@ -169,6 +390,131 @@ def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
     ps = fperms_to_pvals(Fs, F_perms)
     
     if debug_output:
+        # the Gower centered matrices of all tests and the full permuted 
+        # versions of H2 and IH
+        Gs = gower_center_tests(ys, slice(None), condensed)
+        H2perms, IHperms = gen_h2_ih_perms(x, cols, perms, condensed)
         return (ps, Fs, F_perms, perms, Gs, H2perms, IHperms, df_among, df_resid)
     else:
         return (ps, Fs, F_perms, perms)
+
+def mdmr_sequential(ys, x, cols, perms, max_exceedances=10, strata=None, 
+                    block_size=None, condensed=False, test_block_size=None):
+    """
+    Multivariate Distance Matrix Regression with sequential (early stopping)
+    permutation tests
+    
+    Permutations are done in blocks and a test stops receiving permutations
+    once `max_exceedances` permuted F-statistics are greater than or equal to
+    its observed F-statistic [1]_. Tests that are clearly non-significant
+    stop early while tests near the significance threshold get the full 
+    number of permutations.
+    
+    Parameters
+    ----------
+    ys : ndarray
+        Matrix of shape (`nobs**2`, `ntests`) where each column is a 
+        flattened distance matrix. All the tests share the same permutations.
+    x : ndarray
+    cols : list
+    perms : integer or ndarray
+        Maximum number of permutations or the permutations themselves
+    max_exceedances : integer (optional)
+        Number of permuted F-statistics greater than or equal to the 
+        observed one after which a test is stopped
+    strata : list or ndarray
+    block_size : integer (optional)
+        Number of permutations done at once. By default, all permutations 
+        are done together.
+    condensed : boolean (optional)
+        If True, ys holds the upper triangle of each distance matrix
+    test_block_size : integer (optional)
+        Number of tests that are Gower centered and tested at once. By 
+        default, all tests are done together.
+    
+    Returns
+    --------
+    ps : ndarray
+        For a test stopped after `l` permutations this is 
+        `max_exceedances/l`, otherwise it is the usual permutation p-value
+        (including the observed F-statistic)
+    Fs : ndarray
+    nperms_used : ndarray
+        Effective number of permutations of each test
+    perms : ndarray
+    
+    References
+    -----------
+    .. [1] Besag, J. and Clifford, P. 1991. Sequential Monte Carlo p-values. Biometrika 78: 301-304.
+    """
+    check_rank(x)
+    
+    ntests  = ys.shape[1]
+    nobs    = x.shape[0]
+    if condensed:
+        ys_nobs = nobs_from_condensed(ys.shape[0])
+    else:
+        ys_nobs = np.sqrt(ys.shape[0])
+    if nobs != ys_nobs:
+        raise Exception("# of observations incompatible between x and ys")
+    
+    # Degrees of freedom
+    df_among = len(cols)
+    df_resid = nobs - x.shape[1]
+    
+    # Permutations
+    if type(perms) is int:
+        perms = gen_perms(perms, nobs, strata)
+    perms  = add_original_index(perms)
+    nperms = perms.shape[0]
+    
+    if block_size is None:
+        block_size = nperms
+    if test_block_size is None:
+        test_block_size = ntests
+    
+    # Each block of tests is Gower centered once, and its active tests go 
+    # through the blocks of permutations until all of them have stopped
+    H2, IH      = gen_h2_ih_perms(x, cols, perms[:1], condensed)
+    Fs          = np.zeros(ntests)
+    counts      = np.zeros(ntests, dtype=np.int)
+    nperms_used = np.zeros(ntests, dtype=np.int)
+    stopped     = np.zeros(ntests, dtype=np.bool)
+    for tstart in range(0, ntests, test_block_size):
+        tend = min(tstart + test_block_size, ntests)
+        Gs   = gower_center_tests(ys, slice(tstart, tend), condensed)
+        
+        # Observed F-values
+        Fs[tstart:tend] = ftest_fast(H2, IH, Gs, df_among, df_resid)[0]
+        
+        for start in range(1, nperms, block_size):
+            active = np.where(~stopped[tstart:tend])[0]
+            if len(active) == 0:
+                break
+            end = min(start + block_size, nperms)
+            
+            H2perms, IHperms = gen_h2_ih_perms(x, cols, perms[start:end], 
+                                               condensed)
+            F_perms = ftest_fast(H2perms, IHperms, Gs[:,active], 
+                                 df_among, df_resid)
+            
+            # Running count of exceedances over the permutations in this 
+            # block
+            active += tstart
+            exceed  = np.cumsum(F_perms >= Fs[active], axis=0) + \
+                      counts[active]
+            done    = exceed[-1] >= max_exceedances
+            
+            # Tests that reached the limit stop at the permutation where it 
+            # happened
+            stop_at = np.argmax(exceed >= max_exceedances, axis=0)
+            nperms_used[active] += np.where(done, stop_at + 1, end - start)
+            counts[active] = np.where(done, max_exceedances, exceed[-1])
+            stopped[active[done]] = True
+        del Gs
+    
+    ps = np.where(stopped, 
+                  max_exceedances/nperms_used.astype('float'), 
+                  (counts + 1)/(nperms_used + 1.0))
+    
+    return (ps, Fs, nperms_used, perms)
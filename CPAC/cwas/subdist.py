@@ -2,7 +2,6 @@ import numpy as np
 
 # TODO:
 # - less transposes when computing the distances?
-# - better approach to fix autocorrelation issue
 
 def norm_cols(X):
     """
@@ -42,7 +41,95 @@ def ncor_subjects(subjects_normed_data, vox_inds):
 def fischers_transform(S):
     return np.arctanh(S)
 
+def fischers_transform_seeds(S, vox_inds):
+    """
+    In-place Fischer's transform of the seed correlation maps of many subjects
+    with the autocorrelation of each seed masked out
+    
+    Rather than deleting the seed voxel from every map (a copy), its
+    correlation is set to the mean of the remaining transformed correlations
+    in that map. After the maps are centered in `compute_distances_many` the
+    seed voxel is then zero and drops out of the distances.
+    
+    Parameters
+    ----------
+    S : ndarray
+        Correlation maps of shape (`nSubjects`, `nSeeds`, `nVoxels`)
+    vox_inds : list
+        Voxel index of each seed
+    
+    Returns
+    -------
+    S : ndarray
+    """
+    nVoxels = S.shape[2]
+    seeds   = np.arange(len(vox_inds))
+    vox_inds = np.asarray(vox_inds)
+    
+    S[:,seeds,vox_inds] = 0
+    np.arctanh(S, S)
+    S[:,seeds,vox_inds] = S.sum(2)/(nVoxels - 1)
+    
+    return S
+
 def compute_distances(S0):
     S0   = norm_cols(S0.T).T
     dmat = 1 - S0.dot(S0.T)
     return dmat
+
+def compute_distances_many(S, out=None, condensed=False):
+    """
+    Subject distance matrices for many seeds at once
+    
+    The subjects' maps of each seed are multiplied together with `np.dot`,
+    which hands the strided (`nSubjects`, `nVoxels`) view of the seed to
+    BLAS without a copy.
+    
+    Parameters
+    ----------
+    S : ndarray
+        Transformed correlation maps of shape (`nSubjects`, `nSeeds`, 
+        `nVoxels`). This will be centered and normalized in place.
+    out : ndarray (optional)
+        If specified then should have shape (`nSeeds`, `nSubjects`, 
+        `nSubjects`) or (`nSeeds`, `nSubjects*(nSubjects-1)/2`) if condensed
+    condensed : boolean (optional)
+        Only keep the upper triangle (row-major) of each distance matrix
+    
+    Returns
+    -------
+    out : ndarray
+    """
+    nSubjects, nSeeds, _ = S.shape
+    
+    S -= S.mean(2)[:,:,np.newaxis]
+    S /= np.sqrt( (S**2.).sum(2) )[:,:,np.newaxis]
+    
+    if condensed:
+        iu = np.triu_indices(nSubjects, 1)
+        if out is None:
+            out = np.zeros((nSeeds, len(iu[0])), dtype=np.float32)
+    elif out is None:
+        out = np.zeros((nSeeds, nSubjects, nSubjects))
+    
+    # One product per seed, as a stacked matmul over the seeds' (strided)
+    # maps doesn't go to BLAS in older numpy
+    dmat = np.empty((nSubjects, nSubjects), dtype=S.dtype)
+    for i in xrange(nSeeds):
+        np.dot(S[:,i,:], S[:,i,:].T, out=dmat)
+        np.subtract(1, dmat, out=dmat)
+        if condensed:
+            out[i] = dmat[iu]
+        else:
+            out[i] = dmat
+    
+    return out
+
+def calc_seed_blocksize(nSubjects, nVoxels, nSeeds, memory_limit=1.0):
+    """
+    Number of seeds for which subject correlation maps are held in memory at
+    once so that they fit within `memory_limit` (in GB)
+    """
+    nbytes      = np.dtype('float64').itemsize
+    block_size  = int( memory_limit * 1024.0**3 / (2 * nSubjects * nVoxels * nbytes) )
+    return max(1, min(block_size, nSeeds))
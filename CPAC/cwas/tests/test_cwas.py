@@ -297,4 +297,266 @@ def test_distances():
     fperms = np.array(robjects.r("as.matrix(attach.big.matrix('%s'))" % ffile))
     n     = np.sqrt(dmats.shape[0])
     
-    
\ No newline at end of file
+    
+
+def simulate_distances(nobs=12, nvoxs=7, seed=27):
+    """flattened distance matrices (nobs**2 x nvoxs) and a design matrix"""
+    import numpy as np
+    from CPAC.cwas.hats import add_intercept
+    
+    np.random.seed(seed)
+    x  = add_intercept(np.random.randn(nobs, 2))
+    ys = np.zeros((nobs**2, nvoxs))
+    for i in range(nvoxs):
+        ys[:,i] = (1 - np.corrcoef(np.random.randn(nobs, 20))).flatten()
+    
+    return ys, x
+
+def test_gower_center_many():
+    import numpy as np
+    from CPAC.cwas.mdmr import gower_center, gower_center_many
+    
+    ys, x = simulate_distances()
+    nobs  = x.shape[0]
+    
+    Gs = gower_center_many(ys)
+    for i in range(ys.shape[1]):
+        G = gower_center(ys[:,i].reshape(nobs,nobs))
+        np.testing.assert_array_almost_equal(Gs[:,i], G.flatten())
+
+def test_mdmr_permutation_blocks():
+    import numpy as np
+    from CPAC.cwas.mdmr import mdmr, gen_perms, add_original_index, \
+                               gen_h2_perms, gen_ih_perms, \
+                               gower_center_many, ftest_fast
+    
+    ys, x = simulate_distances()
+    nobs  = x.shape[0]
+    perms = gen_perms(50, nobs)
+    
+    # reference with all the permuted hat matrices in memory
+    all_perms = add_original_index(perms)
+    H2perms   = gen_h2_perms(x, [1], all_perms)
+    IHperms   = gen_ih_perms(x, [1], all_perms)
+    ref_Fperms = ftest_fast(H2perms, IHperms, gower_center_many(ys), 
+                            1, nobs - x.shape[1])
+    
+    ps, Fs, F_perms, _ = mdmr(ys, x, [1], perms.copy(), block_size=7)
+    
+    np.testing.assert_array_almost_equal(F_perms, ref_Fperms)
+    np.testing.assert_array_almost_equal(Fs, ref_Fperms[0])
+    ref_ps = (ref_Fperms >= ref_Fperms[0]).mean(0)
+    np.testing.assert_array_almost_equal(ps, ref_ps)
+
+def test_calc_subdists_blocks():
+    import numpy as np
+    from CPAC.cwas.utils import calc_subdists
+    from CPAC.cwas.subdist import norm_subjects, ncor_subjects, \
+                                  fischers_transform, compute_distances
+    
+    np.random.seed(27)
+    nsubs = 6; ntpts = 30; nvoxs = 80
+    subjects_data = [ np.random.randn(ntpts, nvoxs) for i in range(nsubs) ]
+    voxel_range   = (5, 40)
+    
+    # small memory limit to force several blocks of seeds
+    memory_limit  = 7 * (2 * nsubs * nvoxs * 8) / 1024.0**3
+    D = calc_subdists(subjects_data, voxel_range, memory_limit)
+    
+    normed_data = norm_subjects(subjects_data)
+    for i,vox in enumerate(range(*voxel_range)):
+        S   = ncor_subjects(normed_data, [vox])
+        S0  = fischers_transform(np.delete(S[:,0,:], vox, 1))
+        np.testing.assert_array_almost_equal(D[i], compute_distances(S0))
+
+def test_pack_subjects_cube():
+    import os, shutil, tempfile
+    import numpy as np
+    import nibabel as nb
+    from CPAC.cwas.cwas import joint_mask, pack_subjects_cube, \
+                               load_subjects_cube
+    
+    curdir = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        np.random.seed(27)
+        subjects_file_list = []
+        for i,ntpts in enumerate([10, 14, 12]):
+            data = np.random.randn(5, 6, 7, ntpts).astype('float32')
+            data[0,0,i] = 0     # each subject misses a different voxel
+            subject_file = 'subject%i.nii.gz' % i
+            nb.Nifti1Image(data, np.eye(4)).to_filename(subject_file)
+            subjects_file_list.append(subject_file)
+        mask = np.zeros((5, 6, 7))
+        mask[:3,:4] = 1
+        nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+        
+        ref_mask_file = joint_mask(subjects_file_list, 'mask.nii.gz')
+        ref_mask = nb.load(ref_mask_file).get_data().astype('bool')
+        
+        mask_file, cube_file = pack_subjects_cube(subjects_file_list, 
+                                                  'mask.nii.gz')
+        np.testing.assert_equal(nb.load(mask_file).get_data().astype('bool'), 
+                                ref_mask)
+        
+        subjects_data = load_subjects_cube(cube_file)
+        mask_indices  = np.where(ref_mask)
+        for subject_file,sdata in zip(subjects_file_list, subjects_data):
+            ref = nb.load(subject_file).get_data().astype('float64')[mask_indices].T
+            np.testing.assert_array_almost_equal(sdata, ref)
+    finally:
+        os.chdir(curdir)
+        shutil.rmtree(tmpdir)
+
+def test_mdmr_sequential():
+    import numpy as np
+    from CPAC.cwas.mdmr import mdmr, mdmr_sequential, gen_perms
+    
+    ys, x = simulate_distances(nobs=14, nvoxs=20)
+    nobs  = x.shape[0]
+    perms = gen_perms(499, nobs)
+    h     = 10
+    
+    ps, Fs, F_perms, _ = mdmr(ys, x, [1], perms.copy())
+    seq_ps, seq_Fs, nperms_used, _ = mdmr_sequential(ys, x, [1], perms.copy(), 
+                                                     max_exceedances=h, 
+                                                     block_size=37)
+    np.testing.assert_array_almost_equal(seq_Fs, Fs)
+    
+    exceed = np.cumsum(F_perms[1:] >= Fs, axis=0)
+    for i in range(ys.shape[1]):
+        if exceed[-1,i] >= h:
+            # stopped at the permutation with the h-th exceedance
+            nperms = np.argmax(exceed[:,i] >= h) + 1
+            assert nperms_used[i] == nperms
+            np.testing.assert_almost_equal(seq_ps[i], float(h)/nperms)
+        else:
+            assert nperms_used[i] == 499
+            np.testing.assert_almost_equal(seq_ps[i], ps[i])
+
+def test_mdmr_condensed():
+    import numpy as np
+    from CPAC.cwas.mdmr import mdmr, gen_perms
+    
+    ys, x = simulate_distances()
+    nobs  = x.shape[0]
+    iu    = np.triu_indices(nobs, 1)
+    ys_condensed = np.array([ y.reshape(nobs,nobs)[iu] for y in ys.T ], 
+                            dtype='float32').T
+    perms = gen_perms(50, nobs)
+    
+    ps, Fs, F_perms, _ = mdmr(ys, x, [1], perms.copy())
+    c_ps, c_Fs, c_F_perms, _ = mdmr(ys_condensed, x, [1], perms.copy(), 
+                                    condensed=True)
+    
+    np.testing.assert_array_almost_equal(c_F_perms, F_perms, decimal=5)
+    np.testing.assert_array_almost_equal(c_ps, ps)
+
+def test_mdmr_test_blocks():
+    import numpy as np
+    from CPAC.cwas.mdmr import mdmr, mdmr_sequential, gen_perms
+    
+    ys, x = simulate_distances(nvoxs=11)
+    nobs  = x.shape[0]
+    iu    = np.triu_indices(nobs, 1)
+    ys_condensed = np.array([ y.reshape(nobs,nobs)[iu] for y in ys.T ], 
+                            dtype='float32').T
+    perms = gen_perms(99, nobs)
+    
+    # Gower centering and testing a few voxels at a time
+    for y,condensed in [(ys, False), (ys_condensed, True)]:
+        ps, Fs, F_perms, _ = mdmr(y, x, [1], perms.copy(), 
+                                  condensed=condensed)
+        b_ps, b_Fs, b_F_perms, _ = mdmr(y, x, [1], perms.copy(), 
+                                        block_size=17, condensed=condensed, 
+                                        test_block_size=3)
+        np.testing.assert_array_almost_equal(b_F_perms, F_perms)
+        np.testing.assert_array_almost_equal(b_ps, ps)
+        
+        seq = mdmr_sequential(y, x, [1], perms.copy(), max_exceedances=5, 
+                              block_size=17, condensed=condensed)
+        b_seq = mdmr_sequential(y, x, [1], perms.copy(), max_exceedances=5, 
+                                block_size=17, condensed=condensed, 
+                                test_block_size=3)
+        for ref,comp in zip(seq[:3], b_seq[:3]):
+            np.testing.assert_array_almost_equal(comp, ref)
+    
+    # Each voxel is Gower centered once, whatever the blocks of permutations
+    import sys
+    mdmr_module = sys.modules['CPAC.cwas.mdmr']
+    gower_center_tests = mdmr_module.gower_center_tests
+    centered = []
+    def counting_gower_center_tests(ys, tests, condensed=False):
+        centered.extend(np.arange(ys.shape[1])[tests])
+        return gower_center_tests(ys, tests, condensed)
+    mdmr_module.gower_center_tests = counting_gower_center_tests
+    try:
+        for kwrds in [{}, {'test_block_size': 3}]:
+            del centered[:]
+            mdmr(ys, x, [1], perms.copy(), block_size=17, **kwrds)
+            np.testing.assert_equal(sorted(centered), range(ys.shape[1]))
+            del centered[:]
+            mdmr_sequential(ys, x, [1], perms.copy(), max_exceedances=5, 
+                            block_size=17, **kwrds)
+            np.testing.assert_equal(sorted(centered), range(ys.shape[1]))
+    finally:
+        mdmr_module.gower_center_tests = gower_center_tests
+
+def test_cwas_checkpoints():
+    import os, shutil, tempfile
+    import numpy as np
+    import nibabel as nb
+    from nose.tools import assert_raises
+    from CPAC.cwas.cwas import create_cwas_batches, save_cwas_checkpoint, \
+                               load_cwas_checkpoint, cwas_checkpoint_status, \
+                               merge_cwas_checkpoints, cwas_mask_fingerprint
+    
+    curdir = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        mask = np.zeros((4, 5, 6))
+        mask[1:3] = 1
+        nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+        checkpoint_dir = os.path.join(tmpdir, 'checkpoints')
+        
+        batches = create_cwas_batches('mask.nii.gz', 3, checkpoint_dir)
+        completed, pending = cwas_checkpoint_status(checkpoint_dir)
+        assert len(completed) == 0 and pending == batches
+        
+        # Only the first batch finishes
+        mask_fingerprint = cwas_mask_fingerprint('mask.nii.gz')
+        voxel_range = batches[0]
+        nvoxs = voxel_range[1] - voxel_range[0]
+        F_set = np.arange(nvoxs) + 1.0
+        save_cwas_checkpoint(checkpoint_dir, voxel_range, F_set, 
+                             np.ones(nvoxs)/2, 'abc', mask_fingerprint)
+        assert load_cwas_checkpoint(checkpoint_dir, voxel_range, 'abc')
+        assert load_cwas_checkpoint(checkpoint_dir, voxel_range, 'xyz') is None
+        
+        completed, pending = cwas_checkpoint_status(checkpoint_dir)
+        assert pending == batches[1:]
+        completed, pending = cwas_checkpoint_status(checkpoint_dir, 'xyz')
+        assert pending == batches
+        
+        F_file, p_file, pending = merge_cwas_checkpoints(checkpoint_dir, 
+                                                         'mask.nii.gz')
+        F_vol = nb.load(F_file).get_data()
+        F_vals = F_vol[mask.astype('bool')]
+        np.testing.assert_equal(F_vals[:nvoxs], F_set)
+        np.testing.assert_equal(F_vals[nvoxs:], 0)
+        
+        # A rerun with another mask into the same directory does not reuse
+        # the batches of the first mask
+        mask[1,0] = 0
+        nb.Nifti1Image(mask, np.eye(4)).to_filename('mask2.nii.gz')
+        assert cwas_mask_fingerprint('mask2.nii.gz') != mask_fingerprint
+        with assert_raises(ValueError):
+            merge_cwas_checkpoints(checkpoint_dir, 'mask2.nii.gz')
+        batches = create_cwas_batches('mask2.nii.gz', 3, checkpoint_dir)
+        completed, pending = cwas_checkpoint_status(checkpoint_dir)
+        assert len(completed) == 0 and pending == batches
+    finally:
+        os.chdir(curdir)
+        shutil.rmtree(tmpdir)
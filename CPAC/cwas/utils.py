@@ -2,7 +2,8 @@ import numpy as np
 from mdmr import *
 from subdist import *
 
-def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
+def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None, 
+              max_exceedances=None, dmats_file=None):
     """
     Performs Connectome-Wide Association Studies (CWAS) [1]_ for every voxel.  Implementation based on
     [2]_.
@@ -20,6 +21,12 @@ def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
         (start, end) tuple specify the range of voxels (inside the mask) to perform cwas on.    
     strata : None or list
         todo
+    max_exceedances : None or integer
+        If specified, permutations of a voxel stop once this many permuted 
+        pseudo-F values exceed its observed one (see `mdmr_sequential`)
+    dmats_file : None or string
+        If specified, the (condensed) distance matrices are kept in a memory
+        mapped .npy file at this path instead of in memory
         
     Returns
     -------
@@ -31,7 +38,7 @@ def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
     Notes
     -----
     The distance matrix can potentially take up a great deal of memory and therefore is not
-    returned.
+    returned. Only the upper triangle of each distance matrix is kept, as float32.
     
     References
     ----------
@@ -40,41 +47,135 @@ def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
     
     """
     
-    D            = calc_subdists(subjects_data, voxel_range)
-    F_set, p_set = calc_mdmrs(D, regressor, cols, iter, strata)
+    D            = calc_subdists(subjects_data, voxel_range, condensed=True, 
+                                 dmats_file=dmats_file)
+    F_set, p_set = calc_mdmrs(D, regressor, cols, iter, strata, 
+                              max_exceedances=max_exceedances)
     
     return F_set, p_set
 
-def calc_subdists(subjects_data, voxel_range):
+def calc_subdists(subjects_data, voxel_range, memory_limit=1.0, 
+                  condensed=False, dmats_file=None):
+    """
+    Distance matrices between subjects for every voxel
+    
+    Seed voxels are processed in blocks, so each subject's correlation maps
+    for a whole block come from one matrix product.
+    
+    Parameters
+    ----------
+    subjects_data : list of ndarray
+        Data arrays of shape (`T`,`V`) for each subject
+    voxel_range : tuple
+        (start, end) tuple specify the range of voxels (inside the mask) to 
+        use as seeds
+    memory_limit : float (optional)
+        Memory (in GB) for the correlation maps of a block of seeds
+    condensed : boolean (optional)
+        Only keep the upper triangle of each distance matrix, as float32
+    dmats_file : string (optional)
+        If specified, the distance matrices are written to this .npy file
+        and returned as a memory map
+    
+    Returns
+    -------
+    D : ndarray
+        Distance matrices of shape (`nVoxels`, `nSubjects`, `nSubjects`) or
+        (`nVoxels`, `nSubjects*(nSubjects-1)/2`) if condensed
+    """
     nSubjects   = len(subjects_data)
     vox_inds    = range(*voxel_range)
     nVoxels     = len(vox_inds)
     #Number of timepoints may be consistent between subjects
     
     subjects_normed_data = norm_subjects(subjects_data)
+    nMaskVoxels = subjects_normed_data[0].shape[1]
+    block_size  = calc_seed_blocksize(nSubjects, nMaskVoxels, nVoxels, 
+                                      memory_limit)
     
     # Distance matrices for every voxel
-    D = np.zeros((nVoxels, nSubjects, nSubjects))
-        
-    # For a particular voxel v, its spatial correlation map for every subject
-    S = np.zeros((nSubjects, 1, nVoxels))
+    if condensed:
+        shape = (nVoxels, nSubjects*(nSubjects-1)/2)
+        dtype = np.float32
+    else:
+        shape = (nVoxels, nSubjects, nSubjects)
+        dtype = np.float64
+    if dmats_file is None:
+        D = np.zeros(shape, dtype=dtype)
+    else:
+        D = np.lib.format.open_memmap(dmats_file, mode='w+', dtype=dtype, 
+                                      shape=shape)
     
-    for i in range(nVoxels):
-        S    = ncor_subjects(subjects_normed_data, [vox_inds[i]])
-        S0   = np.delete(S[:,0,:], vox_inds[i], 1)    # remove autocorrelations
-        S0   = fischers_transform(S0)
-        D[i] = compute_distances(S0)
+    for start in range(0, nVoxels, block_size):
+        end  = min(start + block_size, nVoxels)
+        # For the seed voxels, their spatial correlation map for every subject
+        S    = ncor_subjects(subjects_normed_data, vox_inds[start:end])
+        S    = fischers_transform_seeds(S, vox_inds[start:end])
+        compute_distances_many(S, out=D[start:end], condensed=condensed)
     
     return D
 
-def calc_mdmrs(D, regressor, cols, iter, strata=None):
-    nVoxels = D.shape[0]
-    nSubjects = D.shape[1]
+def calc_mdmrs(D, regressor, cols, iter, strata=None, memory_limit=1.0, 
+               max_exceedances=None):
+    """
+    MDMR for every voxel distance matrix in a batch
+    
+    The permutations and the permuted hat matrices are the same for every 
+    voxel, so they are generated once and all voxels are tested together.
     
-    F_set = np.zeros(nVoxels)
-    p_set = np.zeros(nVoxels)
+    Parameters
+    ----------
+    D : ndarray
+        Distance matrices of shape (`V`, `S`, `S`), `V` voxels, `S` subjects,
+        or condensed distance matrices of shape (`V`, `S*(S-1)/2`)
+    regressor : ndarray
+        Matrix of shape (`S`, `R`), `S` subjects and `R` regressors
+    cols : list
+        Columns of interest in the regressor
+    iter : integer
+        Number of permutations to derive significance tests
+    strata : None or list
+        todo
+    memory_limit : float (optional)
+        Memory (in GB) for the permuted hat matrices, which sets how many 
+        permutations are processed at once, and for the Gower centered 
+        matrices, which sets how many voxels are tested at once
+    max_exceedances : None or integer (optional)
+        If specified, permutations of a voxel stop once this many permuted 
+        pseudo-F values exceed its observed one (see `mdmr_sequential`)
+    
+    Returns
+    -------
+    F_set : ndarray
+        Pseudo-F statistic calculated for every voxel
+    p_set : ndarray
+        Significance probabilities of F_set based on permutation tests
+    """
+    nVoxels = D.shape[0]
+    condensed = (D.ndim == 2)
+    if condensed:
+        nSubjects = regressor.shape[0]
+        ys = D.T
+    else:
+        nSubjects = D.shape[1]
+        ys = D.reshape(nVoxels, nSubjects**2).T
+    block_size = calc_perm_blocksize(nSubjects, iter+1, memory_limit)
+    # The voxels are Gower centered in blocks, so the centered matrices of
+    # the whole batch (float64 in the centering) are never held at once
+    test_block_size = calc_test_blocksize(ys.shape[0] + nSubjects, nVoxels,
+                                          memory_limit)
     
-    for i in range(nVoxels):
-        p_set[i], F_set[i], _, _ = mdmr(D[i].reshape(nSubjects**2,1), regressor, cols, iter, strata)
+    if max_exceedances is None:
+        p_set, F_set, _, _ = mdmr(ys, regressor, cols, iter, strata, 
+                                  block_size=block_size, condensed=condensed,
+                                  test_block_size=test_block_size)
+    else:
+        p_set, F_set, nperms_used, _ = mdmr_sequential(ys, regressor, cols, 
+                                                       iter, max_exceedances, 
+                                                       strata, block_size, 
+                                                       condensed, 
+                                                       test_block_size)
+        print '... effective permutations per voxel: min %i, mean %.1f, max %i' \
+              % (nperms_used.min(), nperms_used.mean(), nperms_used.max())
     
     return F_set, p_set
@@ -1,8 +1,15 @@
 from resting_state_centrality import create_resting_state_graphs,\
+                                     create_multi_centrality_graphs,\
                                      load,\
                                      calc_centrality,\
+                                     calc_centrality_multi,\
+                                     calc_centrality_batch,\
+                                     calc_centrality_subject,\
+                                     calc_degree_by_thresholds,\
                                      get_centrality_by_rvalue,\
                                      get_centrality_by_sparsity,\
+                                     get_centrality_multi,\
+                                     get_degree_by_thresholds,\
                                      get_centrality_fast
 
 from z_score import get_cent_zscore
@@ -10,28 +17,59 @@ from z_score import get_cent_zscore
 from utils import convert_pvalue_to_r,\
                   map_centrality_matrix,\
                   calc_blocksize,\
+                  probe_blocksize,\
+                  get_memory_usage,\
+                  get_peak_memory,\
                   calc_corrcoef,\
                   cluster_data,\
-                  merge_lists
+                  calc_neighbor_graph,\
+                  merge_lists,\
+                  set_num_threads
 
 from core import degree_centrality, \
+                 degree_centrality_fused, \
+                 degree_centrality_upper, \
+                 degree_centrality_multi, \
+                 lfcd_centrality, \
                  fast_degree_centrality, \
                  eigenvector_centrality, \
+                 eigenvector_centrality_sparse, \
+                 sparse_threshold_rows, \
+                 sparse_graph, \
                  fast_eigenvector_centrality
 
 __all__ = ['create_resting_state_graphs',\
+           'create_multi_centrality_graphs',\
            'load',\
            'get_centrality_by_rvalue',\
            'get_centrality_by_sparsity',\
+           'get_centrality_multi',\
+           'get_degree_by_thresholds',\
            'get_centrality_fast',\
            'map_centrality_matrix',\
            'get_cent_zscore',\
            'calc_corrcoef',\
            'calc_centrality', \
+           'calc_centrality_multi', \
+           'calc_centrality_batch', \
+           'calc_centrality_subject', \
+           'calc_degree_by_thresholds', \
            'convert_pvalue_to_r',\
            'calc_blocksize',\
+           'probe_blocksize',\
+           'get_memory_usage',\
+           'get_peak_memory',\
            'degree_centrality',\
+           'degree_centrality_fused',\
+           'degree_centrality_upper',\
+           'degree_centrality_multi',\
+           'lfcd_centrality',\
+           'calc_neighbor_graph',\
+           'set_num_threads',\
            'fast_degree_centrality',\
            'eigenvector_centrality',\
+           'eigenvector_centrality_sparse',\
+           'sparse_threshold_rows',\
+           'sparse_graph',\
            'fast_eigenvector_centrality']
 
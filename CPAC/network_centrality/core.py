@@ -60,6 +60,230 @@ def degree_centrality(corr_matrix, r_value, method, out=None):
     return out
 
 
+def degree_centrality_fused(corr_matrix, r_value, out_binarize=None, 
+                            out_weighted=None, out_transform=None, 
+                            to_transform=False, nthreads=None):
+    """
+    Calculate the binarized and weighted (and optionally the transformed
+    weighted) degree centrality for the rows in the corr_matrix with one 
+    pass over the matrix. The rows are split across OpenMP threads and the
+    GIL is released.
+    
+    Paramaters
+    ---------
+    corr_matrix : numpy.ndarray
+        C-contiguous float32 or float64 matrix
+    r_value : float
+    out_binarize : numpy.ndarray (optional)
+        If specified then should have shape of `corr_matrix.shape[0]`
+    out_weighted : numpy.ndarray (optional)
+        If specified then should have shape of `corr_matrix.shape[0]`
+    out_transform : numpy.ndarray (optional)
+        If specified then should have shape of `corr_matrix.shape[0]`
+    to_transform : boolean (optional)
+        Also sum the transformed weights `(1+r)/2` of the connections
+    nthreads : integer (optional)
+        Number of threads, by default uses the OpenMP default 
+        (`OMP_NUM_THREADS`)
+    
+    Returns
+    -------
+    out_binarize : numpy.ndarray
+    out_weighted : numpy.ndarray
+    out_transform : numpy.ndarray
+        Only returned if `to_transform` is True or `out_transform` is given
+    """
+    
+    if corr_matrix.dtype.itemsize == 8:
+        dtype   = "double"
+        r_value = np.float64(r_value)
+    else:
+        dtype   = "float"
+        r_value = np.float32(r_value)
+    
+    nrows = corr_matrix.shape[0]
+    if out_binarize is None:
+        out_binarize = np.zeros(nrows, dtype=corr_matrix.dtype)
+    if out_weighted is None:
+        out_weighted = np.zeros(nrows, dtype=corr_matrix.dtype)
+    if out_transform is not None:
+        to_transform = True
+    elif to_transform:
+        out_transform = np.zeros(nrows, dtype=corr_matrix.dtype)
+    
+    func_name   = "centrality_fused_%s" % dtype
+    func        = globals()[func_name]
+    func(np.ascontiguousarray(corr_matrix), out_binarize, out_weighted, 
+         out_transform if to_transform else np.zeros(0, dtype=corr_matrix.dtype),
+         r_value, nthreads or 0)
+    
+    if to_transform:
+        return out_binarize, out_weighted, out_transform
+    else:
+        return out_binarize, out_weighted
+
+
+def degree_centrality_upper(corr_strip, r_value, out_binarize, out_weighted, 
+                            nthreads=None):
+    """
+    Accumulate the binarized and weighted degree centrality from one 
+    upper-triangle strip of a symmetric correlation matrix.
+    
+    The strip holds rows `n:m` against columns `n:nvoxs`. Its leading 
+    `(m-n) x (m-n)` tile is the diagonal block and adds to its rows only, 
+    while the remaining tile adds to both its rows and its columns. Looping
+    over all such strips gives the full degree while only computing (and 
+    thresholding) the upper triangle of the correlation matrix.
+    
+    Paramaters
+    ---------
+    corr_strip : numpy.ndarray
+        C-contiguous float32 or float64 matrix of shape `(m-n, nvoxs-n)`
+    r_value : float
+    out_binarize : numpy.ndarray
+        Outputs for voxels `n:nvoxs`, added to in place
+    out_weighted : numpy.ndarray
+        Outputs for voxels `n:nvoxs`, added to in place
+    nthreads : integer (optional)
+        Number of threads, by default uses the OpenMP default 
+        (`OMP_NUM_THREADS`)
+    
+    Returns
+    -------
+    out_binarize : numpy.ndarray
+    out_weighted : numpy.ndarray
+    """
+    
+    if corr_strip.dtype.itemsize == 8:
+        dtype   = "double"
+        r_value = np.float64(r_value)
+    else:
+        dtype   = "float"
+        r_value = np.float32(r_value)
+    
+    func_name   = "centrality_upper_%s" % dtype
+    func        = globals()[func_name]
+    func(np.ascontiguousarray(corr_strip), out_binarize, out_weighted, 
+         r_value, nthreads or 0)
+    
+    return out_binarize, out_weighted
+
+
+def degree_centrality_multi(corr_matrix, r_values, out_binarize=None, 
+                            out_weighted=None, nthreads=None):
+    """
+    Calculate the binarized and weighted degree centrality for the rows in 
+    the corr_matrix at several thresholds, with one pass over the matrix.
+    
+    Paramaters
+    ---------
+    corr_matrix : numpy.ndarray
+        C-contiguous float32 or float64 matrix
+    r_values : list of floats
+        thresholds, in the order of the output columns
+    out_binarize : numpy.ndarray (optional)
+        If specified then should have shape of 
+        `(corr_matrix.shape[0], len(r_values))`
+    out_weighted : numpy.ndarray (optional)
+        If specified then should have shape of 
+        `(corr_matrix.shape[0], len(r_values))`
+    nthreads : integer (optional)
+        Number of threads, by default uses the OpenMP default 
+        (`OMP_NUM_THREADS`)
+    
+    Returns
+    -------
+    out_binarize : numpy.ndarray
+    out_weighted : numpy.ndarray
+    """
+    
+    if corr_matrix.dtype.itemsize == 8:
+        dtype   = "double"
+    else:
+        dtype   = "float"
+    
+    # Compare with the thresholds at the precision of the data (as the 
+    # single threshold functions do)
+    r_values = np.asarray(r_values, dtype=corr_matrix.dtype).astype(np.float64)
+    order    = np.argsort(r_values, kind='mergesort')
+    shape    = (corr_matrix.shape[0], len(r_values))
+    if out_binarize is None:
+        out_binarize = np.zeros(shape, dtype=corr_matrix.dtype)
+    if out_weighted is None:
+        out_weighted = np.zeros(shape, dtype=corr_matrix.dtype)
+    
+    func_name   = "centrality_multi_%s" % dtype
+    func        = globals()[func_name]
+    # The thresholds need to be sorted
+    if (order == np.arange(len(order))).all():
+        func(np.ascontiguousarray(corr_matrix), r_values, out_binarize, 
+             out_weighted, nthreads or 0)
+    else:
+        tmp_binarize = np.zeros(shape, dtype=corr_matrix.dtype)
+        tmp_weighted = np.zeros(shape, dtype=corr_matrix.dtype)
+        func(np.ascontiguousarray(corr_matrix), r_values[order], 
+             tmp_binarize, tmp_weighted, nthreads or 0)
+        out_binarize[:,order] += tmp_binarize
+        out_weighted[:,order] += tmp_weighted
+    
+    return out_binarize, out_weighted
+
+
+def lfcd_centrality(corr_block, r_value, neighbors, offset, 
+                    out_binarize=None, out_weighted=None, nthreads=None):
+    """
+    Calculate the binarized and weighted local functional connectivity 
+    density (lFCD) for a block of seed voxels by flood filling from each 
+    seed through its suprathreshold neighbours.
+    
+    Paramaters
+    ---------
+    corr_block : numpy.ndarray
+        C-contiguous float32 or float64 matrix of shape `(nseeds, nvoxs)`,
+        the correlation of seeds `offset:offset+nseeds` with all voxels
+    r_value : float
+    neighbors : scipy.sparse.csr_matrix
+        Voxel adjacency of the mask (see `utils.calc_neighbor_graph`)
+    offset : integer
+        Index of the first seed in the block
+    out_binarize : numpy.ndarray (optional)
+        If specified then should have shape of `corr_block.shape[0]`
+    out_weighted : numpy.ndarray (optional)
+        If specified then should have shape of `corr_block.shape[0]`
+    nthreads : integer (optional)
+        Number of threads, by default uses the OpenMP default 
+        (`OMP_NUM_THREADS`)
+    
+    Returns
+    -------
+    out_binarize : numpy.ndarray
+    out_weighted : numpy.ndarray
+    """
+    
+    if corr_block.dtype.itemsize == 8:
+        dtype   = "double"
+        r_value = np.float64(r_value)
+    else:
+        dtype   = "float"
+        r_value = np.float32(r_value)
+    
+    nrows = corr_block.shape[0]
+    if out_binarize is None:
+        out_binarize = np.zeros(nrows, dtype=corr_block.dtype)
+    if out_weighted is None:
+        out_weighted = np.zeros(nrows, dtype=corr_block.dtype)
+    
+    indptr  = neighbors.indptr.astype(np.intc)
+    indices = neighbors.indices.astype(np.intc)
+    
+    func_name   = "lfcd_flood_%s" % dtype
+    func        = globals()[func_name]
+    func(np.ascontiguousarray(corr_block), indptr, indices, offset, 
+         out_binarize, out_weighted, r_value, nthreads or 0)
+    
+    return out_binarize, out_weighted
+
+
 def fast_degree_centrality(m):
     from numpy import linalg as LA
     
@@ -141,6 +365,399 @@ def eigenvector_centrality(corr_matrix,
         return np.abs(eigenVector)
 
 
+def sparse_threshold_rows(corr_block, r_value):
+    """
+    Gather the suprathreshold entries of a block of rows of a correlation 
+    matrix, in the (row counts, column indices, values) parts of a CSR 
+    matrix. The parts from consecutive blocks can be concatenated and 
+    passed to `sparse_graph`.
+    
+    Paramaters
+    ---------
+    corr_block : numpy.ndarray
+        block of rows of the correlation matrix
+    r_value : float
+        only entries greater than `r_value` are kept
+    
+    Returns
+    -------
+    row_nnz : numpy.ndarray
+        number of entries kept in each row
+    indices : numpy.ndarray
+        column index (int32) of each kept entry
+    data : numpy.ndarray
+        value of each kept entry
+    """
+    
+    mask    = corr_block > r_value
+    row_nnz = mask.sum(axis=1)
+    rows, cols = np.nonzero(mask)
+    del mask
+    
+    return row_nnz, cols.astype(np.int32), corr_block[rows,cols]
+
+
+def sparse_graph(row_nnz, indices, data, nvoxs):
+    """
+    Assemble the parts from `sparse_threshold_rows` (concatenated across
+    blocks) into a CSR matrix of shape `(nvoxs, nvoxs)`.
+    """
+    from scipy.sparse import csr_matrix
+    
+    indptr = np.zeros(nvoxs+1, dtype=np.int64)
+    np.cumsum(row_nnz, out=indptr[1:])
+    
+    return csr_matrix((data, indices, indptr), shape=(nvoxs, nvoxs))
+
+
+def eigenvector_centrality_sparse(graph, 
+                                  method=None, 
+                                  to_transform=False, 
+                                  ret_eigenvalue=False):
+    """
+    Eigenvector centrality of an already thresholded graph, held as a sparse
+    (CSR) matrix of the suprathreshold correlations. Unlike 
+    `eigenvector_centrality` the input is left untouched; the binarized
+    and transformed graphs share its sparsity pattern.
+    
+    Examples
+    --------
+    >>> # Simulate Data
+    >>> import numpy as np
+    >>> ntpts = 100; nvoxs = 1000
+    >>> m = np.random.random((ntpts,nvoxs))
+    >>> mm = m.T.dot(m) # note that need to generate connectivity matrix here
+    >>> # Threshold and Execute
+    >>> from CPAC.network_centrality.core import sparse_threshold_rows, \
+    ...     sparse_graph, eigenvector_centrality_sparse
+    >>> graph = sparse_graph(*sparse_threshold_rows(mm, 0.5), nvoxs=nvoxs)
+    >>> eigenvector = eigenvector_centrality_sparse(graph, method="weighted")
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse import linalg as LA
+    
+    if method not in ["binarize", "weighted"]:
+        raise Exception("Method must be one of binarize or weighted and not %s" % method)
+    
+    # Don't transform if binarize
+    if method == "binarize" and to_transform is True:
+        to_transform = False
+    
+    if method == "binarize":
+        data = np.ones_like(graph.data)
+    elif to_transform:
+        data = (1.0 + graph.data)/2.0
+    else:
+        data = graph.data
+    
+    # Share the indices of the input graph
+    graph = csr_matrix((data, graph.indices, graph.indptr), shape=graph.shape)
+    
+    #using scipy method, which is a wrapper to the ARPACK functions
+    #http://docs.scipy.org/doc/scipy/reference/tutorial/arpack.html
+    eigenValue, eigenVector = LA.eigsh(graph, k=1, which='LM', maxiter=1000)
+    
+    if ret_eigenvalue:
+        return eigenValue, np.abs(eigenVector)
+    else:
+        return np.abs(eigenVector)
+
+
+def eigenvector_centrality_blocked(ts_normd, r_value, method=None, 
+                                   block_size=1000, tiles=None, 
+                                   tiles_written=None, inclusive=False, to_transform=False, 
+                                   ret_eigenvalue=False):
+    """
+    Eigenvector centrality of the thresholded correlation matrix without
+    holding it (or its suprathreshold graph) in memory. ARPACK is given an 
+    operator whose matrix-vector products go over the matrix one block of
+    rows at a time, recomputing each block from the timeseries or, if 
+    `tiles` is given, reading it from disk.
+    
+    Paramaters
+    ---------
+    ts_normd : numpy.ndarray
+        timeseries of shape (ntpts x nvoxs) that is normalized; i.e. the data 
+        is demeaned and divided by its L2-norm
+    r_value : float
+    method : string
+        binarize or weighted
+    block_size : integer
+        the number of rows (voxels) in each block
+    tiles : numpy.memmap (optional)
+        scratch (nvoxs x nvoxs) array on disk. Blocks are written to it on 
+        the first product and read back after
+    tiles_written : numpy.ndarray (optional)
+        boolean flag per block for whether it is already in `tiles`, updated
+        in place; pass the same array to share `tiles` between calls
+    inclusive : boolean (optional)
+        Keep correlations greater than or equal to (rather than greater 
+        than) `r_value`
+    to_transform : boolean (optional)
+        Use the transformed weights `(1+r)/2`
+    ret_eigenvalue : boolean (optional)
+    
+    Returns
+    -------
+    eigenvector : numpy.ndarray
+    """
+    from scipy.sparse import linalg as LA
+    
+    if method not in ["binarize", "weighted"]:
+        raise Exception("Method must be one of binarize or weighted and not %s" % method)
+    
+    # Don't transform if binarize
+    if method == "binarize" and to_transform is True:
+        to_transform = False
+    
+    dtype   = ts_normd.dtype
+    r_value = dtype.type(r_value)
+    nvoxs   = ts_normd.shape[1]
+    blocks  = [ (n, min(n+block_size, nvoxs)) 
+                for n in xrange(0, nvoxs, block_size) ]
+    if tiles is not None and tiles_written is None:
+        tiles_written = np.zeros(len(blocks), dtype='bool')
+    
+    def matvec(x):
+        x = np.asarray(x, dtype=dtype).ravel()
+        y = np.zeros(nvoxs, dtype=dtype)
+        for b,(n,m) in enumerate(blocks):
+            if tiles is not None and tiles_written[b]:
+                rmat_block = np.asarray(tiles[n:m])
+            else:
+                rmat_block = np.dot(ts_normd[:,n:m].T, ts_normd)
+                if tiles is not None:
+                    tiles[n:m] = rmat_block
+                    tiles_written[b] = True
+            if inclusive:
+                mask = rmat_block >= r_value
+            else:
+                mask = rmat_block > r_value
+            if method == "binarize":
+                rmat_block = mask.astype(dtype)
+            elif to_transform:
+                rmat_block = ((1.0 + rmat_block)/2.0)*mask
+            else:
+                rmat_block = rmat_block*mask
+            y[n:m] = rmat_block.dot(x)
+            del rmat_block, mask
+        return y
+    
+    op = LA.LinearOperator((nvoxs, nvoxs), matvec=matvec, rmatvec=matvec, 
+                           dtype=dtype)
+    
+    #using scipy method, which is a wrapper to the ARPACK functions
+    #http://docs.scipy.org/doc/scipy/reference/tutorial/arpack.html
+    eigenValue, eigenVector = LA.eigsh(op, k=1, which='LM', maxiter=1000)
+    
+    if ret_eigenvalue:
+        return eigenValue, np.abs(eigenVector)
+    else:
+        return np.abs(eigenVector)
+
+
+def correlation_block(ts_normd, n, m, full_rows=False):
+    """
+    Rows `n:m` of the correlation matrix of the normalized timeseries and
+    their upper-triangle strip (against columns `n:nvoxs`). With
+    `full_rows`, the whole rows are computed and the strip is a view of
+    them, otherwise only the strip is computed (and returned as both).
+
+    Every pass over the blocks of one run must get its correlations from
+    here with the same `full_rows`, as the two products can round
+    differently and a correlation must fall in the same sparsity bin in
+    each pass.
+    """
+
+    if full_rows:
+        rmat_block = np.dot(ts_normd[:,n:m].T, ts_normd)
+        return rmat_block, rmat_block[:,n:]
+    rmat_strip = np.dot(ts_normd[:,n:m].T, ts_normd[:,n:])
+    return rmat_strip, rmat_strip
+
+
+def quantize_upper(corr_strip, nbins=2**20):
+    """
+    Bin index of each correlation in an upper-triangle strip of the 
+    correlation matrix (rows `n:m` against columns `n:nvoxs`), for fine bins
+    over [-1,1]. The diagonal and lower triangle of the leading (diagonal)
+    tile are set to -1 so they fall outside every bin.
+    """
+    
+    idx = ((corr_strip + 1.0)*(nbins/2.0)).astype('int32')
+    np.clip(idx, 0, nbins-1, out=idx)
+    k = idx.shape[0]
+    idx[:,:k][np.tril_indices(k)] = -1
+    
+    return idx
+
+
+def sparsity_cutoff(hist, sparse_num):
+    """
+    Given the histogram of the upper-triangle correlations (see 
+    `quantize_upper`), find the bin holding the cutoff for keeping the 
+    `sparse_num` strongest connections. Connections in higher bins are all
+    kept, while those in the cutoff bin are resolved by `sparsity_boundary`.
+    """
+    
+    n_above = np.cumsum(hist[::-1])[::-1]
+    cut_bin = np.where(n_above >= sparse_num)[0]
+    
+    return cut_bin[-1] if len(cut_bin) else 0
+
+
+def sparsity_boundary(bnd_w, bnd_i, bnd_j, nkeep):
+    """
+    Keep the `nkeep` largest connections (weights and coordinates) in the 
+    cutoff bin, breaking ties by their coordinates.
+    """
+    
+    order = np.lexsort((bnd_j, bnd_i, bnd_w))
+    order = order[len(order)-max(0, min(nkeep, len(order))):]
+    
+    return bnd_w[order], bnd_i[order], bnd_j[order]
+
+
+def sparsity_accumulator(nvoxs, threshold, track_r_value=False):
+    """
+    State of exact sparsity thresholding of `nvoxs` voxels at `threshold`
+    (the fraction of connections to keep), for `sparsity_cutoffs`, 
+    `sparsity_keep_block` and `sparsity_resolve`. With `track_r_value`, 
+    the weakest kept connection is also tracked (as 'r_value').
+    """
+    
+    acc = {'sparse_num' : int(np.round((nvoxs**2-nvoxs)*threshold/2.0)), 
+           'n_kept' : 0, 
+           'bnd' : ([], [], [])}
+    if track_r_value:
+        acc['r_value'] = np.inf
+    
+    return acc
+
+
+def sparsity_cutoffs(ts_normd, blocks, accums, full_rows=False, 
+                     nbins=2**20):
+    """
+    First pass of exact sparsity thresholding: the histogram of the 
+    upper-triangle correlations over all `blocks` (see `quantize_upper`), 
+    shared by all the sparsity `accums`, and the cutoff bin of each (set as
+    'cut_bin'). `full_rows` must match the main pass (see 
+    `correlation_block`). Whether the connections above the cutoff bin are
+    all positive is also set (as 'all_positive').
+    """
+    
+    # Import packages
+    from nipype import logging
+    
+    # Init logger
+    logger = logging.getLogger('workflow')
+    
+    hist = np.zeros(nbins, dtype='int64')
+    for block_no,(n,m) in enumerate(blocks):
+        logger.info('histogram block %d: rows %d thru %d' 
+                    % (block_no+1, n, m-1))
+        rmat_strip = correlation_block(ts_normd, n, m, full_rows)[1]
+        idx = quantize_upper(rmat_strip, nbins)
+        hist += np.bincount(idx.ravel()+1, minlength=nbins+1)[1:]
+        del idx, rmat_strip
+    for acc in accums:
+        acc['cut_bin'] = sparsity_cutoff(hist, acc['sparse_num'])
+        acc['all_positive'] = acc['cut_bin'] >= nbins//2
+        logger.info('cutoff bin is %d of %d, with %d connections' 
+                    % (acc['cut_bin'], nbins, hist[acc['cut_bin']]))
+    
+    return accums
+
+
+def sparsity_keep_block(acc, idx, corr_strip, n, out_binarize=None, 
+                        out_weighted=None):
+    """
+    Second pass of exact sparsity thresholding, for the upper-triangle 
+    strip of rows `n:m` and its bin indices `idx` (see `quantize_upper`): 
+    keep the connections above the cutoff bin, and gather those in the 
+    cutoff bin for `sparsity_resolve`. The kept connections are added to 
+    the degree outputs for voxels `n:nvoxs`, if given. Binarized degree 
+    only counts the positive ones, while weighted degree sums them all.
+    
+    Returns
+    -------
+    keep : numpy.ndarray
+        Boolean mask of the kept connections in the strip
+    """
+    
+    keep = idx > acc['cut_bin']
+    acc['n_kept'] += keep.sum()
+    if 'r_value' in acc and keep.any():
+        acc['r_value'] = min(acc['r_value'], corr_strip[keep].min())
+    bi,bj = np.where(idx == acc['cut_bin'])
+    acc['bnd'][0].append(corr_strip[bi,bj])
+    acc['bnd'][1].append(bi + n)
+    acc['bnd'][2].append(bj + n)
+    del bi, bj
+    
+    k = corr_strip.shape[0]
+    if out_binarize is not None:
+        if acc['all_positive']:
+            keep_pos = keep
+        else:
+            keep_pos = keep & (corr_strip > 0)
+        out_binarize[:k] += keep_pos.sum(axis=1)
+        out_binarize[:] += keep_pos.sum(axis=0)
+        del keep_pos
+    if out_weighted is not None:
+        kept_block = corr_strip*keep
+        out_weighted[:k] += kept_block.sum(axis=1)
+        out_weighted[:] += kept_block.sum(axis=0)
+        del kept_block
+    
+    return keep
+
+
+def sparsity_resolve(acc, out_binarize=None, out_weighted=None):
+    """
+    End of exact sparsity thresholding: keep the largest connections of the
+    cutoff bin, up to the number to keep (see `sparsity_boundary`), and add
+    them to the degree outputs, if given (as in `sparsity_keep_block`).
+    
+    Returns
+    -------
+    bnd_w, bnd_i, bnd_j : numpy.ndarray
+        Weights and coordinates of the connections kept from the cutoff bin
+    """
+    
+    bnd_w, bnd_i, bnd_j = \
+        sparsity_boundary(*[ np.concatenate(part) for part in acc['bnd'] ], 
+                          nkeep=acc['sparse_num']-acc['n_kept'])
+    if 'r_value' in acc and len(bnd_w):
+        acc['r_value'] = min(acc['r_value'], bnd_w.min())
+    
+    if out_binarize is not None:
+        pos = bnd_w > 0
+        np.add.at(out_binarize, bnd_i[pos], 1)
+        np.add.at(out_binarize, bnd_j[pos], 1)
+    if out_weighted is not None:
+        np.add.at(out_weighted, bnd_i, bnd_w)
+        np.add.at(out_weighted, bnd_j, bnd_w)
+    
+    return bnd_w, bnd_i, bnd_j
+
+
+def symmetric_sparse_graph(w, i, j, diag, r_value):
+    """
+    Create the symmetric sparse (CSR) graph from the connections kept in the
+    upper triangle, adding the self-correlations (`diag`) above `r_value`.
+    """
+    from scipy.sparse import coo_matrix, diags
+    
+    nvoxs = len(diag)
+    Rsp = coo_matrix((w, (i, j)), shape=(nvoxs,nvoxs))
+    Rsp = Rsp + Rsp.T + diags(diag*(diag > r_value), 0)
+    graph = Rsp.tocsr()
+    graph.eliminate_zeros()
+    
+    return graph
+
+
 def fast_eigenvector_centrality(m, maxiter=99, verbose=True):
     """
     The output here is based on a transfered correlation matrix of m.
@@ -172,6 +172,111 @@ def create_resting_state_graphs(wf_name='resting_state_graph',
     return wf
 
 
+# Function to create the multi-measure network centrality workflow
+def create_multi_centrality_graphs(wf_name='multi_centrality_graph', 
+                                   allocated_memory=None):
+    '''
+    Workflow to calculate any combination of degree and eigenvector 
+    centrality and lfcd, each with its own threshold, with one load of the
+    data and one sweep over the correlation matrix (see 
+    `calc_centrality_multi`), instead of one `create_resting_state_graphs`
+    workflow per measure.
+    
+    Parameters
+    ----------
+    wf_name : string
+        name of the workflow
+    allocated_memory : float
+        memory (GB) allocated to the centrality calculation
+        
+    Returns 
+    -------
+    wf : workflow object
+        multi-measure centrality workflow object
+    
+    Notes
+    -----
+    
+    Workflow Inputs::
+    
+        inputspec.in_file : string (nifti file)
+            path to resting state input data for which centrality measures
+            are to be calculated
+            
+        inputspec.template : string (existing nifti file)
+            path to mask/parcellation unit 
+        
+        inputspec.measures : list of tuples
+            (method_option, threshold_option, threshold) of each measure
+        
+    Workflow Outputs::
+    
+        outputspec.centrality_outputs : string (list of nifti files)
+            path to list of centrality outputs, in the order of the measures
+    
+    Examples
+    --------
+    
+    >>> import resting_state_centrality as graph
+    >>> wflow = graph.create_multi_centrality_graphs()
+    >>> wflow.inputs.inputspec.in_file = '/home/work/data/rest_mc_MNI_TR_3mm.nii.gz'
+    >>> wflow.inputs.inputspec.template = '/home/work/data/mask_3mm.nii.gz'
+    >>> wflow.inputs.inputspec.measures = [('degree', 'sparsity', 0.001),
+    ...                                    ('lfcd', 'correlation', 0.6)]
+    >>> wflow.base_dir = 'graph_working_directory'
+    >>> wflow.run()
+    
+    '''
+
+    # Import packages
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+
+    # Init variables
+    # Instantiate workflow with input name
+    wf = pe.Workflow(name = wf_name)
+    
+    # Instantiate inputspec node
+    inputspec = pe.Node(util.IdentityInterface(fields=['in_file',
+                                                       'template',
+                                                       'measures']),
+                        name='inputspec')
+    
+    # Instantiate calculate_centrality main function node
+    calculate_centrality = pe.Node(util.Function(input_names=['in_file',
+                                                              'template',
+                                                              'measures',
+                                                              'allocated_memory'],
+                                                 output_names=['out_list'],
+                                                 function=calc_centrality_multi),
+                                   name='calculate_centrality')
+
+    # Specify memory to interface for resource profiling
+    calculate_centrality.interface.estimated_memory_gb = allocated_memory
+
+    # Connect inputspec node to main function node
+    wf.connect(inputspec, 'in_file', 
+               calculate_centrality, 'in_file')
+    wf.connect(inputspec, 'template', 
+               calculate_centrality, 'template')
+    wf.connect(inputspec, 'measures',
+               calculate_centrality, 'measures')
+
+    # Specify allocated memory for calculating block size in function
+    calculate_centrality.inputs.allocated_memory = allocated_memory
+    
+    # Instantiate outputspec node
+    outputspec = pe.Node(util.IdentityInterface(fields=['centrality_outputs']),
+                         name = 'outputspec')
+    
+    # Connect function node output list to outputspec node
+    wf.connect(calculate_centrality, 'out_list',
+               outputspec, 'centrality_outputs')
+    
+    # Return the connected workflow
+    return wf
+
+
 # Function to load in nifti files and extract info for centrality calculation
 def load(datafile, template=None):
     '''
@@ -187,8 +292,8 @@ def load(datafile, template=None):
     ----------
     datafile : string (nifti file)
         path to subject data file
-    template : string (nifti file) or None (default: None)
-        path to mask/parcellation unit
+    template : string (nifti file), ndarray or None (default: None)
+        path to mask/parcellation unit, or its already loaded data
         if none, then will be mask with all 1s
         
     Returns
@@ -212,6 +317,7 @@ def load(datafile, template=None):
     import os
     import nibabel as nib
     import numpy as np
+    from CPAC.utils.utils import parcel_mean_timeseries
 
     try:
         if isinstance(datafile, list):
@@ -226,6 +332,8 @@ def load(datafile, template=None):
         datmask = data.var(axis=3).astype('bool')
         if template is None:
             mask = np.ones((data.shape[:3]))
+        elif isinstance(template, np.ndarray):
+            mask = template.astype(np.float32)
         else:
             mask = nib.load(template).get_data().astype(np.float32)
         
@@ -246,17 +354,12 @@ def load(datafile, template=None):
         nodes.sort()
         print "sorted nodes", nodes
 
-        flag=1
-        for n in nodes:
-            if n > 0:
-                node_array = data[(mask == n) & datmask]
-                avg = np.mean(node_array, axis =0)
-                if flag:
-                    timeseries = avg
-                    flag=0
-                else:
-                    timeseries = np.vstack((timeseries, avg))
-            final_mask  = datmask
+        # mean timeseries of all the nodes in one pass over the data
+        nodes = [ n for n in nodes if n > 0 ]
+        _, timeseries = parcel_mean_timeseries(data, mask, nodes=nodes,
+                                               vox_mask=datmask)
+        timeseries = timeseries.astype(data.dtype)
+        final_mask  = datmask
         #template_type is 1 for parcellation
         template_type = 1
     else:
@@ -270,7 +373,8 @@ def load(datafile, template=None):
 
 
 # Function to calculate centrality using a correlation threshold 
-def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_size):
+def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_size,
+                             graph_memory=None, scratch_dir=None):
     '''
     Method to calculate degree/eigenvector centrality and lFCD
     via correlation (r-value) threshold
@@ -287,11 +391,17 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
         0 - degree centrality calculation, 
         1 - eigenvector centrality calculation, 
         2 - lFCD calculation
-    threshold : a float
+    r_value : a float
         threshold (as correlation r) value
     block_size : an integer
         the number of rows (voxels) to compute timeseries correlation over
         at any one time
+    graph_memory : float (optional)
+        memory (GB) allowed for the sparse graph of eigenvector centrality,
+        beyond which it goes out-of-core; by default it never does
+    scratch_dir : string (optional)
+        directory for the correlation blocks of out-of-core eigenvector
+        centrality; see `get_centrality_multi`
 
     Returns
     -------
@@ -301,143 +411,379 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
         ndarray - the array of values to be mapped for that metric
     '''
     
+    # Calculate as a single measure
+    return get_centrality_multi(ts_normd, template,
+                                [(method_option, 'correlation', r_value)],
+                                block_size, graph_memory=graph_memory, 
+                                scratch_dir=scratch_dir)
+
+
+# Function to calculate centrality with a sparsity threhold
+def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size,
+                               graph_memory=None, scratch_dir=None):
+    '''
+    Method to calculate degree/eigenvector centrality via sparsity threshold
+
+    The upper triangle of the correlation matrix is streamed twice. The first
+    pass builds a fine histogram of the correlations to find the bin holding
+    the cutoff, and the second computes degree from the connections above
+    that bin and keeps the largest connections within it, so the result is
+    exact while memory is bounded by the block size. Binarized degree only
+    counts the kept connections with a positive correlation, while weighted
+    degree sums all of them.
+
+    Parameters
+    ----------
+    ts_normd : ndarray
+        timeseries of shape (ntpts x nvoxs) that is normalized; i.e. the data 
+        is demeaned and divided by its L2-norm
+    method_option : integer
+        0 - degree centrality calculation, 
+        1 - eigenvector centrality calculation, 
+        2 - lFCD calculation
+    threshold : a float
+        sparsity_threshold value
+    block_size : an integer
+        the number of rows (voxels) to compute timeseries correlation over
+        at any one time
+    graph_memory : float (optional)
+        memory (GB) allowed for the sparse graph of eigenvector centrality,
+        beyond which it goes out-of-core; by default it never does
+    scratch_dir : string (optional)
+        directory for the correlation blocks of out-of-core eigenvector
+        centrality; see `get_centrality_multi`
+
+    Returns
+    -------
+    out_list : list (string, ndarray)
+        list of (string,ndarray) elements corresponding to:
+        string - the name of the metric
+        ndarray - the array of values to be mapped for that metric
+    '''
+
+    # Calculate as a single measure
+    return get_centrality_multi(ts_normd, None,
+                                [(method_option, 'sparsity', threshold)],
+                                block_size, graph_memory=graph_memory, 
+                                scratch_dir=scratch_dir)
+
+
+# Function to calculate several centrality measures from one correlation sweep
+def get_centrality_multi(ts_normd, template, measures, block_size,
+                         graph_memory=None, scratch_dir=None, neighbors=None):
+    '''
+    Method to calculate any combination of degree/eigenvector centrality 
+    and lFCD, each with its own threshold, from one sweep over the blocks 
+    of the correlation matrix. Every block is fed to the accumulator of each
+    requested measure.
+
+    Measures thresholded by sparsity first need a histogram of the
+    correlations (see `get_centrality_by_sparsity`). All of them share one
+    extra pass over the blocks for it, whatever their thresholds.
+
+    Eigenvector centrality runs on the sparse graph of the kept connections.
+    If that graph would not fit in `graph_memory` (low thresholds, dense 
+    graphs), it falls back to an out-of-core operator that goes over the 
+    correlation matrix block by block for each ARPACK iteration (see 
+    `core.eigenvector_centrality_blocked`).
+
+    Parameters
+    ----------
+    ts_normd : ndarray (float)
+        timeseries of shape (ntpts x nvoxs) that is normalized; i.e. the data 
+        is demeaned and divided by its L2-norm
+    template : ndarray
+        three dimensional array with non-zero elements corresponding to the
+        indices at which the lFCD metric is analyzed (only used by lFCD)
+    measures : list of tuples (string, string, float)
+        (method_option, threshold_option, threshold) of each measure, where
+        method_option is 'degree', 'eigenvector' or 'lfcd', and 
+        threshold_option is 'correlation' (threshold is an r value) or 
+        'sparsity' (threshold is the fraction of connections to keep).
+        Each method may only be given once
+    block_size : an integer
+        the number of rows (voxels) to compute timeseries correlation over
+        at any one time
+    graph_memory : float (optional)
+        memory (GB) allowed for the sparse graph of eigenvector centrality;
+        by default the graph is never out-of-core
+    scratch_dir : string (optional)
+        directory for the correlation blocks of the out-of-core operator,
+        written to a memory-mapped file on the first iteration and read
+        back after; by default the blocks are recomputed on each iteration.
+        Each run uses (and removes) a uniquely named file, so the directory
+        can be shared by concurrent runs
+    neighbors : scipy.sparse.csr_matrix (optional)
+        voxel adjacency of the template for lFCD (see 
+        `utils.calc_neighbor_graph`), if already computed
+
+    Returns
+    -------
+    out_list : list (string, ndarray)
+        list of (string,ndarray) elements corresponding to:
+        string - the name of the metric
+        ndarray - the array of values to be mapped for that metric
+    '''
+
     # Import packages
-    import copy
+    import os
+    import tempfile
     import numpy as np
-    import copy
     from nipype import logging
 
-    from CPAC.network_centrality.utils import cluster_data
+    from CPAC.network_centrality.utils import calc_neighbor_graph
     import CPAC.network_centrality.core as core
 
     # Init variables
     logger = logging.getLogger('workflow')
     out_list = []
     nvoxs = ts_normd.shape[1]
+    dtype = ts_normd.dtype
+    out_names = {'degree' : ('degree_centrality_binarize',
+                             'degree_centrality_weighted'),
+                 'eigenvector' : ('eigenvector_centrality_binarize',
+                                  'eigenvector_centrality_weighted'),
+                 'lfcd' : ('lfcd_binarize', 'lfcd_weighted')}
 
-    # Init degree centrality outputs
-    if method_option == 'degree':
-        # Init output map
-        degree_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('degree_centrality_binarize', degree_binarize))
-        # Init output map
-        degree_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('degree_centrality_weighted', degree_weighted))
-    # Init eigenvector centrality outputs
-    if method_option == 'eigenvector':
-        r_matrix = np.zeros((nvoxs,nvoxs), dtype=ts_normd.dtype)
-        # Init output map
-        eigen_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('eigenvector_centrality_binarize', eigen_binarize))
-        # Init output map
-        eigen_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('eigenvector_centrality_weighted', eigen_weighted))
-    # Init lFCD outputs
-    if method_option == 'lfcd':
-        # Init output map
-        lfcd_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('lfcd_binarize', lfcd_binarize))
-        # Init output map
-        lfcd_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('lfcd_weighted', lfcd_weighted))
-
-    # Prepare to loop through and calculate correlation matrix
-    n = 0
-    m = block_size
-    block_no = 1
-    # Run as long as our last row index is <= nvoxs
-    while m <= nvoxs:
-        # First, compute block of correlation matrix
-        logger.info('running block %d: rows %d thru %d' % (block_no, n, m))
-        rmat_block = np.dot(ts_normd[:,n:m].T, ts_normd)
-
-        # Degree centrality calculation
-        if method_option == 'degree':
-            core.degree_centrality(rmat_block, r_value, method='binarize', 
-                              out=degree_binarize[n:m])
-            core.degree_centrality(rmat_block, r_value, method='weighted', 
-                              out=degree_weighted[n:m])
-
-        # Eigenvector centrality - append global corr. matrix
-        if method_option == 'eigenvector':
-            r_matrix[n:m] = rmat_block
-
-        # lFCD - perform lFCD algorithm
-        if method_option == 'lfcd':
-            xyz_a = np.argwhere(template)
-            krange = rmat_block.shape[0]
-            logger.info('...iterating through seeds in block - lfcd')
-            for k in range (0,krange):
-                corr_seed = rmat_block[k,:]
-                labels = cluster_data(corr_seed,r_value,xyz_a)
-                seed_label = labels[n+k]
-                # Binarized lFCD
-                if seed_label > 0:
-                    lfcd_bin = np.sum(labels==seed_label)
-                    lfcd_wght = np.sum(corr_seed*(labels==seed_label))
+    # Correlations in the upper triangle are quantized into fine bins
+    # over [-1,1] for sparsity thresholding
+    nbins = 2**20
+
+    # Init outputs and accumulators of each measure
+    accums = []
+    for method_option, threshold_option, threshold in measures:
+        if method_option not in out_names:
+            raise Exception('Method option: %s not supported' % method_option)
+        if threshold_option not in ['correlation', 'sparsity']:
+            raise Exception('Threshold option: %s not supported for network '\
+                            'centrality measure: %s' 
+                            % (threshold_option, method_option))
+        if method_option == 'lfcd' and threshold_option == 'sparsity':
+            raise Exception('lFCD must use significance or correlation-type '\
+                            'thresholding.')
+        if method_option in [ a['method'] for a in accums ]:
+            raise Exception('Method option: %s given more than once' 
+                            % method_option)
+        acc = {'method' : method_option, 
+               'thresh_type' : threshold_option, 
+               'threshold' : threshold}
+        # Init output maps
+        acc['binarize'] = np.zeros(nvoxs, dtype=dtype)
+        out_list.append((out_names[method_option][0], acc['binarize']))
+        acc['weighted'] = np.zeros(nvoxs, dtype=dtype)
+        out_list.append((out_names[method_option][1], acc['weighted']))
+        # Kept connections, as CSR parts or upper triangle coordinates
+        acc['parts'] = ([], [], [])
+        acc['graph_bytes'] = 0
+        acc['out_of_core'] = False
+        # Get the number of connections to keep
+        if threshold_option == 'sparsity':
+            acc.update(core.sparsity_accumulator(nvoxs, threshold, 
+                                                 track_r_value=True))
+        accums.append(acc)
+
+    sparse_accums = [ a for a in accums if a['thresh_type'] == 'sparsity' ]
+    # lFCD and eigenvector (correlation) need whole rows of the matrix, 
+    # otherwise only the upper-triangle strip (rows n:m against columns 
+    # n:nvoxs) is needed
+    full_rows = any([ a['method'] == 'lfcd' or 
+                      (a['method'] == 'eigenvector' and 
+                       a['thresh_type'] == 'correlation') for a in accums ])
+    # Neighbours (26-connected) of each voxel in the mask, computed once
+    if 'lfcd' in [ a['method'] for a in accums ] and neighbors is None:
+        neighbors = calc_neighbor_graph(np.argwhere(template), k=26)
+
+    blocks = [ (n, min(n+block_size, nvoxs)) 
+               for n in xrange(0, nvoxs, block_size) ]
+
+    # Sparsity pass - histogram of all upper triangle correlations, shared
+    # by all sparsity thresholds
+    if sparse_accums:
+        core.sparsity_cutoffs(ts_normd, blocks, sparse_accums, full_rows, 
+                              nbins)
+        for acc in sparse_accums:
+            # The symmetric graph holds each kept connection twice, and is 
+            # built from coordinates (int32) and weights (about 3 copies)
+            if acc['method'] == 'eigenvector' and graph_memory is not None:
+                acc['graph_bytes'] = 3*2*acc['sparse_num']*(8 + dtype.itemsize)
+                if acc['graph_bytes'] > graph_memory*1024.0**3:
+                    logger.info('sparse graph would need %.2fGB, so using '\
+                                'out-of-core eigenvector centrality' 
+                                % (acc['graph_bytes']/1024.0**3))
+                    acc['out_of_core'] = True
+
+    # Main pass - compute each block once and feed it to every measure
+    for block_no,(n,m) in enumerate(blocks):
+        logger.info('running block %d: rows %d thru %d' 
+                    % (block_no+1, n, m-1))
+        rmat_block, rmat_strip = core.correlation_block(ts_normd, n, m, 
+                                                        full_rows)
+        if sparse_accums:
+            idx = core.quantize_upper(rmat_strip, nbins)
+
+        for acc in accums:
+            method_option = acc['method']
+            # Correlation (r-value) thresholds
+            if acc['thresh_type'] == 'correlation':
+                r_value = acc['threshold']
+                if method_option == 'degree' and full_rows:
+                    core.degree_centrality_fused(rmat_block, r_value, 
+                                    out_binarize=acc['binarize'][n:m], 
+                                    out_weighted=acc['weighted'][n:m])
+                elif method_option == 'degree':
+                    core.degree_centrality_upper(rmat_strip, r_value, 
+                                                 acc['binarize'][n:], 
+                                                 acc['weighted'][n:])
+                elif method_option == 'eigenvector' and \
+                     not acc['out_of_core']:
+                    parts = core.sparse_threshold_rows(rmat_block, r_value)
+                    for part,acc_part in zip(parts, acc['parts']):
+                        acc_part.append(part)
+                        acc['graph_bytes'] += part.nbytes
+                    del parts
+                    # Concatenating the parts copies them
+                    if graph_memory is not None and \
+                       2*acc['graph_bytes'] > graph_memory*1024.0**3:
+                        logger.info('sparse graph exceeds %.2fGB, so using '\
+                                    'out-of-core eigenvector centrality' 
+                                    % graph_memory)
+                        acc['out_of_core'] = True
+                        acc['parts'] = ([], [], [])
+                elif method_option == 'lfcd':
+                    core.lfcd_centrality(rmat_block, r_value, neighbors, n, 
+                                         out_binarize=acc['binarize'][n:m], 
+                                         out_weighted=acc['weighted'][n:m])
+            # Sparsity thresholds - keep the connections above the cutoff
+            # bin, while gathering those in the cutoff bin
+            else:
+                if method_option == 'degree':
+                    keep = core.sparsity_keep_block(
+                        acc, idx, rmat_strip, n, 
+                        out_binarize=acc['binarize'][n:], 
+                        out_weighted=acc['weighted'][n:])
                 else:
-                    lfcd_bin = lfcd_wght = 1
-                lfcd_binarize[n+k] = lfcd_bin
-                lfcd_weighted[n+k] = lfcd_wght
-
-        # Delete block of corr matrix and increment indices
-        del rmat_block
-
-        # Move next block start point up to last block finish point
-        n = m
-        # If we finished at nvoxs last time, break the loop
-        if n == nvoxs:
-            break
-        # Else, if our next block runs over nvoxs, limit it to nvoxs
-        elif (m+block_size) > nvoxs:
-            m = nvoxs
-        # Else, just increment end of next block by block_size
+                    keep = core.sparsity_keep_block(acc, idx, rmat_strip, n)
+                if method_option == 'eigenvector' and \
+                     not acc['out_of_core']:
+                    ki,kj = np.where(keep)
+                    acc['parts'][0].append(rmat_strip[ki,kj])
+                    acc['parts'][1].append((ki + n).astype('int32'))
+                    acc['parts'][2].append((kj + n).astype('int32'))
+                    del ki, kj
+                del keep
+
+        # Delete block of corr matrix
+        del rmat_block, rmat_strip
+        if sparse_accums:
+            del idx
+
+    # Finish each measure
+    for acc in accums:
+        method_option = acc['method']
+        if acc['thresh_type'] == 'correlation':
+            r_value = acc['threshold']
+            # Correct for self-correlation in degree centrality
+            if method_option == 'degree':
+                for out in [acc['binarize'], acc['weighted']]:
+                    idx = np.where(out)
+                    out[idx] = out[idx]-1
+            # Eigenvector - the sparse (CSR) graph of the blocks
+            if method_option == 'eigenvector' and not acc['out_of_core']:
+                logger.info('...creating sparse graph')
+                graph = core.sparse_graph(*[ np.concatenate(part) 
+                                             for part in acc['parts'] ], 
+                                          nvoxs=nvoxs)
         else:
-            m += block_size
-        # Increment block number
-        block_no += 1
+            # Break ties in the cutoff bin exactly - keep its largest 
+            # connections, and add them to degree
+            if method_option == 'degree':
+                bnd_w, bnd_i, bnd_j = \
+                    core.sparsity_resolve(acc, out_binarize=acc['binarize'], 
+                                          out_weighted=acc['weighted'])
+            else:
+                bnd_w, bnd_i, bnd_j = core.sparsity_resolve(acc)
+            r_value = acc['r_value']
+            logger.info('%d connections kept with r >= %f' 
+                        % (acc['n_kept'] + len(bnd_w), r_value))
+            # Eigenvector - the sparse (CSR) graph of the kept connections,
+            # made symmetric and with the self-correlations
+            if method_option == 'eigenvector' and not acc['out_of_core']:
+                logger.info('...creating sparse graph')
+                acc['parts'][0].append(bnd_w)
+                acc['parts'][1].append(bnd_i.astype('int32'))
+                acc['parts'][2].append(bnd_j.astype('int32'))
+                graph = core.symmetric_sparse_graph(
+                            *[ np.concatenate(part) for part in acc['parts'] ],
+                            diag=(ts_normd**2).sum(axis=0), r_value=r_value)
+            del bnd_w, bnd_i, bnd_j
 
-    # Correct for self-correlation in degree centrality
-    if method_option == 'degree':
-        idx = np.where(degree_binarize)
-        degree_binarize[idx] = degree_binarize[idx]-1
-        idx = np.where(degree_weighted)
-        degree_weighted[idx] = degree_weighted[idx]-1
-
-    # Perform eigenvector measures
-    if method_option == 'eigenvector':
-        logger.info('...calculating binarize eigenvector')
-        # Have to deepcopy the r_matrix because thresh and sum overwrites
-        # its values via pass-by-reference
-        eigen_binarize[:] = \
-            core.eigenvector_centrality(copy.deepcopy(r_matrix), r_value,
-                                        method='binarize').squeeze()
-        logger.info('...calculating weighted eigenvector')
-        eigen_weighted[:] = \
-            core.eigenvector_centrality(r_matrix, r_value,
-                                        method='weighted').squeeze()
-        del r_matrix
+        # Perform out-of-core eigenvector measures, with the threshold of
+        # sparsity set at the weakest kept connection
+        if method_option == 'eigenvector' and acc['out_of_core']:
+            tiles = None
+            tiles_file = None
+            tiles_written = None
+            try:
+                # Each run gets its own file, so runs sharing the scratch
+                # directory don't overwrite each other's blocks
+                if scratch_dir is not None:
+                    fd, tiles_file = tempfile.mkstemp(prefix='correlation_tiles_',
+                                                      suffix='.dat',
+                                                      dir=scratch_dir)
+                    os.close(fd)
+                    tiles = np.memmap(tiles_file, dtype=dtype, mode='w+',
+                                      shape=(nvoxs,nvoxs))
+                    tiles_written = np.zeros(len(blocks), dtype='bool')
+                for method in ['binarize', 'weighted']:
+                    logger.info('...calculating %s eigenvector (out-of-core)'
+                                % method)
+                    acc[method][:] = core.eigenvector_centrality_blocked(
+                        ts_normd, r_value, method=method,
+                        block_size=block_size, tiles=tiles,
+                        tiles_written=tiles_written,
+                        inclusive=(acc['thresh_type'] == 'sparsity')).squeeze()
+            finally:
+                del tiles
+                if tiles_file is not None and os.path.exists(tiles_file):
+                    os.remove(tiles_file)
+        # Perform eigenvector measures
+        elif method_option == 'eigenvector':
+            logger.info('...calculating binarize eigenvector')
+            acc['binarize'][:] = \
+                core.eigenvector_centrality_sparse(graph, 
+                                                   method='binarize').squeeze()
+            logger.info('...calculating weighted eigenvector')
+            acc['weighted'][:] = \
+                core.eigenvector_centrality_sparse(graph, 
+                                                   method='weighted').squeeze()
+            del graph
+        del acc['parts']
 
     # Return list of outputs
     return out_list
 
 
-# Function to calculate centrality with a sparsity threhold
-def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
+# Function to calculate degree centrality at several thresholds in one pass
+def get_degree_by_thresholds(ts_normd, thresholds, block_size):
     '''
-    Method to calculate degree/eigenvector centrality via sparsity threshold
+    Method to calculate binarized and weighted degree centrality at several
+    thresholds (correlation and/or sparsity) from one pass over the blocks
+    of the correlation matrix, e.g. for sensitivity analyses
+
+    Correlation thresholds are accumulated together by binning each 
+    correlation by the number of thresholds it exceeds (see
+    `core.degree_centrality_multi`). Sparsity thresholds share one extra
+    histogram pass and are then exact as in `get_centrality_by_sparsity`.
 
     Parameters
     ----------
-    ts_normd : ndarray
+    ts_normd : ndarray (float)
         timeseries of shape (ntpts x nvoxs) that is normalized; i.e. the data 
         is demeaned and divided by its L2-norm
-    method_option : integer
-        0 - degree centrality calculation, 
-        1 - eigenvector centrality calculation, 
-        2 - lFCD calculation
-    threshold : a float
-        sparsity_threshold value
+    thresholds : list of tuples (string, float)
+        (threshold_option, threshold) for each threshold, where 
+        threshold_option is 'correlation' (threshold is an r value) or 
+        'sparsity' (threshold is the fraction of connections to keep)
     block_size : an integer
         the number of rows (voxels) to compute timeseries correlation over
         at any one time
@@ -447,154 +793,97 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
     out_list : list (string, ndarray)
         list of (string,ndarray) elements corresponding to:
         string - the name of the metric
-        ndarray - the array of values to be mapped for that metric
+        ndarray - array of shape (nvoxs x nthresholds) with the values to 
+        be mapped for that metric, one column per threshold
     '''
 
     # Import packages
-    import copy
     import numpy as np
-    import scipy as sp
     from nipype import logging
 
     import CPAC.network_centrality.core as core
 
     # Init variables
     logger = logging.getLogger('workflow')
-    out_list = []
     nvoxs = ts_normd.shape[1]
+    nthr = len(thresholds)
 
     # Init degree centrality outputs
-    if method_option == 'degree':
-        degree_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('degree_centrality_binarize', degree_binarize))
-        degree_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('degree_centrality_weighted', degree_weighted))
-
-    # Init eigenvector centrality outputs
-    if method_option == 'eigenvector':
-        r_matrix = np.zeros((nvoxs,nvoxs), dtype = ts_normd.dtype)
-        # Init output map
-        eigen_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('eigenvector_centrality_binarize', eigen_binarize))
-        # Init output map
-        eigen_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
-        out_list.append(('eigenvector_centrality_weighted', eigen_weighted))
-
-    # Get the number of connections to keep
-    sparse_num = np.round((nvoxs**2-nvoxs)*threshold/2.0)
-
-    # Prepare to loop through and calculate correlation matrix
-    n = 0
-    m = block_size
-    block_no = 1
-    r_value = -1
-
-    # Init wij list
-    z = np.array([])
-    wij_global = np.rec.fromarrays([z.astype(ts_normd.dtype),
-                                    z.astype('int32'),
-                                    z.astype('int32')])
-    # Form the initial blockwise mask (to only grab upper triangle of data)
-    block_triu = np.triu(np.ones((block_size,block_size)), k=1).astype('bool')
-    block_rect = np.ones((block_size,nvoxs-block_size), dtype='bool')
-    block_mask = np.concatenate((block_triu,block_rect), axis=1)
-
-    # Delete matrices to save memory
-    del block_triu, block_rect
-    # Calculate correlations step - prune connections for degree
-    while n <= nvoxs:
-        # First, compute block of correlation matrix
-        logger.info('running block %d: rows %d thru %d' % (block_no, n, m-1))
-        # Calculate wij over entire matrix by block
-        # Do this for both deg and eig, more efficient way to compute r_value
-        rmat_block = np.dot(ts_normd[:,n:m].T,
-                            ts_normd[:,n:])
-        # Shrink block_mask down on every iteration after the first block
-        if n > 0:
-            block_mask = block_mask[:,:-block_size]
-
-        # Get elements as an array
-        rmat_block = rmat_block[block_mask]
-        thr_idx = np.where(rmat_block >= r_value)
-        rmat_block = rmat_block[thr_idx]
-        logger.info('number of passing correlations is %d' % len(rmat_block))
-
-        # Add global offset to indicies
-        idx = np.where(block_mask)
-        i = idx[0][thr_idx].astype('int32') + n
-        j = idx[1][thr_idx].astype('int32') + n
-
-        # Free some memory
-        del idx, thr_idx
-        w_global = np.concatenate([wij_global.f0,rmat_block])
-        i_global = np.concatenate([wij_global.f1,i])
-        j_global = np.concatenate([wij_global.f2,j])
-        # Free some memory
-        del i,j,rmat_block
-        # Grab indices and weights that pass and combine into list
-        wij_global = np.rec.fromarrays([w_global,i_global,j_global])
-        # Free some memory
-        del w_global, i_global, j_global
-
-        # Pass these into the global set and sort (ascending) by correlation
-        logger.info('sorting list...')
-        wij_global.sort()
-        # And trim list if it's greater than the number of connections we want
-        if len(wij_global) > sparse_num:
-            wij_global = wij_global[-sparse_num:]
-        r_value = wij_global[0][0]
-
-        # If we're doing eigen, store block into full matrix
-        if method_option == 'eigenvector':
-            r_matrix[n:m] = np.dot(ts_normd[:,n:m].T, ts_normd)
-
-        # Move next block start point up to last block finish point
-        n = m
-        # If we finished at nvoxs last time, break the loop
-        if n == nvoxs:
-            break
-        # Else, if our next block runs over nvoxs, limit it to nvoxs
-        elif (m+block_size) > nvoxs:
-            m = nvoxs
-        # Else, just increment end of next block by block_size
+    degree_binarize = np.zeros((nvoxs,nthr), dtype=ts_normd.dtype)
+    degree_weighted = np.zeros((nvoxs,nthr), dtype=ts_normd.dtype)
+    out_list = [('degree_centrality_binarize', degree_binarize),
+                ('degree_centrality_weighted', degree_weighted)]
+
+    # Split the thresholds by type, keeping their output columns
+    r_cols = []; r_values = []
+    sparse_accums = []
+    for col,(threshold_option, threshold) in enumerate(thresholds):
+        if threshold_option == 'correlation':
+            r_cols.append(col)
+            r_values.append(threshold)
+        elif threshold_option == 'sparsity':
+            acc = core.sparsity_accumulator(nvoxs, threshold)
+            acc['col'] = col
+            sparse_accums.append(acc)
         else:
-            m += block_size
-        # Increment block number
-        block_no += 1
-
-    # Calculate centrality step
-    # Degree - use ijw list to create a sparse matrix
-    if method_option == 'degree':
-        # Create sparse (symmetric) matrix of all correlations that survived
-        logger.info('creating sparse matrix')
-        # Extract the weights and indices from the global list
-        w = wij_global.f0
-        i = wij_global.f1
-        j = wij_global.f2
-        del wij_global
-        # Create sparse correlation matrix (upper tri) from wij's
-        Rsp = sp.sparse.coo_matrix((w,(i,j)), shape=(nvoxs,nvoxs))
-        Rsp = Rsp + Rsp.T
-        # And compute degree centrality on compressed row matrix
-        Rcsr = Rsp.tocsr()
-        del Rsp
-        degree_binarize[:] = np.array((Rcsr > 0).sum(axis=0))
-        degree_weighted[:] = np.array(Rcsr.sum(axis=0))
-        del Rcsr
-
-    # Eigenvector - compute the r value from entire matrix
-    if method_option == 'eigenvector':
-        del wij_global
-        # Finally compute centrality using full matrix and r_value
-        logger.info('...calculating binarize eigenvector')
-        eigen_binarize[:] = \
-            core.eigenvector_centrality(copy.deepcopy(r_matrix), r_value,
-                                        method='binarize').squeeze()
-        logger.info('...calculating weighted eigenvector')
-        eigen_weighted[:] = \
-            core.eigenvector_centrality(r_matrix, r_value,
-                                        method='weighted').squeeze()
-        del r_matrix
+            raise Exception('Threshold option: %s not supported for '\
+                            'multi-threshold degree centrality' 
+                            % threshold_option)
+
+    # Correlations in the upper triangle are quantized into fine bins
+    # over [-1,1] for sparsity thresholding
+    nbins = 2**20
+
+    blocks = [ (n, min(n+block_size, nvoxs)) 
+               for n in xrange(0, nvoxs, block_size) ]
+
+    # Sparsity pass - histogram of all upper triangle correlations, shared
+    # by all sparsity thresholds
+    if sparse_accums:
+        core.sparsity_cutoffs(ts_normd, blocks, sparse_accums, 
+                              bool(r_values), nbins)
+
+    # Main pass - all thresholds from each block
+    for block_no,(n,m) in enumerate(blocks):
+        logger.info('running block %d: rows %d thru %d' 
+                    % (block_no+1, n, m-1))
+        rmat_block, rmat_strip = core.correlation_block(ts_normd, n, m, 
+                                                        bool(r_values))
+        if r_values:
+            bin_block, wt_block = \
+                core.degree_centrality_multi(rmat_block, r_values)
+            degree_binarize[n:m,r_cols] += bin_block
+            degree_weighted[n:m,r_cols] += wt_block
+            del bin_block, wt_block
+
+        # Sparsity thresholds - keep the connections above the cutoff bin,
+        # while gathering those in the cutoff bin
+        if sparse_accums:
+            idx = core.quantize_upper(rmat_strip, nbins)
+            for acc in sparse_accums:
+                col = acc['col']
+                keep = core.sparsity_keep_block(
+                    acc, idx, rmat_strip, n, 
+                    out_binarize=degree_binarize[n:,col], 
+                    out_weighted=degree_weighted[n:,col])
+                del keep
+            del idx
+
+        # Delete block of corr matrix
+        del rmat_block, rmat_strip
+
+    # Correct for self-correlation in degree centrality
+    if r_cols:
+        for out in [degree_binarize, degree_weighted]:
+            out_r = out[:,r_cols]
+            out_r[out_r != 0] -= 1
+            out[:,r_cols] = out_r
+
+    # Add the connections kept from the cutoff bins
+    for acc in sparse_accums:
+        col = acc['col']
+        core.sparsity_resolve(acc, out_binarize=degree_binarize[:,col], 
+                              out_weighted=degree_weighted[:,col])
 
     # Return list of outputs
     return out_list
@@ -675,7 +964,8 @@ def get_centrality_fast(timeseries,
 
 # Main centrality function utilized by the centrality workflow
 def calc_centrality(in_file, template, method_option, threshold_option,
-                    threshold, allocated_memory):
+                    threshold, allocated_memory, scratch_dir=None,
+                    probe_block_size=False):
     '''
     Function to calculate centrality and map them to a nifti file
     
@@ -689,11 +979,23 @@ def calc_centrality(in_file, template, method_option, threshold_option,
         accepted values are 'degree centrality', 'eigenvector centrality', and
         'lfcd'
     threshold_option : string
-        accepted values are: 'significance', 'sparsity', and 'correlation'
+        accepted values are: 'significance', 'sparsity', and 'correlation';
+        'none' (or 3) skips thresholding and gives the weighted degree or
+        eigenvector centrality of the full correlation matrix without
+        computing it (see `get_centrality_fast`)
     threshold : float
-        pvalue/sparsity_threshold/threshold value
+        pvalue/sparsity_threshold/threshold value; unused without a
+        threshold
     allocated_memory : string
-        amount of memory allocated to degree centrality
+        amount of memory allocated to degree centrality; eigenvector 
+        centrality gives half of it to the blocks and half to its sparse
+        graph, beyond which it goes out-of-core
+    scratch_dir : string (optional)
+        directory for out-of-core eigenvector centrality to memory-map the
+        correlation blocks in, rather than recompute them each iteration
+    probe_block_size : boolean (optional)
+        time blocks of the data to pick the block size with the best 
+        throughput under the memory limit; see `calc_blocksize`
     
     Returns
     -------
@@ -709,29 +1011,45 @@ def calc_centrality(in_file, template, method_option, threshold_option,
                                         map_centrality_matrix,\
                                         calc_blocksize,\
                                         convert_pvalue_to_r
-    from CPAC.network_centrality.utils import check_centrality_params
+    from CPAC.network_centrality.utils import check_centrality_params,\
+                                              get_memory_usage
+    from nipype import logging
     from CPAC.cwas.subdist import norm_cols
 
     # First check input parameters and get proper formatted method/thr options
-    method_option, threshold_option = \
-        check_centrality_params(method_option, threshold_option, threshold)
+    if threshold_option in [3, 'none']:
+        method_option, _ = \
+            check_centrality_params(method_option, 'correlation', 0.0)
+        if method_option == 'lfcd':
+            raise Exception('lFCD needs a correlation threshold')
+        threshold_option = 3
+    else:
+        method_option, threshold_option = \
+            check_centrality_params(method_option, threshold_option, threshold)
 
     # Init variables
+    logger = logging.getLogger('workflow')
     out_list = []
     ts, aff, mask, t_type, scans = load(in_file, template)
 
-    # If we're doing degree sparsity
-    if method_option == 'degree' and threshold_option == 'sparsity':
-        block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
-                                    sparsity_thresh=threshold)
-    # Otherwise
-    elif method_option == 'eigenvector':
+    # Eigenvector centrality splits the memory between the blocks and its
+    # sparse graph
+    graph_memory = None
+    if method_option == 'eigenvector' and allocated_memory:
+        allocated_memory = allocated_memory/2.0
+        graph_memory = allocated_memory
+
+    # If we're doing degree/eigenvector sparsity
+    if threshold_option == 'sparsity':
         block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
-                                    include_full_matrix=True)
+                                    sparsity_thresh=threshold,
+                                    probe=probe_block_size)
     # Otherwise, compute blocksize with regards to available memory
+    # (eigenvector centrality now only keeps the suprathreshold graph)
     else:
         block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
-                                    include_full_matrix=False)
+                                    include_full_matrix=False,
+                                    probe=probe_block_size)
     # Normalize the timeseries for easy dot-product correlation calc.
     ts_normd = norm_cols(ts.T)
 
@@ -742,23 +1060,31 @@ def calc_centrality(in_file, template, method_option, threshold_option,
                                                      mask,
                                                      method_option,
                                                      r_value,
-                                                     block_size)
+                                                     block_size,
+                                                     graph_memory,
+                                                     scratch_dir)
     # Sparsity threshold
     elif threshold_option == 'sparsity':
         centrality_matrix = get_centrality_by_sparsity(ts_normd,
                                                        method_option,
                                                        threshold,
-                                                       block_size)
+                                                       block_size,
+                                                       graph_memory,
+                                                       scratch_dir)
     # R-value threshold centrality
     elif threshold_option == 'correlation':
         centrality_matrix = get_centrality_by_rvalue(ts_normd,
                                                      mask,
                                                      method_option,
                                                      threshold,
-                                                     block_size)
+                                                     block_size,
+                                                     graph_memory,
+                                                     scratch_dir)
     # For fast approach (no thresholding)
     elif threshold_option == 3:
-        centrality_matrix = get_centrality_fast(ts, method_option)
+        centrality_matrix = get_centrality_fast(ts, 
+                                                [method_option == 'degree', 
+                                                 method_option == 'eigenvector'])
     # Otherwise, incorrect input for threshold_option
     else:
         err_msg = 'Threshold option: %s not supported for network centrality '\
@@ -766,6 +1092,111 @@ def calc_centrality(in_file, template, method_option, threshold_option,
                   % (str(threshold_option), str(method_option))
         raise Exception(err_msg)
  
+    # Compare the observed peak memory to the expected usage
+    logger.info('observed peak usage -> %.2fGB' \
+                % (get_memory_usage(peak=True)/1024.0**3))
+
+    # Map the arrays back to images
+    for mat in centrality_matrix:
+        centrality_image = map_centrality_matrix(mat, aff, mask, t_type)
+        out_list.append(centrality_image)
+
+    # Finally return
+    return out_list
+
+
+# Centrality function for several measures at once, utilized by the 
+# multi-measure centrality workflow
+def calc_centrality_multi(in_file, template, measures, allocated_memory,
+                          scratch_dir=None, probe_block_size=False):
+    '''
+    Function to calculate several centrality measures from one load of the
+    data and one sweep over the correlation matrix, and map them to nifti 
+    files
+    
+    Parameters
+    ----------
+    in_file : string (nifti file)
+        path to subject data file
+    template : string (nifti file)
+        path to mask/parcellation unit
+    measures : list of tuples
+        (method_option, threshold_option, threshold) of each measure, with
+        the same accepted values as `calc_centrality`; each method may only
+        be given once
+    allocated_memory : string
+        amount of memory allocated to degree centrality; with eigenvector
+        centrality, half of it goes to the blocks and half to its sparse
+        graph, beyond which it goes out-of-core
+    scratch_dir : string (optional)
+        directory for out-of-core eigenvector centrality to memory-map the
+        correlation blocks in, rather than recompute them each iteration
+    probe_block_size : boolean (optional)
+        time blocks of the data to pick the block size with the best 
+        throughput under the memory limit; see `calc_blocksize`
+    
+    Returns
+    -------
+    out_list : list
+        list containing out mapped centrality images, in the order of 
+        `measures`
+    '''
+
+    # Import packages
+    from CPAC.network_centrality import load,\
+                                        get_centrality_multi,\
+                                        map_centrality_matrix,\
+                                        calc_blocksize,\
+                                        convert_pvalue_to_r
+    from CPAC.network_centrality.utils import check_centrality_params,\
+                                              get_memory_usage
+    from nipype import logging
+    from CPAC.cwas.subdist import norm_cols
+
+    # First check input parameters and get proper formatted method/thr 
+    # options, converting p-values to correlation thresholds
+    checked_measures = []
+    for method_option, threshold_option, threshold in measures:
+        method_option, threshold_option = \
+            check_centrality_params(method_option, threshold_option, threshold)
+        if threshold_option == 'significance':
+            threshold = convert_pvalue_to_r(in_file, threshold, 
+                                            two_tailed=False)
+            threshold_option = 'correlation'
+        checked_measures.append((method_option, threshold_option, threshold))
+
+    # Init variables
+    logger = logging.getLogger('workflow')
+    out_list = []
+    ts, aff, mask, t_type, scans = load(in_file, template)
+
+    # Eigenvector centrality splits the memory between the blocks and its
+    # sparse graph
+    graph_memory = None
+    if 'eigenvector' in [ m[0] for m in checked_measures ] and \
+       allocated_memory:
+        allocated_memory = allocated_memory/2.0
+        graph_memory = allocated_memory
+
+    # If any measure uses sparsity, size blocks for sparsity thresholding
+    sparsity_thresh = max([ thr for _,thr_opt,thr in checked_measures 
+                            if thr_opt == 'sparsity' ] or [0.0])
+    block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
+                                sparsity_thresh=sparsity_thresh,
+                                probe=probe_block_size)
+    # Normalize the timeseries for easy dot-product correlation calc.
+    ts_normd = norm_cols(ts.T)
+
+    # Calculate all the measures from one sweep
+    centrality_matrix = get_centrality_multi(ts_normd, mask, 
+                                             checked_measures, block_size,
+                                             graph_memory=graph_memory,
+                                             scratch_dir=scratch_dir)
+
+    # Compare the observed peak memory to the expected usage
+    logger.info('observed peak usage -> %.2fGB' \
+                % (get_memory_usage(peak=True)/1024.0**3))
+
     # Map the arrays back to images
     for mat in centrality_matrix:
         centrality_image = map_centrality_matrix(mat, aff, mask, t_type)
@@ -773,3 +1204,365 @@ def calc_centrality(in_file, template, method_option, threshold_option,
 
     # Finally return
     return out_list
+
+
+# Function to calculate degree centrality at several thresholds and map 
+# them to 4D nifti files
+def calc_degree_by_thresholds(in_file, template, thresholds, 
+                              allocated_memory, probe_block_size=False):
+    '''
+    Function to calculate degree centrality at several thresholds in one
+    pass over the correlation matrix and map them to 4D nifti files, with 
+    one volume per threshold. This replaces one `calc_centrality` run per 
+    threshold.
+    
+    Parameters
+    ----------
+    in_file : string (nifti file)
+        path to subject data file
+    template : string (nifti file)
+        path to mask/parcellation unit
+    thresholds : list of tuples (string, float)
+        (threshold_option, threshold) for each volume, where 
+        threshold_option accepts the same values as in `calc_centrality`
+    allocated_memory : string
+        amount of memory allocated to degree centrality
+    probe_block_size : boolean (optional)
+        time blocks of the data to pick the block size with the best 
+        throughput under the memory limit; see `calc_blocksize`
+    
+    Returns
+    -------
+    out_list : list
+        list containing the binarized and weighted 4D centrality images
+    '''
+
+    # Import packages
+    from CPAC.network_centrality import load,\
+                                        get_degree_by_thresholds,\
+                                        map_centrality_matrix,\
+                                        calc_blocksize,\
+                                        convert_pvalue_to_r
+    from CPAC.network_centrality.utils import check_centrality_params,\
+                                              get_memory_usage
+    from nipype import logging
+    from CPAC.cwas.subdist import norm_cols
+
+    # First check input parameters and convert p-values to correlation
+    # thresholds
+    checked_thresholds = []
+    for threshold_option, threshold in thresholds:
+        _, threshold_option = \
+            check_centrality_params('degree', threshold_option, threshold)
+        if threshold_option == 'significance':
+            threshold = convert_pvalue_to_r(in_file, threshold, 
+                                            two_tailed=False)
+            threshold_option = 'correlation'
+        checked_thresholds.append((threshold_option, threshold))
+
+    # Init variables
+    logger = logging.getLogger('workflow')
+    out_list = []
+    ts, aff, mask, t_type, scans = load(in_file, template)
+
+    # If any threshold uses sparsity, size blocks for sparsity thresholding
+    sparsity_thresh = max([ thr for thr_opt,thr in checked_thresholds 
+                            if thr_opt == 'sparsity' ] or [0.0])
+    block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
+                                sparsity_thresh=sparsity_thresh,
+                                probe=probe_block_size)
+    # Normalize the timeseries for easy dot-product correlation calc.
+    ts_normd = norm_cols(ts.T)
+
+    # Calculate degree at all thresholds
+    centrality_matrix = get_degree_by_thresholds(ts_normd, 
+                                                 checked_thresholds, 
+                                                 block_size)
+
+    # Compare the observed peak memory to the expected usage
+    logger.info('observed peak usage -> %.2fGB' \
+                % (get_memory_usage(peak=True)/1024.0**3))
+
+    # Map the arrays back to 4D images
+    for mat in centrality_matrix:
+        centrality_image = map_centrality_matrix(mat, aff, mask, t_type)
+        out_list.append(centrality_image)
+
+    # Finally return
+    return out_list
+
+
+# Function to calculate centrality for many subjects on a common mask, 
+# sharing the setup between them
+def calc_centrality_batch(in_files, template, measures, allocated_memory,
+                          out_dir, subject_ids=None, num_workers=1, 
+                          num_threads=1, scratch_dir=None, 
+                          probe_block_size=False):
+    '''
+    Function to calculate centrality measures for a list of subjects on a
+    common mask/parcellation unit and map them to nifti files, without a
+    pipeline launch per subject. The template is loaded, its voxels and
+    their lFCD neighbours are found, the block size is planned and p-values
+    are converted to correlation thresholds once, and the subjects are then
+    run through a pool of worker processes.
+
+    Parameters
+    ----------
+    in_files : list of strings (nifti files)
+        paths to the subjects' data files
+    template : string (nifti file)
+        path to the common mask/parcellation unit
+    measures : list of tuples
+        (method_option, threshold_option, threshold) of each measure, with
+        the same accepted values as `calc_centrality_multi`
+    allocated_memory : float
+        amount of memory (GB) allocated to each worker
+    out_dir : string
+        directory to write each subject's images into a subdirectory of
+    subject_ids : list of strings (optional)
+        name of each subject's subdirectory; by default the data files'
+        names, or their numbers in the list if the names aren't unique
+    num_workers : integer (optional)
+        number of subjects to run at once
+    num_threads : integer (optional)
+        number of BLAS/OpenMP threads of each worker
+    scratch_dir : string (optional)
+        directory for out-of-core eigenvector centrality to memory-map the
+        correlation blocks in; see `calc_centrality`
+    probe_block_size : boolean (optional)
+        time blocks of the data of the subject with the most timepoints to
+        pick the block size with the best throughput; see `calc_blocksize`
+
+    Returns
+    -------
+    out_lists : list
+        list of each subject's mapped centrality images, in the order of
+        `measures`, or None for the subjects that failed
+    '''
+
+    # Import packages
+    import os
+    import multiprocessing
+    import nibabel as nib
+    import numpy as np
+    from CPAC.network_centrality import load,\
+                                        calc_blocksize,\
+                                        convert_pvalue_to_r
+    from CPAC.network_centrality.utils import check_centrality_params,\
+                                              calc_neighbor_graph,\
+                                              set_num_threads
+    from CPAC.utils.utils import get_nifti_header_info
+    from nipype import logging
+
+    # Init variables
+    logger = logging.getLogger('workflow')
+    checked_measures = []
+    for method_option, threshold_option, threshold in measures:
+        method_option, threshold_option = \
+            check_centrality_params(method_option, threshold_option, threshold)
+        checked_measures.append((method_option, threshold_option, threshold))
+
+    # Name each subject's output directory
+    if subject_ids is None:
+        subject_ids = [ os.path.basename(in_file).split('.')[0] 
+                        for in_file in in_files ]
+        if len(set(subject_ids)) < len(subject_ids):
+            subject_ids = [ 'subject_%04d' % idx 
+                            for idx in range(len(in_files)) ]
+    elif len(subject_ids) != len(in_files):
+        err_msg = 'Number of subject ids (%d) does not match the number of '\
+                  'data files (%d)' % (len(subject_ids), len(in_files))
+        raise Exception(err_msg)
+
+    # Load the template once, and for a mask (rather than a parcellation)
+    # find its voxels and, for lFCD, their neighbours once for all subjects
+    template_data = nib.load(template).get_data()
+    mask_indices = None
+    neighbors = None
+    if len(np.unique(template_data)) <= 2:
+        mask_indices = np.where(template_data.astype('bool'))
+        if 'lfcd' in [ m[0] for m in checked_measures ]:
+            neighbors = calc_neighbor_graph(np.column_stack(mask_indices), 
+                                            k=26)
+
+    # Convert p-values to correlation thresholds once for each number of
+    # timepoints (read from the headers)
+    subject_measures = []
+    subject_scans = []
+    r_values = {}
+    for in_file in in_files:
+        scans = get_nifti_header_info(in_file)['shape'][3]
+        subject_scans.append(scans)
+        sub_measures = []
+        for method_option, threshold_option, threshold in checked_measures:
+            if threshold_option == 'significance':
+                if (scans, threshold) not in r_values:
+                    r_values[(scans, threshold)] = \
+                        convert_pvalue_to_r(in_file, threshold, 
+                                            two_tailed=False)
+                sub_measures.append((method_option, 'correlation', 
+                                     r_values[(scans, threshold)]))
+            else:
+                sub_measures.append((method_option, threshold_option, 
+                                     threshold))
+        subject_measures.append(sub_measures)
+
+    # Eigenvector centrality splits the memory between the blocks and its
+    # sparse graph
+    graph_memory = None
+    if 'eigenvector' in [ m[0] for m in checked_measures ] and \
+       allocated_memory:
+        allocated_memory = allocated_memory/2.0
+        graph_memory = allocated_memory
+
+    # Plan the block size once, from the subject with the most timepoints
+    # (and all the template voxels), so that it fits every subject
+    sparsity_thresh = max([ thr for _,thr_opt,thr in checked_measures 
+                            if thr_opt == 'sparsity' ] or [0.0])
+    longest_file = in_files[int(np.argmax(subject_scans))]
+    if mask_indices is not None:
+        ts = nib.load(longest_file).get_data()[mask_indices].astype(np.float32)
+    else:
+        ts = load(longest_file, template_data)[0]
+    block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
+                                sparsity_thresh=sparsity_thresh,
+                                probe=probe_block_size)
+    del ts
+
+    # Run the subjects
+    jobs = [ (in_file, template_data, sub_measures, block_size,
+              os.path.join(out_dir, subject_id), graph_memory, scratch_dir,
+              mask_indices, neighbors)
+             for in_file, sub_measures, subject_id 
+             in zip(in_files, subject_measures, subject_ids) ]
+    out_lists = []
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=set_num_threads,
+                                    initargs=(num_threads,))
+        results = [ pool.apply_async(calc_centrality_subject, job) 
+                    for job in jobs ]
+        pool.close()
+    else:
+        set_num_threads(num_threads)
+        results = jobs
+    for in_file, result in zip(in_files, results):
+        try:
+            if num_workers > 1:
+                out_lists.append(result.get())
+            else:
+                out_lists.append(calc_centrality_subject(*result))
+        except Exception as exc:
+            logger.error('Centrality failed for %s. Error: %s' \
+                         % (in_file, exc))
+            out_lists.append(None)
+    if num_workers > 1:
+        pool.join()
+
+    # Finally return
+    return out_lists
+
+
+# Function to calculate the centrality measures of one subject of a batch
+def calc_centrality_subject(in_file, template, measures, block_size, 
+                            out_dir, graph_memory=None, scratch_dir=None,
+                            mask_indices=None, neighbors=None):
+    '''
+    Function to calculate centrality measures for one subject with an
+    already loaded template and planned block size, and map them to nifti
+    files in its output directory; used by `calc_centrality_batch`
+
+    Parameters
+    ----------
+    in_file : string (nifti file)
+        path to subject data file
+    template : ndarray
+        mask/parcellation unit data
+    measures : list of tuples
+        (method_option, threshold_option, threshold) of each measure, with
+        p-values already converted to correlation thresholds
+    block_size : integer
+        the number of rows (voxels) to compute timeseries correlation over
+        at any one time
+    out_dir : string
+        directory to write the images in
+    graph_memory : float (optional)
+        memory (GB) for the eigenvector centrality graph, beyond which it
+        goes out-of-core
+    scratch_dir : string (optional)
+        directory for out-of-core eigenvector centrality to memory-map the
+        correlation blocks in
+    mask_indices : tuple of ndarrays (optional)
+        indices of the voxels of a mask template (`np.where`), to take the
+        timeseries from without setting up the mask again; by default the 
+        data is read with `load`
+    neighbors : scipy.sparse.csr_matrix (optional)
+        lFCD neighbours of the voxels of `mask_indices` (see 
+        `utils.calc_neighbor_graph`)
+
+    Returns
+    -------
+    out_list : list
+        list containing out mapped centrality images, in the order of 
+        `measures`
+    '''
+
+    # Import packages
+    import os
+    import nibabel as nib
+    import numpy as np
+    from CPAC.network_centrality import load,\
+                                        get_centrality_multi,\
+                                        map_centrality_matrix
+    from CPAC.cwas.subdist import norm_cols
+
+    # Init variables
+    out_list = []
+    if mask_indices is None:
+        ts, aff, mask, t_type, scans = load(in_file, template)
+    else:
+        # As `load` with a mask, dropping the voxels without variance from 
+        # the shared mask voxels (and their neighbours)
+        img = nib.load(in_file)
+        data = img.get_data()
+        if data.shape[:3] != template.shape:
+            raise Exception('Invalid Shape Error. mask and data file have '\
+                            'different shape please check the voxel size of '\
+                            'the two files')
+        aff = img.get_affine()
+        t_type = 0
+        ts = data[mask_indices].astype(np.float32)
+        del data
+        keep = ts.var(axis=1).astype('bool')
+        mask = np.zeros(template.shape, dtype='bool')
+        mask[mask_indices] = keep
+        if not keep.all():
+            ts = ts[keep]
+            if neighbors is not None:
+                keep_idx = np.where(keep)[0]
+                neighbors = neighbors[keep_idx][:,keep_idx]
+                neighbors.sort_indices()
+    ts_normd = norm_cols(ts.T)
+    del ts
+
+    # Calculate all the measures from one sweep
+    centrality_matrix = get_centrality_multi(ts_normd, mask, measures, 
+                                             min(block_size, 
+                                                 ts_normd.shape[1]),
+                                             graph_memory=graph_memory,
+                                             scratch_dir=scratch_dir,
+                                             neighbors=neighbors)
+
+    # Map the arrays back to images in the subject's directory
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for mat in centrality_matrix:
+            centrality_image = map_centrality_matrix(mat, aff, mask, t_type)
+            out_list.append(centrality_image)
+    finally:
+        os.chdir(cwd)
+
+    # Finally return
+    return out_list
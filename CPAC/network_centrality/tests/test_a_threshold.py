@@ -25,6 +25,16 @@ from CPAC.network_centrality.thresh_and_sum import \
         centrality_weighted_float, centrality_weighted_double, \
         centrality_both_float, centrality_both_double    # these aren't currently used
 
+# Fused (multithreaded) degree centrality
+from CPAC.network_centrality.thresh_and_sum import \
+        centrality_fused_float, centrality_fused_double, \
+        centrality_upper_float, centrality_upper_double, \
+        centrality_multi_float, centrality_multi_double
+
+# lFCD
+from CPAC.network_centrality.thresh_and_sum import \
+        lfcd_flood_float, lfcd_flood_double
+
 
 ###
 # TEST thresholding of matrices for eigenvector centrality
@@ -80,3 +90,128 @@ class TestThresholding:
 ###
 # TEST centrality functions
 ###
+
+@attr('centrality', 'degree', 'fused')
+def test_centrality_fused():
+    print "testing fused degree centrality"
+    
+    nvoxs       = 1000
+    r_value     = 0.2
+    
+    for dtype,func in [('float32', centrality_fused_float), 
+                       ('float64', centrality_fused_double)]:
+        corr_matrix = np.random.random((nvoxs, nvoxs)).astype(dtype)
+        
+        ref_bin = (corr_matrix>r_value).sum(axis=1)
+        ref_wt  = (corr_matrix*(corr_matrix>r_value)).sum(axis=1)
+        ref_tr  = (((1.0+corr_matrix)/2.0)*(corr_matrix>r_value)).sum(axis=1)
+        
+        comp_bin = np.zeros(nvoxs, dtype=dtype)
+        comp_wt  = np.zeros(nvoxs, dtype=dtype)
+        comp_tr  = np.zeros(nvoxs, dtype=dtype)
+        func(corr_matrix, comp_bin, comp_wt, comp_tr, r_value, 2)
+        
+        assert_equal(ref_bin, comp_bin)
+        assert_allclose(ref_wt, comp_wt, rtol=1e-5)
+        assert_allclose(ref_tr, comp_tr, rtol=1e-5)
+
+@attr('centrality', 'degree', 'upper')
+def test_centrality_upper():
+    print "testing upper-triangle degree centrality"
+    
+    ntpts       = 50
+    nvoxs       = 1000
+    block_size  = 128
+    r_value     = 0.1
+    
+    np.random.seed(8)
+    for dtype,func in [('float32', centrality_upper_float), 
+                       ('float64', centrality_upper_double)]:
+        ts = np.random.randn(ntpts, nvoxs).astype(dtype)
+        ts = (ts - ts.mean(axis=0))/ts.std(axis=0)/np.sqrt(ntpts)
+        strips = [ (n, ts[:,n:n+block_size].T.dot(ts[:,n:])) 
+                   for n in range(0, nvoxs, block_size) ]
+        
+        # The reference thresholds the same products as the kernel, so 
+        # correlations right at r_value are on the same side in both
+        corr_matrix = np.zeros((nvoxs, nvoxs), dtype=dtype)
+        for n,strip in strips:
+            corr_matrix[n:n+strip.shape[0], n:] = strip
+        corr_matrix = np.triu(corr_matrix) + np.triu(corr_matrix, 1).T
+        
+        ref_bin = (corr_matrix>r_value).sum(axis=1)
+        ref_wt  = (corr_matrix*(corr_matrix>r_value)).sum(axis=1)
+        
+        comp_bin = np.zeros(nvoxs, dtype=dtype)
+        comp_wt  = np.zeros(nvoxs, dtype=dtype)
+        for n,strip in strips:
+            func(strip, comp_bin[n:], comp_wt[n:], r_value, 2)
+        
+        assert_equal(ref_bin, comp_bin)
+        assert_allclose(ref_wt, comp_wt, rtol=1e-4)
+
+@attr('centrality', 'degree', 'multi')
+def test_centrality_multi():
+    print "testing multi-threshold degree centrality"
+    
+    nvoxs       = 1000
+    r_values    = np.array([-0.5, 0.1, 0.2, 0.6])
+    
+    for dtype,func in [('float32', centrality_multi_float), 
+                       ('float64', centrality_multi_double)]:
+        corr_matrix = (2*np.random.random((nvoxs, nvoxs)) - 1).astype(dtype)
+        thresh      = r_values.astype(dtype)
+        
+        ref_bin = np.column_stack([ (corr_matrix>r).sum(axis=1) 
+                                    for r in thresh ])
+        ref_wt  = np.column_stack([ (corr_matrix*(corr_matrix>r)).sum(axis=1) 
+                                    for r in thresh ])
+        
+        comp_bin = np.zeros((nvoxs, len(thresh)), dtype=dtype)
+        comp_wt  = np.zeros((nvoxs, len(thresh)), dtype=dtype)
+        func(corr_matrix, thresh.astype('float64'), comp_bin, comp_wt, 2)
+        
+        assert_equal(ref_bin, comp_bin)
+        assert_allclose(ref_wt, comp_wt, rtol=1e-4, atol=1e-3)
+
+@attr('centrality', 'lfcd')
+def test_lfcd_flood():
+    print "testing lfcd flood fill"
+    
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    from CPAC.network_centrality.utils import calc_neighbor_graph
+    
+    r_value     = 0.3
+    template    = np.random.random((8,8,6)) > 0.2
+    xyz         = np.argwhere(template)
+    nvoxs       = xyz.shape[0]
+    neighbors   = calc_neighbor_graph(xyz, k=26)
+    indptr      = neighbors.indptr.astype(np.intc)
+    indices     = neighbors.indices.astype(np.intc)
+    
+    for dtype,func in [('float32', lfcd_flood_float), 
+                       ('float64', lfcd_flood_double)]:
+        corr_matrix = np.random.random((nvoxs, nvoxs)).astype(dtype)
+        np.fill_diagonal(corr_matrix, 1)
+        
+        # Reference: connected component of the seed amongst the
+        # suprathreshold voxels
+        ref_bin = np.ones(nvoxs)
+        ref_wt  = np.ones(nvoxs)
+        for i in range(nvoxs):
+            above   = corr_matrix[i] > r_value
+            adj     = csr_matrix(neighbors.multiply(np.outer(above, above)))
+            adj.eliminate_zeros()
+            nc,lbl  = connected_components(adj, directed=False)
+            comp    = (lbl == lbl[i]) & above
+            if comp.sum() > 1:
+                ref_bin[i] = comp.sum()
+                ref_wt[i]  = corr_matrix[i][comp].sum()
+        
+        comp_bin = np.zeros(nvoxs, dtype=dtype)
+        comp_wt  = np.zeros(nvoxs, dtype=dtype)
+        func(corr_matrix, indptr, indices, 0, comp_bin, comp_wt, r_value, 2)
+        
+        assert_equal(ref_bin, comp_bin)
+        assert_allclose(ref_wt, comp_wt, rtol=1e-5)
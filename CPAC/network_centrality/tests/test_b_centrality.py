@@ -15,6 +15,9 @@ sys.path.insert(1, "/home2/data/Projects/CPAC_Regression_Test/zarrar/centrality_
 
 from CPAC.network_centrality import degree_centrality, fast_degree_centrality
 from CPAC.network_centrality import eigenvector_centrality, fast_eigenvector_centrality
+from CPAC.network_centrality import eigenvector_centrality_sparse, \
+        sparse_threshold_rows, sparse_graph
+from CPAC.network_centrality.core import eigenvector_centrality_blocked
 
 class TestDegreeCentrality:
     @attr('degree', 'centrality', 'binarize')
@@ -117,6 +120,61 @@ def test_fast_eigenvector_centrality(ntpts=100, nvoxs=1000):
     ok_(diff < np.spacing(1e2)) # allow minimal difference
 
 
+def test_eigenvector_centrality_sparse(ntpts=100, nvoxs=500, nblocks=4):
+    print "testing eigenvector_centrality_sparse"
+    
+    from CPAC.cwas.subdist import norm_cols
+    
+    r_value = 0.1
+    m       = norm_cols(np.random.random((ntpts,nvoxs)))
+    mm      = m.T.dot(m)
+    
+    # Build the sparse graph from blocks of rows
+    parts = [ sparse_threshold_rows(block, r_value) 
+              for block in np.array_split(mm, nblocks) ]
+    graph = sparse_graph(*[ np.concatenate(p) for p in zip(*parts) ], 
+                         nvoxs=nvoxs)
+    
+    for method in ["binarize", "weighted"]:
+        ref  = eigenvector_centrality(mm.copy(), r_value, method=method)
+        comp = eigenvector_centrality_sparse(graph, method=method)
+        assert_allclose(ref, comp, atol=1e-6)
+
+
+def test_eigenvector_centrality_blocked(ntpts=100, nvoxs=500, block_size=64):
+    print "testing eigenvector_centrality_blocked"
+    
+    import tempfile
+    from CPAC.cwas.subdist import norm_cols
+    
+    r_value = 0.1
+    m       = norm_cols(np.random.random((ntpts,nvoxs)))
+    mm      = m.T.dot(m)
+    
+    tiles_file    = tempfile.mktemp(suffix='.dat')
+    tiles         = np.memmap(tiles_file, dtype=m.dtype, mode='w+', 
+                              shape=(nvoxs,nvoxs))
+    tiles_written = np.zeros(int(np.ceil(nvoxs/float(block_size))), 
+                             dtype='bool')
+    
+    try:
+        for method in ["binarize", "weighted"]:
+            ref  = eigenvector_centrality(mm.copy(), r_value, method=method)
+            # Recomputed and disk-backed blocks
+            comp = eigenvector_centrality_blocked(m, r_value, method=method, 
+                                                  block_size=block_size)
+            assert_allclose(ref, comp, atol=1e-6)
+            comp = eigenvector_centrality_blocked(m, r_value, method=method, 
+                                                  block_size=block_size, 
+                                                  tiles=tiles, 
+                                                  tiles_written=tiles_written)
+            assert_allclose(ref, comp, atol=1e-6)
+        ok_(tiles_written.all())
+    finally:
+        del tiles
+        os.remove(tiles_file)
+
+
 def test_fast_on_real_data():
     from pandas import read_table
     from os import path as op
@@ -144,3 +202,195 @@ def test_fast_on_real_data():
     
     ok_(diff < np.spacing(1e10)) # allow some differences
 
+
+
+def test_get_centrality_multi(ntpts=50, nvoxs=300, block_size=64):
+    print "testing get_centrality_multi against one measure at a time"
+    
+    from CPAC.cwas.subdist import norm_cols
+    from CPAC.network_centrality import get_centrality_multi, \
+        get_centrality_by_rvalue, get_centrality_by_sparsity
+    
+    template = np.zeros((10,10,10), dtype='bool')
+    template.flat[:nvoxs] = True
+    ts_normd = norm_cols(np.random.random((ntpts,nvoxs)).astype('float32'))
+    
+    measures = [('degree', 'sparsity', 0.05), 
+                ('eigenvector', 'correlation', 0.2), 
+                ('lfcd', 'correlation', 0.2)]
+    comp = get_centrality_multi(ts_normd, template, measures, block_size)
+    ref  = get_centrality_by_sparsity(ts_normd, 'degree', 0.05, block_size) + \
+           get_centrality_by_rvalue(ts_normd, template, 'eigenvector', 0.2, 
+                                    block_size) + \
+           get_centrality_by_rvalue(ts_normd, template, 'lfcd', 0.2, 
+                                    block_size)
+    
+    eq_([ name for name,_ in ref ], [ name for name,_ in comp ])
+    for (_,ref_arr),(_,comp_arr) in zip(ref, comp):
+        assert_allclose(ref_arr, comp_arr, atol=1e-5)
+
+
+def test_calc_blocksize_probe(ntpts=50, nvoxs=2000, memory=0.01):
+    print "testing calc_blocksize with a throughput probe"
+    
+    from CPAC.network_centrality import calc_blocksize, probe_blocksize
+    
+    ts = np.random.random((nvoxs,ntpts)).astype('float32')
+    
+    # The probe stays within the memory limit
+    ref  = calc_blocksize(ts, memory_allocated=memory)
+    comp = calc_blocksize(ts, memory_allocated=memory, probe=True)
+    ok_(1 <= comp <= ref)
+    
+    # And picks one of the block sizes it tried
+    block_size, memory_ratio = probe_blocksize(ts, 1000, min_block_size=100)
+    ok_(block_size in [100, 200, 400, 800, 1000])
+    ok_(memory_ratio >= 0)
+
+    # The sparsity blocks take about the modeled memory, where it can be
+    # measured
+    block_size, memory_ratio = probe_blocksize(ts, 1000, min_block_size=100,
+                                               sparsity_thresh=0.01)
+    ok_(block_size in [100, 200, 400, 800, 1000])
+    ok_(0.5 < memory_ratio < 1.5)
+
+
+def test_get_centrality_by_sparsity_exact(ntpts=16, nvoxs=300, block_size=64):
+    print "testing sparsity thresholding against a sort of the upper triangle"
+    
+    from CPAC.network_centrality import get_centrality_multi
+    
+    # Timeseries of -1/4, 0 and 1/4 give correlations that are multiples of
+    # 1/16, computed exactly in float32 and full of ties
+    np.random.seed(10)
+    ts_normd = np.random.randint(-1, 2, (ntpts,nvoxs)).astype('float32')/4
+    template = np.zeros((10,10,10), dtype='bool')
+    template.flat[:nvoxs] = True
+    
+    corr_matrix = ts_normd.T.dot(ts_normd)
+    iu = np.triu_indices(nvoxs, 1)
+    w  = corr_matrix[iu]
+    
+    for sparsity in [0.01, 0.05, 0.2]:
+        sparse_num = int(np.round((nvoxs**2-nvoxs)*sparsity/2.0))
+        # Reference: the strongest connections, ties broken by coordinates
+        # as in `core.sparsity_boundary`
+        order = np.lexsort((iu[1], iu[0], w))[-sparse_num:]
+        ref_bin = np.zeros(nvoxs)
+        ref_wt  = np.zeros(nvoxs)
+        for idx in iu:
+            np.add.at(ref_bin, idx[order], 1)
+            np.add.at(ref_wt, idx[order], w[order])
+        ok_(len(np.unique(w[order])) < sparse_num)
+        
+        # Upper-triangle strips alone, and with lFCD computing whole rows
+        for measures in [[('degree', 'sparsity', sparsity)], 
+                         [('degree', 'sparsity', sparsity), 
+                          ('lfcd', 'correlation', 0.5)]]:
+            comp = get_centrality_multi(ts_normd, template, measures, 
+                                        block_size)
+            eq_(comp[0][1].sum(), 2*sparse_num)
+            assert_equal(comp[0][1], ref_bin)
+            assert_allclose(comp[1][1], ref_wt, atol=1e-5)
+
+
+def test_get_centrality_by_sparsity_negative(ntpts=20, nvoxs=300, 
+                                             block_size=64):
+    print "testing sparsity thresholding with a cutoff below zero"
+    
+    from CPAC.cwas.subdist import norm_cols
+    from CPAC.network_centrality import get_centrality_by_sparsity
+    
+    np.random.seed(11)
+    ts_normd = norm_cols(np.random.random((ntpts,nvoxs)).astype('float32'))
+    
+    corr_matrix = ts_normd.T.dot(ts_normd)
+    iu = np.triu_indices(nvoxs, 1)
+    w  = corr_matrix[iu]
+    
+    # Keep more connections than are positive
+    sparsity = 0.8
+    sparse_num = int(np.round((nvoxs**2-nvoxs)*sparsity/2.0))
+    order = np.argsort(w)[-sparse_num:]
+    ok_(w[order].min() < 0)
+    
+    # Reference: binarized degree counts the positive kept connections, 
+    # while weighted degree sums all of them
+    pos = order[w[order] > 0]
+    ref_bin = np.zeros(nvoxs)
+    ref_wt  = np.zeros(nvoxs)
+    for idx in iu:
+        np.add.at(ref_bin, idx[pos], 1)
+        np.add.at(ref_wt, idx[order], w[order])
+    
+    comp = get_centrality_by_sparsity(ts_normd, 'degree', sparsity, 
+                                      block_size)
+    assert_equal(comp[0][1], ref_bin)
+    assert_allclose(comp[1][1], ref_wt, atol=1e-3)
+
+
+def test_degree_by_thresholds(ntpts=50, nvoxs=300, block_size=64):
+    print "testing multi-threshold degree against one threshold at a time"
+    
+    import shutil, tempfile
+    import nibabel as nib
+    from CPAC.cwas.subdist import norm_cols
+    from CPAC.network_centrality import get_degree_by_thresholds, \
+        get_centrality_by_rvalue, get_centrality_by_sparsity, \
+        calc_degree_by_thresholds, calc_centrality
+    
+    # Unsorted, with correlation and sparsity thresholds mixed
+    thresholds = [('sparsity', 0.05), ('correlation', 0.3), 
+                  ('sparsity', 0.01), ('correlation', 0.1)]
+    
+    np.random.seed(12)
+    template = np.zeros((10,10,10), dtype='bool')
+    template.flat[:nvoxs] = True
+    ts_normd = norm_cols(np.random.random((ntpts,nvoxs)).astype('float32'))
+    
+    # Each column is the single-threshold run of its threshold
+    comp = get_degree_by_thresholds(ts_normd, thresholds, block_size)
+    for col,(threshold_option, threshold) in enumerate(thresholds):
+        if threshold_option == 'sparsity':
+            ref = get_centrality_by_sparsity(ts_normd, 'degree', threshold, 
+                                             block_size)
+        else:
+            ref = get_centrality_by_rvalue(ts_normd, template, 'degree', 
+                                           threshold, block_size)
+        eq_([ name for name,_ in ref ], [ name for name,_ in comp ])
+        for (_,ref_arr),(_,comp_arr) in zip(ref, comp):
+            assert_allclose(comp_arr[:,col], ref_arr, atol=1e-5)
+    
+    # And each volume of the 4D images is the `calc_centrality` image of its
+    # threshold
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        data = np.zeros(template.shape + (ntpts,), dtype='float32')
+        data[template] = ts_normd.T
+        in_file = os.path.join(tmp_dir, 'func.nii.gz')
+        mask_file = os.path.join(tmp_dir, 'mask.nii.gz')
+        nib.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+        nib.Nifti1Image(template.astype('int16'), 
+                        np.eye(4)).to_filename(mask_file)
+        
+        os.chdir(tmp_dir)
+        comp_files = calc_degree_by_thresholds(in_file, mask_file, 
+                                               thresholds, None)
+        comp_imgs = [ nib.load(f).get_data() for f in comp_files ]
+        for vol,(threshold_option, threshold) in enumerate(thresholds):
+            run_dir = os.path.join(tmp_dir, 'ref%d' % vol)
+            os.makedirs(run_dir)
+            os.chdir(run_dir)
+            ref_files = calc_centrality(in_file, mask_file, 'degree', 
+                                        threshold_option, threshold, None)
+            eq_([ os.path.basename(f) for f in ref_files ], 
+                [ os.path.basename(f) for f in comp_files ])
+            for ref_file,comp_img in zip(ref_files, comp_imgs):
+                eq_(comp_img.shape, template.shape + (len(thresholds),))
+                assert_allclose(comp_img[...,vol], 
+                                nib.load(ref_file).get_data(), 
+                                rtol=1e-4, atol=1e-5)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,176 @@
+"""
+This tests the batch centrality runner (calc_centrality_batch) and the
+scripts/cpac_centrality.py command line that drives it
+"""
+
+import os, sys
+import numpy as np
+from numpy.testing import *
+
+from nose.tools import ok_, eq_, raises, with_setup
+from nose.plugins.attrib import attr    # http://nose.readthedocs.org/en/latest/plugins/attrib.html
+
+
+def simulate_subjects(out_dir, ntpts_list=(40, 55), shape=(6,6,5)):
+    '''
+    Write subjects with different numbers of timepoints and a mask common
+    to them, where the last subject has a voxel without variance in the
+    mask
+    '''
+    import nibabel as nib
+
+    np.random.seed(26)
+    mask = np.zeros(shape, dtype='int16')
+    mask[1:5,1:5,1:4] = 1
+    mask_file = os.path.join(out_dir, 'mask.nii.gz')
+    nib.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+
+    in_files = []
+    for i,ntpts in enumerate(ntpts_list):
+        # A shared signal so that there are strong (and local) connections
+        signal = np.random.randn(ntpts)
+        data = np.random.randn(*(shape + (ntpts,))) + \
+               np.linspace(0, 2, shape[0])[:,None,None,None]*signal
+        if i == len(ntpts_list) - 1:
+            data[2,2,2] = 3.0
+        in_file = os.path.join(out_dir, 'sub%02d.nii.gz' % i)
+        nib.Nifti1Image(data.astype('float32'), np.eye(4)).to_filename(in_file)
+        in_files.append(in_file)
+
+    return in_files, mask_file
+
+
+def calc_centrality_reference(in_file, mask_file, measures, out_dir):
+    '''
+    Centrality images of one subject from one `calc_centrality` run per
+    measure, keyed by their names
+    '''
+    from CPAC.network_centrality import calc_centrality
+
+    ref = {}
+    cwd = os.getcwd()
+    for method_option, threshold_option, threshold in measures:
+        run_dir = os.path.join(out_dir, method_option)
+        os.makedirs(run_dir)
+        os.chdir(run_dir)
+        try:
+            for out_file in calc_centrality(in_file, mask_file,
+                                            method_option, threshold_option,
+                                            threshold, None):
+                ref[os.path.basename(out_file)] = out_file
+        finally:
+            os.chdir(cwd)
+
+    return ref
+
+
+def assert_images_equal(ref_files, comp_files):
+    import nibabel as nib
+
+    eq_(sorted(ref_files), sorted([ os.path.basename(f) for f in comp_files ]))
+    for comp_file in comp_files:
+        ref_file = ref_files[os.path.basename(comp_file)]
+        assert_allclose(nib.load(comp_file).get_data(),
+                        nib.load(ref_file).get_data(), rtol=1e-4, atol=1e-5)
+
+
+@attr('centrality', 'batch')
+def test_calc_centrality_batch():
+    print "testing calc_centrality_batch against calc_centrality"
+
+    import shutil, tempfile
+    from CPAC.network_centrality import calc_centrality_batch
+
+    measures = [('degree', 'sparsity', 0.1),
+                ('eigenvector', 'correlation', 0.3),
+                ('lfcd', 'correlation', 0.3)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_files, mask_file = simulate_subjects(tmp_dir)
+        refs = [ calc_centrality_reference(in_file, mask_file, measures,
+                                           os.path.join(tmp_dir, 'ref%d' % i))
+                 for i,in_file in enumerate(in_files) ]
+
+        # Serially and with a pool of workers
+        for num_workers in [1, 2]:
+            out_dir = os.path.join(tmp_dir, 'batch%d' % num_workers)
+            out_lists = calc_centrality_batch(in_files, mask_file, measures,
+                                              None, out_dir,
+                                              num_workers=num_workers,
+                                              scratch_dir=tmp_dir)
+            eq_(len(out_lists), len(in_files))
+            for ref,out_list,in_file in zip(refs, out_lists, in_files):
+                subject_id = os.path.basename(in_file).split('.')[0]
+                for out_file in out_list:
+                    eq_(os.path.dirname(out_file),
+                        os.path.join(out_dir, subject_id))
+                assert_images_equal(ref, out_list)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@attr('centrality', 'batch')
+def test_cpac_centrality_script():
+    print "testing the cpac_centrality.py command line"
+
+    import glob, shutil, subprocess, tempfile
+    from nose.plugins.skip import SkipTest
+    import CPAC
+
+    script = os.path.join(os.path.dirname(os.path.dirname(CPAC.__file__)),
+                          'scripts', 'cpac_centrality.py')
+    if not os.path.exists(script):
+        raise SkipTest('scripts/cpac_centrality.py not found')
+
+    measures = [('degree', 'correlation', 0.3),
+                ('lfcd', 'correlation', 0.3)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_files, mask_file = simulate_subjects(tmp_dir)
+        input_list = os.path.join(tmp_dir, 'inputs.txt')
+        with open(input_list, 'w') as f:
+            f.write('\n'.join(in_files[1:]) + '\n')
+        out_dir = os.path.join(tmp_dir, 'out')
+
+        subprocess.check_call([sys.executable, script,
+                               '-i', in_files[0], '--input-list', input_list,
+                               '-m', mask_file, '--degree', '--lfcd',
+                               '--rho', '0.3', '--nworkers', '2',
+                               '-o', out_dir])
+
+        for i,in_file in enumerate(in_files):
+            ref = calc_centrality_reference(in_file, mask_file, measures,
+                                            os.path.join(tmp_dir, 'ref%d' % i))
+            subject_id = os.path.basename(in_file).split('.')[0]
+            comp_files = glob.glob(os.path.join(out_dir, subject_id,
+                                                '*.nii.gz'))
+            assert_images_equal(ref, comp_files)
+        
+        # Only the binarized outputs
+        out_dir = os.path.join(tmp_dir, 'out_binarize')
+        subprocess.check_call([sys.executable, script, '-i'] + in_files + 
+                              ['-m', mask_file, '--degree', '--rho', '0.3', 
+                               '--binarize', '-o', out_dir])
+        for in_file in in_files:
+            subject_id = os.path.basename(in_file).split('.')[0]
+            eq_(os.listdir(os.path.join(out_dir, subject_id)), 
+                ['degree_centrality_binarize.nii.gz'])
+        
+        # Without a threshold, through calc_centrality
+        measures = [('degree', 'none', None), ('eigenvector', 'none', None)]
+        out_dir = os.path.join(tmp_dir, 'out_none')
+        subprocess.check_call([sys.executable, script, '-i'] + in_files + 
+                              ['-m', mask_file, '--degree', '--eigen', 
+                               '--no-threshold', '-o', out_dir])
+        for i,in_file in enumerate(in_files):
+            ref = calc_centrality_reference(in_file, mask_file, measures,
+                                            os.path.join(tmp_dir, 
+                                                         'ref_none%d' % i))
+            subject_id = os.path.basename(in_file).split('.')[0]
+            comp_files = glob.glob(os.path.join(out_dir, subject_id,
+                                                '*.nii.gz'))
+            assert_images_equal(ref, comp_files)
+    finally:
+        shutil.rmtree(tmp_dir)
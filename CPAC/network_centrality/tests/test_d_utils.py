@@ -0,0 +1,120 @@
+"""
+This tests the functions in network_centrality/utils.py
+"""
+
+import os, sys
+import numpy as np
+from numpy.testing import *
+
+from nose.tools import ok_, eq_, raises, with_setup
+from nose.plugins.attrib import attr    # http://nose.readthedocs.org/en/latest/plugins/attrib.html
+
+
+def write_graph_dump(one_d_file, mask, nedges=23, seed=5):
+    '''
+    Write a 1D graph dump like the ones of 3dDegreeCentrality and 3dECM, 
+    with 6 header lines and comment and blank lines between the edges
+    '''
+    
+    rng   = np.random.RandomState(seed)
+    xyz   = np.argwhere(mask)
+    pairs = set()
+    while len(pairs) < nedges:
+        i,j = sorted(rng.choice(len(xyz), 2, replace=False))
+        pairs.add((i,j))
+    
+    with open(one_d_file, 'w') as f:
+        f.write('# 3dDegreeCentrality graph dump\n')
+        f.write('# ncols = 9\n')
+        f.write('#\n')
+        f.write('# mask voxels = %d\n' % len(xyz))
+        f.write('#\n')
+        f.write('# i j ijk1 ijk2 weight\n')
+        for n,(i,j) in enumerate(sorted(pairs)):
+            if n % 7 == 3:
+                f.write('# a comment between the edges\n\n')
+            f.write('%d %d %d %d %d %d %d %d %.6f\n' \
+                    % ((i, j) + tuple(xyz[i]) + tuple(xyz[j]) + 
+                       (rng.uniform(0.3, 1.0),)))
+    
+    return xyz, sorted(pairs)
+
+
+def parse_reference(one_d_file, mask_arr):
+    '''
+    Similarity matrices as parsed with np.loadtxt and a search of the mask
+    coordinates for each edge
+    '''
+    
+    import scipy.sparse as sparse
+    
+    graph_arr = np.loadtxt(one_d_file, skiprows=6)
+    ijk1 = graph_arr[:, 2:5].astype('int32')
+    ijk2 = graph_arr[:, 5:8].astype('int32')
+    w_arr = graph_arr[:,-1].astype('float32')
+    b_arr = np.ones(w_arr.shape)
+    
+    mask_idx = np.argwhere(mask_arr)
+    mask_voxs = mask_idx.shape[0]
+    i_arr = [ np.where((mask_idx == ijk).all(axis=1))[0][0] for ijk in ijk1 ]
+    j_arr = [ np.where((mask_idx == ijk).all(axis=1))[0][0] for ijk in ijk2 ]
+    
+    wmat = sparse.coo_matrix((w_arr, (i_arr, j_arr)), 
+                             shape=(mask_voxs, mask_voxs))
+    bmat = sparse.coo_matrix((b_arr, (i_arr, j_arr)), 
+                             shape=(mask_voxs, mask_voxs))
+    
+    return bmat + bmat.T, wmat + wmat.T
+
+
+@attr('centrality', 'afni', 'parse')
+def test_parse_and_return_mats():
+    print "testing parsing of a 1D graph dump against np.loadtxt"
+    
+    import shutil, tempfile
+    from CPAC.network_centrality.utils import parse_and_return_mats
+    
+    mask = np.random.RandomState(3).rand(5,6,4) > 0.4
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        one_d_file = os.path.join(tmp_dir, 'graph.1D')
+        write_graph_dump(one_d_file, mask)
+        ref_b, ref_w = parse_reference(one_d_file, mask)
+        
+        # Chunks smaller than a comment and blank line, and a last chunk 
+        # smaller than the others
+        for chunk_size in [1, 2, 10, 1000000]:
+            comp_b, comp_w = parse_and_return_mats(one_d_file, mask, 
+                                                   chunk_size=chunk_size)
+            eq_(comp_b.format, 'csr')
+            eq_(comp_w.format, 'csr')
+            eq_(comp_b.nnz, 2*23)
+            assert_equal(comp_b.toarray(), ref_b.toarray())
+            assert_equal(comp_w.toarray(), ref_w.toarray())
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@attr('centrality', 'afni', 'parse')
+def test_parse_and_return_mats_outside_mask():
+    print "testing parsing of a 1D graph dump with an edge outside the mask"
+    
+    import shutil, tempfile
+    from CPAC.network_centrality.utils import parse_and_return_mats
+    
+    mask = np.random.RandomState(3).rand(5,6,4) > 0.4
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        one_d_file = os.path.join(tmp_dir, 'graph.1D')
+        xyz, pairs = write_graph_dump(one_d_file, mask)
+        
+        # A voxel of the graph dropped from the mask
+        comp_mask = mask.copy()
+        comp_mask[tuple(xyz[pairs[0][0]])] = False
+        assert_raises(Exception, parse_and_return_mats, one_d_file, comp_mask)
+        
+        # A volume without some of the graph's voxels
+        ok_(max([ xyz[j][0] for i,j in pairs ]) >= 3)
+        assert_raises(Exception, parse_and_return_mats, one_d_file, mask[:3])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,4 +1,21 @@
+import numpy
 cimport numpy as np
+cimport cython
+from cython.parallel cimport prange, threadid
+
+# OpenMP thread settings, or a single thread when built without OpenMP (the
+# prange loops then run serially)
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    #else
+    static int omp_get_max_threads(void) { return 1; }
+    static void omp_set_num_threads(int nthreads) { (void)nthreads; }
+    #endif
+    """
+    int omp_get_max_threads() nogil
+    void c_omp_set_num_threads "omp_set_num_threads"(int nthreads) nogil
 
 
 ###
@@ -102,3 +119,343 @@ def centrality_both_double(np.ndarray[double, ndim=2] cmat, np.ndarray[double, n
         for j in xrange(cmat.shape[1]):
             cent_bin[i] += cmat[i,j]*(cmat[i,j] > thresh)
             cent_wt[i]  += 1.0*(cmat[i,j] > thresh)
+
+
+###
+# Fused Threshold and Sum (Degree Centrality)
+# - one pass over the matrix for the binarized, weighted and (optionally)
+#   transformed weighted degree, parallelized over rows with OpenMP
+###
+
+# Sets the OpenMP default number of threads, used by the kernels below when
+# they are called with nthreads <= 0
+def omp_set_num_threads(int nthreads):
+    c_omp_set_num_threads(nthreads)
+
+# Pass an empty cent_tr to skip the transformed weighted degree
+# nthreads <= 0 uses the OpenMP default (e.g. OMP_NUM_THREADS)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_fused_float(float[:, ::1] cmat, float[::1] cent_bin, float[::1] cent_wt, float[::1] cent_tr, float thresh, int nthreads=0):
+    cdef Py_ssize_t i,j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef bint transform = cent_tr.shape[0] > 0
+    cdef double sum_bin, sum_wt, sum_tr
+    cdef float val
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        sum_bin = 0
+        sum_wt  = 0
+        sum_tr  = 0
+        for j in range(ncols):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+                sum_tr  = sum_tr + (1.0+val)/2.0
+        cent_bin[i] += sum_bin
+        cent_wt[i]  += sum_wt
+        if transform:
+            cent_tr[i] += sum_tr
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_fused_double(double[:, ::1] cmat, double[::1] cent_bin, double[::1] cent_wt, double[::1] cent_tr, double thresh, int nthreads=0):
+    cdef Py_ssize_t i,j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef bint transform = cent_tr.shape[0] > 0
+    cdef double sum_bin, sum_wt, sum_tr
+    cdef double val
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        sum_bin = 0
+        sum_wt  = 0
+        sum_tr  = 0
+        for j in range(ncols):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+                sum_tr  = sum_tr + (1.0+val)/2.0
+        cent_bin[i] += sum_bin
+        cent_wt[i]  += sum_wt
+        if transform:
+            cent_tr[i] += sum_tr
+
+
+# cmat is an upper-triangle strip of the correlation matrix: rows n:m against
+# columns n:nvoxs, with cent_bin/cent_wt the outputs for voxels n:nvoxs. The
+# leading (m-n) x (m-n) tile is the diagonal block and only counts towards
+# its rows. The remaining tile is counted towards both its rows and (by
+# symmetry) its columns. Column sums are kept per thread and reduced after.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_upper_float(float[:, ::1] cmat, float[::1] cent_bin, float[::1] cent_wt, float thresh, int nthreads=0):
+    cdef Py_ssize_t i,j,t,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double sum_bin, sum_wt
+    cdef float val
+    cdef double[:, ::1] col_bin, col_wt
+    if nrows > ncols or cent_bin.shape[0] != ncols or cent_wt.shape[0] != ncols:
+        raise ValueError("cmat must be an upper-triangle strip matching the outputs")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    col_bin = numpy.zeros((nthreads, ncols), dtype=numpy.float64)
+    col_wt  = numpy.zeros((nthreads, ncols), dtype=numpy.float64)
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        tid     = threadid()
+        sum_bin = 0
+        sum_wt  = 0
+        for j in range(nrows):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+        for j in range(nrows, ncols):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+                col_bin[tid,j] += 1.0
+                col_wt[tid,j]  += val
+        cent_bin[i] += sum_bin
+        cent_wt[i]  += sum_wt
+    for j in prange(nrows, ncols, nogil=True, schedule='static', num_threads=nthreads):
+        sum_bin = 0
+        sum_wt  = 0
+        for t in range(nthreads):
+            sum_bin = sum_bin + col_bin[t,j]
+            sum_wt  = sum_wt + col_wt[t,j]
+        cent_bin[j] += sum_bin
+        cent_wt[j]  += sum_wt
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_upper_double(double[:, ::1] cmat, double[::1] cent_bin, double[::1] cent_wt, double thresh, int nthreads=0):
+    cdef Py_ssize_t i,j,t,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double sum_bin, sum_wt
+    cdef double val
+    cdef double[:, ::1] col_bin, col_wt
+    if nrows > ncols or cent_bin.shape[0] != ncols or cent_wt.shape[0] != ncols:
+        raise ValueError("cmat must be an upper-triangle strip matching the outputs")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    col_bin = numpy.zeros((nthreads, ncols), dtype=numpy.float64)
+    col_wt  = numpy.zeros((nthreads, ncols), dtype=numpy.float64)
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        tid     = threadid()
+        sum_bin = 0
+        sum_wt  = 0
+        for j in range(nrows):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+        for j in range(nrows, ncols):
+            val = cmat[i,j]
+            if val > thresh:
+                sum_bin = sum_bin + 1.0
+                sum_wt  = sum_wt + val
+                col_bin[tid,j] += 1.0
+                col_wt[tid,j]  += val
+        cent_bin[i] += sum_bin
+        cent_wt[i]  += sum_wt
+    for j in prange(nrows, ncols, nogil=True, schedule='static', num_threads=nthreads):
+        sum_bin = 0
+        sum_wt  = 0
+        for t in range(nthreads):
+            sum_bin = sum_bin + col_bin[t,j]
+            sum_wt  = sum_wt + col_wt[t,j]
+        cent_bin[j] += sum_bin
+        cent_wt[j]  += sum_wt
+
+
+###
+# Multi-Threshold Degree Centrality
+# - binarized and weighted degree at several thresholds in one pass
+###
+
+# thresh holds the thresholds sorted in ascending order, and row i of 
+# cent_bin/cent_wt receives the degree of row i of cmat at each of them.
+# Each value is binned by the number of thresholds it exceeds (binary 
+# search), then the bins of a row are summed from the top down. The bins are
+# kept per thread.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_multi_float(float[:, ::1] cmat, double[::1] thresh, float[:, ::1] cent_bin, float[:, ::1] cent_wt, int nthreads=0):
+    cdef Py_ssize_t i,j,k,lo,hi,mid,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef Py_ssize_t nthr = thresh.shape[0]
+    cdef double sum_bin, sum_wt
+    cdef float val
+    cdef double[:, ::1] bins_bin, bins_wt
+    if cent_bin.shape[0] != nrows or cent_bin.shape[1] != nthr or \
+       cent_wt.shape[0] != nrows or cent_wt.shape[1] != nthr:
+        raise ValueError("outputs must have shape (nrows, nthresholds)")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    bins_bin = numpy.zeros((nthreads, nthr+1), dtype=numpy.float64)
+    bins_wt  = numpy.zeros((nthreads, nthr+1), dtype=numpy.float64)
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        tid = threadid()
+        for k in range(nthr+1):
+            bins_bin[tid,k] = 0
+            bins_wt[tid,k]  = 0
+        for j in range(ncols):
+            val = cmat[i,j]
+            # number of thresholds below val
+            lo = 0
+            hi = nthr
+            while lo < hi:
+                mid = (lo + hi) / 2
+                if thresh[mid] < val:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            bins_bin[tid,lo] += 1.0
+            bins_wt[tid,lo]  += val
+        sum_bin = 0
+        sum_wt  = 0
+        for k in range(nthr, 0, -1):
+            sum_bin = sum_bin + bins_bin[tid,k]
+            sum_wt  = sum_wt + bins_wt[tid,k]
+            cent_bin[i,k-1] += sum_bin
+            cent_wt[i,k-1]  += sum_wt
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_multi_double(double[:, ::1] cmat, double[::1] thresh, double[:, ::1] cent_bin, double[:, ::1] cent_wt, int nthreads=0):
+    cdef Py_ssize_t i,j,k,lo,hi,mid,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef Py_ssize_t nthr = thresh.shape[0]
+    cdef double sum_bin, sum_wt
+    cdef double val
+    cdef double[:, ::1] bins_bin, bins_wt
+    if cent_bin.shape[0] != nrows or cent_bin.shape[1] != nthr or \
+       cent_wt.shape[0] != nrows or cent_wt.shape[1] != nthr:
+        raise ValueError("outputs must have shape (nrows, nthresholds)")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    bins_bin = numpy.zeros((nthreads, nthr+1), dtype=numpy.float64)
+    bins_wt  = numpy.zeros((nthreads, nthr+1), dtype=numpy.float64)
+    for i in prange(nrows, nogil=True, schedule='static', num_threads=nthreads):
+        tid = threadid()
+        for k in range(nthr+1):
+            bins_bin[tid,k] = 0
+            bins_wt[tid,k]  = 0
+        for j in range(ncols):
+            val = cmat[i,j]
+            # number of thresholds below val
+            lo = 0
+            hi = nthr
+            while lo < hi:
+                mid = (lo + hi) / 2
+                if thresh[mid] < val:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            bins_bin[tid,lo] += 1.0
+            bins_wt[tid,lo]  += val
+        sum_bin = 0
+        sum_wt  = 0
+        for k in range(nthr, 0, -1):
+            sum_bin = sum_bin + bins_bin[tid,k]
+            sum_wt  = sum_wt + bins_wt[tid,k]
+            cent_bin[i,k-1] += sum_bin
+            cent_wt[i,k-1]  += sum_wt
+
+
+###
+# Local Functional Connectivity Density (lFCD)
+# - flood fill from each seed through its neighbours (CSR adjacency of the
+#   mask) whose correlation with the seed is above threshold
+###
+
+# Each row i of cmat is the correlation of seed voxel (offset + i) with every
+# voxel in the mask. Seeds are split across OpenMP threads, each thread
+# keeping its own queue and visited stamps (no clearing between seeds).
+# Seeds with no suprathreshold neighbours get an lFCD of 1.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lfcd_flood_float(float[:, ::1] cmat, int[::1] indptr, int[::1] indices, Py_ssize_t offset, float[::1] lfcd_bin, float[::1] lfcd_wt, float thresh, int nthreads=0):
+    cdef Py_ssize_t i,p,v,u,seed,head,tail,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], nvoxs = cmat.shape[1]
+    cdef double sum_wt
+    cdef int[:, ::1] queue
+    cdef Py_ssize_t[:, ::1] visited
+    if indptr.shape[0] != nvoxs+1 or offset+nrows > nvoxs:
+        raise ValueError("cmat, the neighbour graph and offset do not match")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    queue   = numpy.empty((nthreads, nvoxs), dtype=numpy.intc)
+    visited = numpy.zeros((nthreads, nvoxs), dtype=numpy.intp)
+    for i in prange(nrows, nogil=True, schedule='dynamic', num_threads=nthreads):
+        tid  = threadid()
+        seed = offset + i
+        tail = 0
+        if cmat[i,seed] > thresh:
+            head = 0
+            tail = 1
+            queue[tid,0] = seed
+            visited[tid,seed] = i+1
+            sum_wt = cmat[i,seed]
+            while head < tail:
+                v    = queue[tid,head]
+                head = head + 1
+                for p in range(indptr[v], indptr[v+1]):
+                    u = indices[p]
+                    if visited[tid,u] != i+1 and cmat[i,u] > thresh:
+                        visited[tid,u] = i+1
+                        queue[tid,tail] = u
+                        tail   = tail + 1
+                        sum_wt = sum_wt + cmat[i,u]
+        if tail > 1:
+            lfcd_bin[i] = tail
+            lfcd_wt[i]  = sum_wt
+        else:
+            lfcd_bin[i] = 1
+            lfcd_wt[i]  = 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lfcd_flood_double(double[:, ::1] cmat, int[::1] indptr, int[::1] indices, Py_ssize_t offset, double[::1] lfcd_bin, double[::1] lfcd_wt, double thresh, int nthreads=0):
+    cdef Py_ssize_t i,p,v,u,seed,head,tail,tid
+    cdef Py_ssize_t nrows = cmat.shape[0], nvoxs = cmat.shape[1]
+    cdef double sum_wt
+    cdef int[:, ::1] queue
+    cdef Py_ssize_t[:, ::1] visited
+    if indptr.shape[0] != nvoxs+1 or offset+nrows > nvoxs:
+        raise ValueError("cmat, the neighbour graph and offset do not match")
+    if nthreads <= 0:
+        nthreads = omp_get_max_threads()
+    queue   = numpy.empty((nthreads, nvoxs), dtype=numpy.intc)
+    visited = numpy.zeros((nthreads, nvoxs), dtype=numpy.intp)
+    for i in prange(nrows, nogil=True, schedule='dynamic', num_threads=nthreads):
+        tid  = threadid()
+        seed = offset + i
+        tail = 0
+        if cmat[i,seed] > thresh:
+            head = 0
+            tail = 1
+            queue[tid,0] = seed
+            visited[tid,seed] = i+1
+            sum_wt = cmat[i,seed]
+            while head < tail:
+                v    = queue[tid,head]
+                head = head + 1
+                for p in range(indptr[v], indptr[v+1]):
+                    u = indices[p]
+                    if visited[tid,u] != i+1 and cmat[i,u] > thresh:
+                        visited[tid,u] = i+1
+                        queue[tid,tail] = u
+                        tail   = tail + 1
+                        sum_wt = sum_wt + cmat[i,u]
+        if tail > 1:
+            lfcd_bin[i] = tail
+            lfcd_wt[i]  = sum_wt
+        else:
+            lfcd_bin[i] = 1
+            lfcd_wt[i]  = 1
@@ -8,7 +8,8 @@ Network centrality utilities
 
 # Method to return recommended block size based on memory restrictions 
 def calc_blocksize(timeseries, memory_allocated=None, 
-                   include_full_matrix=False, sparsity_thresh=0.0):
+                   include_full_matrix=False, sparsity_thresh=0.0,
+                   probe=False):
     '''
     Method to calculate blocksize to calculate correlation matrix
     as per the memory allocated by the user. By default, the block
@@ -20,6 +21,12 @@ def calc_blocksize(timeseries, memory_allocated=None,
     map. That is how many correlation maps can we calculate simultaneously 
     in memory?
 
+    If probe is set, blocks of increasing size are run on the data (see
+    probe_blocksize), and the block size with the best throughput under
+    the memory limit is used instead. The peak memory the probe blocks
+    were observed to take is checked against the model, and the limit is
+    tightened if the model underestimates it.
+
     Parameters
     ----------
     timeseries : numpy array
@@ -34,6 +41,10 @@ def calc_blocksize(timeseries, memory_allocated=None,
         a number between 0 and 1 that represents the number of
         connections to keep during sparsity thresholding.
         Default is 0.0.
+    probe : boolean
+        Boolean indicating if the block size should be picked by timing
+        blocks of the data, rather than by memory alone.
+        Default is False
 
     Returns
     -------
@@ -66,34 +77,21 @@ def calc_blocksize(timeseries, memory_allocated=None,
     needed_memory = memory_for_timeseries + \
                     memory_for_output + \
                     memory_for_full_matrix
+    # Sparsity thresholding holds a histogram (2**20 int64 bins) throughout
+    if sparsity_thresh:
+        needed_memory += 8 * 2**20
+
+    # Memory for each row (seed voxel) of a block; if we're doing sparsity
+    # thresholding, each row also needs its bin index (int32), mask (bool)
+    # and weighted copy
+    if sparsity_thresh:
+        memory_per_row = nvoxs*(2*nbytes + 5)
+    else:
+        memory_per_row = nvoxs*nbytes
 
     if memory_allocated:
         available_memory = memory_allocated * 1024.0**3  # assume it is in GB
-        ## memory_for_block = # of seed voxels * nvoxs * nbytes
-        block_size = int( (available_memory - needed_memory)/(nvoxs*nbytes) )
-        # If we're doing degree/sparisty thresholding, calculate block_size
-        if sparsity_thresh:
-            # k - block_size, v - nvoxs, d - nbytes, m - memory_allocated
-            # Polynomial for sparsity algorithm memory usage
-            # Solve for k: (-d/2 - 20.5)*k^2 + (41*v + d*v -d/2 - 20.5)*k - m = 0
-            coeffs = np.zeros(3)
-            coeffs[0] = -nbytes/2 - 20.5
-            coeffs[1] = 41*nvoxs + nbytes*nvoxs - nbytes/2 - 20.5
-            coeffs[2] = -(available_memory - needed_memory)
-            roots = np.roots(coeffs)
-            # If roots are complex, then the block_size needed to occupy all of
-            # the available memory is bigger than the number of voxels.
-            # So set block_size = nvoxs
-            if np.iscomplex(roots[0]):
-                block_size = nvoxs
-            # If the roots are real, test the roots for condition
-            else:
-                root = roots[np.where(roots <= nvoxs)]
-                root = root[np.where(root > 0)]
-                if len(root) == 1:
-                    block_size = np.floor(root[0])
-                else:
-                    block_size = 1000
+        block_size = int( (available_memory - needed_memory)/memory_per_row )
 
     # Test if calculated block size is beyond max/min limits
     if block_size > nvoxs:
@@ -103,23 +101,29 @@ def calc_blocksize(timeseries, memory_allocated=None,
         raise MemoryError('Not enough memory available to perform degree '\
                           'centrality. Need a minimum of %.2fGB' % memory_usage)
 
+    # Time blocks up to the memory limit (or all voxels, if there's no
+    # limit) and take the fastest, after correcting the memory model
+    if probe:
+        max_block_size = block_size if memory_allocated else nvoxs
+        probe_size, memory_ratio = \
+            probe_blocksize(timeseries, max_block_size,
+                            sparsity_thresh=sparsity_thresh)
+        # Tighten the limit if the blocks took more memory than modeled,
+        # beyond the noise of measuring it
+        if memory_allocated and memory_ratio > 1.1:
+            memory_per_row = memory_per_row*memory_ratio
+            max_block_size = int( (available_memory - needed_memory)/\
+                                  memory_per_row )
+            logger.info('memory model underestimates blocks by %.2fx; '\
+                        'limiting blocks to %i voxels' \
+                        % (memory_ratio, max(max_block_size, 1)))
+        block_size = max(min(probe_size, max_block_size), 1)
+
     # Convert block_size to an integer before returning
     block_size = int(block_size)
 
     # Return memory usage and block size
-    if sparsity_thresh:
-        # Calculate RAM usage by blocking algorithm
-        m = (-nbytes/2 - 20.5)*block_size**2 + \
-            (41*nvoxs + nbytes*nvoxs - nbytes/2 - 20.5)*block_size
-        # Calculate RAM usage by sparse matrix at end
-        max_conns = nvoxs**2-nvoxs
-        # Max number of connections * i + j (32-bit ints) + w
-        m2 = np.round(max_conns*sparsity_thresh)*(4 + 4 + nbytes)
-        if m2 > m:
-            m = m2
-        memory_usage = (needed_memory + m)/1024.0**3
-    else:
-        memory_usage = (needed_memory + block_size*nvoxs*nbytes)/1024.0**3
+    memory_usage = (needed_memory + block_size*memory_per_row)/1024.0**3
 
     # Log information
     logger.info('block_size -> %i voxels' % block_size)
@@ -129,6 +133,256 @@ def calc_blocksize(timeseries, memory_allocated=None,
     return block_size
 
 
+# Method to pick the block size with the best block throughput
+def probe_blocksize(timeseries, max_block_size, min_block_size=256,
+                    probe_voxs=8192, tolerance=0.05, sparsity_thresh=0.0,
+                    r_value=0.0):
+    '''
+    Method to time one iteration of the centrality block loop (the
+    correlation of a block of rows, then its thresholding and sums), for
+    block sizes doubling from min_block_size up to max_block_size, and
+    return the block size with the best throughput. The smallest block
+    size within tolerance of the best is taken, since it uses the least
+    memory.
+
+    With sparsity_thresh, the iteration is that of sparsity thresholding:
+    the bin index, kept mask, weighted copy and cutoff bin coordinates of
+    the block, against a cutoff bin found from the smallest block.
+    Otherwise it is degree centrality thresholded at r_value.
+
+    The peak memory of the iteration is also measured (see
+    get_peak_memory), to check the per-row memory model of
+    calc_blocksize against what the blocks actually take.
+
+    Parameters
+    ----------
+    timeseries : numpy array
+       timeseries data: `nvoxs` x `ntpts`
+    max_block_size : integer
+        largest block size to try
+    min_block_size : integer (optional)
+        smallest block size to try
+    probe_voxs : integer (optional)
+        number of voxels to correlate each probe block against, if more
+        than max_block_size
+    tolerance : float (optional)
+        fraction of the best throughput a smaller block size may lose
+    sparsity_thresh : float (optional)
+        fraction of connections to keep, or 0.0 for correlation
+        thresholding
+    r_value : float (optional)
+        correlation threshold, without sparsity_thresh
+
+    Returns
+    -------
+    block_size : integer
+        block size with the best throughput
+    memory_ratio : float
+        observed over modeled memory of the largest probe block, or 1.0 if
+        the peak memory could not be measured
+    '''
+
+    # Import packages
+    import time
+    import numpy as np
+    from nipype import logging
+    from CPAC.cwas.subdist import norm_cols
+    from CPAC.network_centrality import core
+
+    # Init variables
+    logger = logging.getLogger('workflow')
+    nvoxs, ntpts = timeseries.shape
+    nbytes = timeseries.dtype.itemsize
+    nbins = 2**20
+
+    # The probe blocks are rows of the correlation matrix of the first
+    # voxels (at least as many as the largest block)
+    ncols = min(nvoxs, max(probe_voxs, max_block_size))
+    ts_normd = norm_cols(timeseries[:ncols].T).astype(timeseries.dtype)
+    out_binarize = np.zeros(ncols, dtype=timeseries.dtype)
+    out_weighted = np.zeros(ncols, dtype=timeseries.dtype)
+
+    # Block sizes doubling up to the maximum
+    block_sizes = []
+    size = min(min_block_size, max_block_size)
+    while size < max_block_size:
+        block_sizes.append(size)
+        size *= 2
+    block_sizes.append(max_block_size)
+
+    # Cutoff bin for the sparsity of the smallest block
+    if sparsity_thresh:
+        size = block_sizes[0]
+        acc = core.sparsity_accumulator(ncols, sparsity_thresh)
+        acc['sparse_num'] = int(sparsity_thresh*(size*ncols - 
+                                                 size*(size+1)//2))
+        core.sparsity_cutoffs(ts_normd, [(0, size)], [acc], nbins=nbins)
+
+    # One iteration of the block loop, as in get_centrality_multi
+    def run_block(m):
+        rmat_strip = core.correlation_block(ts_normd, 0, m)[1]
+        if sparsity_thresh:
+            acc['bnd'] = ([], [], [])
+            idx = core.quantize_upper(rmat_strip, nbins)
+            keep = core.sparsity_keep_block(acc, idx, rmat_strip, 0,
+                                            out_binarize=out_binarize,
+                                            out_weighted=out_weighted)
+            del idx, keep
+        else:
+            core.degree_centrality_upper(rmat_strip, r_value, out_binarize,
+                                         out_weighted)
+        del rmat_strip
+
+    # Time each block size, taking the best of a few runs
+    throughput = []
+    memory_ratio = 1.0
+    for size in block_sizes:
+        elapsed = np.inf
+        for rep in range(3):
+            start = time.time()
+            # Freed blocks may be reused by later runs, so only the first
+            # run's memory is telling
+            if rep == 0:
+                observed = get_peak_memory(run_block, size)
+            else:
+                run_block(size)
+            elapsed = min(elapsed, time.time() - start)
+        gflops = 2.0*size*ncols*ntpts/max(elapsed, 1e-9)/1e9
+        throughput.append(gflops)
+
+        # Observed against modeled memory of the block, with the per-row
+        # model of calc_blocksize
+        if sparsity_thresh:
+            modeled = size*ncols*(2*nbytes + 5)
+        else:
+            modeled = size*ncols*nbytes
+        if observed is not None and modeled >= 2**20:
+            memory_ratio = float(observed)/modeled
+            logger.info('probe block %i -> %.2f GFLOP/s, predicted %.1fMB, '\
+                        'observed %.1fMB' % (size, gflops, modeled/1024.0**2,
+                                              observed/1024.0**2))
+        else:
+            logger.info('probe block %i -> %.2f GFLOP/s' % (size, gflops))
+
+    # Smallest block size within tolerance of the best throughput
+    best = max(throughput)
+    for size, gflops in zip(block_sizes, throughput):
+        if gflops >= (1 - tolerance)*best:
+            break
+
+    # Return the block size and memory ratio
+    return size, max(memory_ratio, 0.0)
+
+
+# Method to return the peak memory taken by a function call
+def get_peak_memory(func, *args):
+    '''
+    Method to call a function and return the peak memory it took, above
+    the memory in use when it was called.
+
+    Allocations are traced with tracemalloc, where numpy reports its
+    arrays to it (Python 3). Otherwise, on Linux, the peak resident
+    memory of the process is reset before the call and read after it, so
+    the peak reported by get_memory_usage then starts from the call.
+
+    Parameters
+    ----------
+    func : function
+        function to call
+    args : arguments (optional)
+        arguments to call func with
+
+    Returns
+    -------
+    peak : integer
+        peak memory in bytes, or None if it can't be measured on this
+        platform
+    '''
+
+    # Import packages
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    # Trace the allocations of the call, unless something else is already
+    # tracing them
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        try:
+            current = tracemalloc.get_traced_memory()[0]
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return peak - current
+
+    # Otherwise return the free heap to the system (glibc), so the call
+    # can't reuse freed memory that is still resident, then reset the peak
+    # resident memory (Linux 4.0+) to the current resident memory
+    try:
+        import ctypes
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    rss = get_memory_usage()
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        rss = None
+    func(*args)
+    if rss is None:
+        return None
+
+    # Peak resident memory from procfs
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return max(int(line.split()[1])*1024 - rss, 0)
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+# Method to return the resident memory of this process
+def get_memory_usage(peak=False):
+    '''
+    Method to return the resident set size (RSS) of this process
+
+    Parameters
+    ----------
+    peak : boolean (optional)
+        return the peak RSS over the life of the process, rather than
+        the current RSS
+
+    Returns
+    -------
+    rss : integer
+        resident memory in bytes, or None if the current RSS can't be read
+        on this platform
+    '''
+
+    # Import packages
+    import resource
+    import sys
+
+    # Peak resident memory is in bytes on OS X, and kilobytes elsewhere
+    if peak:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return max_rss
+        return max_rss*1024
+
+    # Current resident memory from procfs
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1])*resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
 # Method to calculate correlation coefficient from (one or two) datasets
 def calc_corrcoef(X, Y=None):
     '''
@@ -199,6 +453,44 @@ def cluster_data(img, thr, xyz_a, k=26):
     return lbl_img
 
 
+def calc_neighbor_graph(xyz, k=26):
+    '''
+    Method to build the voxel adjacency of a mask once, for use by the
+    lFCD flood fill
+
+    Parameters
+    ----------
+    xyz : ndarray (int)
+        array of shape (nvoxs, 3); grid coordinates of the voxels in the
+        mask, ordered as the columns of the timeseries
+    k : integer (optional); default=26
+        neighboring system, equal to 6, 18, or 26
+
+    Returns
+    -------
+    neighbors : scipy.sparse.csr_matrix
+        (nvoxs x nvoxs) sparse matrix, where the column indices of row i
+        are the neighbours of voxel i
+    '''
+
+    # Import packages
+    from scipy.sparse import csr_matrix
+    import numpy as np
+
+    nvoxs = xyz.shape[0]
+    edges = graph_3d_grid(xyz, k=k)
+    if edges is None:
+        i = j = np.array([], dtype=np.int32)
+    else:
+        i, j = edges[0], edges[1]
+    neighbors = csr_matrix((np.ones(len(i), dtype=np.int8), (i, j)),
+                           shape=(nvoxs, nvoxs))
+    neighbors.sum_duplicates()
+    neighbors.sort_indices()
+
+    return neighbors
+
+
 # Convert probability threshold value to correlation threshold
 def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     '''
@@ -221,18 +513,17 @@ def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     '''
 
     # Import packages
-    import nibabel as nb
     import numpy as np
     import scipy.stats
+    from CPAC.utils.utils import get_nifti_header_info
 
     # Init variables
     # Get two-tailed distribution
     if two_tailed:
         p_value = p_value/2
 
-    # Load in data and number of time pts
-    img = nb.load(datafile).get_data()
-    t_pts = img.shape[-1]
+    # Number of time pts from the image header
+    t_pts = get_nifti_header_info(datafile)['shape'][-1]
 
     # N-2 degrees of freedom with Pearson correlation (two sample means)
     deg_freedom = t_pts-2
@@ -332,7 +623,8 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
     Parameters
     ----------
     centrality_matrix : tuple (string, array_like)
-        tuple containing matrix name and degree/eigenvector centrality matrix
+        tuple containing matrix name and degree/eigenvector centrality matrix;
+        a 2D matrix (nvoxs x nvols) is mapped to a 4D image
     aff : ndarray
         Affine matrix of the input data
     mask : ndarray
@@ -363,17 +655,15 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
         out_file, matrix = centrality_matrix
 
         out_file = os.path.join(os.getcwd(), out_file + '.nii.gz')
-        sparse_m = np.zeros((mask.shape), dtype=float)
+        if getattr(matrix, 'ndim', 1) == 2:
+            sparse_m = np.zeros(mask.shape + matrix.shape[1:], dtype=float)
+        else:
+            sparse_m = np.zeros((mask.shape), dtype=float)
 
         logger.info('mapping centrality matrix to nifti image: %s' % out_file)
 
         if int(template_type) == 0:
-            cords = np.argwhere(mask)
-            index=0
-            for val in cords:
-                x,y,z=val
-                sparse_m[x,y,z]= matrix[index]
-                index+=1
+            sparse_m[mask.astype('bool')] = matrix
 
         elif int(template_type) == 1:
             nodes = np.unique(mask).tolist()
@@ -400,6 +690,44 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
         raise Exception(err_msg)
 
 
+# Method to limit the threads used by BLAS and the centrality kernels
+def set_num_threads(num_threads):
+    '''
+    Method to limit the number of threads used by BLAS and by the OpenMP
+    centrality kernels in this process, e.g. in each worker of a pool
+
+    The environment variables only reach libraries that have not been
+    loaded yet (and subprocesses, such as AFNI), so MKL and the OpenMP
+    kernels are also set directly, and any other BLAS via threadpoolctl
+    if it is installed.
+
+    Parameters
+    ----------
+    num_threads : integer
+        the number of threads
+    '''
+
+    # Import packages
+    import os
+    from CPAC.network_centrality.thresh_and_sum import omp_set_num_threads
+
+    for env_var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']:
+        os.environ[env_var] = str(num_threads)
+    omp_set_num_threads(num_threads)
+
+    try:
+        import mkl
+        mkl.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(num_threads)
+    except ImportError:
+        pass
+
+
 # Function to actually do the list merging
 def merge_lists(deg_list=[],eig_list=[],lfcd_list=[]):
     merged_list = []
@@ -447,11 +775,32 @@ def sep_nifti_subbriks(nifti_file, out_names):
 
 
 # Calculate eigenvector centrality from one_d file
-def parse_and_return_mats(one_d_file, mask_arr):
+def parse_and_return_mats(one_d_file, mask_arr, chunk_size=1000000):
     '''
+    Function to parse a 1D graph dump from AFNI's 3dDegreeCentrality or
+    3dECM into binarized and weighted similarity matrices. The file is
+    streamed in chunks of lines, and each edge's ijk coordinates are mapped
+    to its mask index through a lookup array of the raveled volume.
+
+    Parameters
+    ----------
+    one_d_file : string
+        filepath to the 1D graph dump
+    mask_arr : ndarray
+        3D mask array the graph was computed over
+    chunk_size : integer (optional)
+        number of lines to parse at a time
+
+    Returns
+    -------
+    b_similarity_matrix : scipy.sparse.csr_matrix
+        symmetric binarized similarity matrix
+    w_similarity_matrix : scipy.sparse.csr_matrix
+        symmetric weighted similarity matrix
     '''
 
     # Import packages
+    import itertools
     import numpy as np
     import scipy.sparse as sparse
     from nipype import logging
@@ -459,48 +808,70 @@ def parse_and_return_mats(one_d_file, mask_arr):
     # Init logger
     logger = logging.getLogger('workflow')
 
-    # Parse out numbers
+    # Lookup of mask index from raveled voxel index, -1 outside the mask
+    mask_shape = mask_arr.shape
+    mask_flat = np.flatnonzero(mask_arr)
+    mask_voxs = mask_flat.shape[0]
+    lookup = -np.ones(np.prod(mask_shape), dtype='int32')
+    lookup[mask_flat] = np.arange(mask_voxs, dtype='int32')
+
+    def ijk_to_idx(ijk):
+        if (ijk < 0).any() or (ijk >= mask_shape).any():
+            raise Exception('Voxel coordinates in %s are outside of the ' \
+                            'mask' % one_d_file)
+        idx = lookup[np.ravel_multi_index(ijk.T, mask_shape)]
+        if (idx < 0).any():
+            raise Exception('Voxel coordinates in %s are not in the mask' \
+                            % one_d_file)
+        return idx
+
+    # Stream the edges in chunks of lines
     logger.info('Parsing contents...')
-    graph_arr = np.loadtxt(one_d_file, skiprows=6)
-
-    # Cast as numpy arrays and extract i, j, w
+    i_list = []
+    j_list = []
+    w_list = []
+    with open(one_d_file, 'r') as one_d:
+        lines = itertools.islice(one_d, 6, None)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            # Skip blank and comment lines, as np.loadtxt does
+            chunk = [line for line in chunk
+                     if line.strip() and not line.lstrip().startswith('#')]
+            if not chunk:
+                continue
+            ncols = len(chunk[0].split())
+            graph_arr = np.fromstring(''.join(chunk), sep=' ')
+            del chunk
+            graph_arr = graph_arr.reshape(-1, ncols)
+
+            # Extract 3d indices and weights
+            i_list.append(ijk_to_idx(graph_arr[:, 2:5].astype('int64')))
+            j_list.append(ijk_to_idx(graph_arr[:, 5:8].astype('int64')))
+            w_list.append(graph_arr[:, -1].astype('float32'))
+            del graph_arr
+
+    # Cast as numpy arrays of i, j, w
     logger.info('Creating arrays...')
-    one_d_rows = graph_arr.shape[0]
-
-    # Extract 3d indices
-    ijk1 = graph_arr[:, 2:5].astype('int32')
-    ijk2 = graph_arr[:, 5:8].astype('int32')
-    # Weighted array and binarized array
-    w_arr = graph_arr[:,-1].astype('float32')
-    del graph_arr
-    b_arr = np.ones(w_arr.shape)
+    i_arr = np.concatenate(i_list) if i_list else np.zeros(0, 'int32')
+    j_arr = np.concatenate(j_list) if j_list else np.zeros(0, 'int32')
+    w_arr = np.concatenate(w_list) if w_list else np.zeros(0, 'float32')
+    del i_list, j_list, w_list
 
-    # Non-zero elements from mask is size of similarity matrix
-    mask_idx = np.argwhere(mask_arr)
-    mask_voxs = mask_idx.shape[0]
-
-    # Extract the ijw's from 1D file
-    i_arr = [np.where((mask_idx == ijk1[ii]).all(axis=1))[0][0] \
-             for ii in range(one_d_rows)]
-    del ijk1
-    j_arr = [np.where((mask_idx == ijk2[ii]).all(axis=1))[0][0] \
-             for ii in range(one_d_rows)]
-    del ijk2
-    i_arr = np.array(i_arr, dtype='int32')
-    j_arr = np.array(j_arr, dtype='int32')
-
-    # Construct the sparse matrix
+    # Construct the symmetric sparse matrices from both triangles
     logger.info('Constructing sparse matrix...')
-    wmat_upper_tri = sparse.coo_matrix((w_arr, (i_arr, j_arr)),
-                                       shape=(mask_voxs, mask_voxs))
-    bmat_upper_tri = sparse.coo_matrix((b_arr, (i_arr, j_arr)),
-                                       shape=(mask_voxs, mask_voxs))
-
-    # Make symmetric
-    w_similarity_matrix = wmat_upper_tri + wmat_upper_tri.T
-    b_similarity_matrix = bmat_upper_tri + bmat_upper_tri.T
+    rows = np.concatenate([i_arr, j_arr])
+    cols = np.concatenate([j_arr, i_arr])
+    del i_arr, j_arr
+    w_arr = np.concatenate([w_arr, w_arr])
+    b_arr = np.ones(w_arr.shape)
+    w_similarity_matrix = sparse.csr_matrix((w_arr, (rows, cols)),
+                                            shape=(mask_voxs, mask_voxs))
+    b_similarity_matrix = sparse.csr_matrix((b_arr, (rows, cols)),
+                                            shape=(mask_voxs, mask_voxs))
 
-    # Return the symmetric matrices and affine
+    # Return the symmetric matrices
     return b_similarity_matrix, w_similarity_matrix
 
 
@@ -55,6 +55,7 @@ from CPAC.timeseries import create_surface_registration, get_roi_timeseries, \
     get_voxel_timeseries, get_vertices_timeseries, \
     get_spatial_map_timeseries
 from CPAC.network_centrality import create_resting_state_graphs, \
+    create_multi_centrality_graphs, \
     get_cent_zscore
 from CPAC.utils.datasource import *
 from CPAC.utils import Configuration, create_all_qc
@@ -3703,18 +3704,15 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
                                  name='merge_node_%d' % num_strat)
 
             # Function to connect the CPAC centrality python workflow
-            # into pipeline
-            def connectCentralityWorkflow(methodOption,
-                                          thresholdOption,
-                                          threshold,
-                                          weightOptions,
-                                          mList):
+            # into pipeline, computing all of its measures from one sweep
+            # over the correlation matrix
+            def connectCentralityWorkflow(measures, mList):
 
                 # Create centrality workflow
                 network_centrality = \
-                    create_resting_state_graphs(
+                    create_multi_centrality_graphs(
                         wf_name='network_centrality_%d-%s' \
-                                % (num_strat, methodOption),
+                                % (num_strat, '_'.join([ m[0] for m in measures ])),
                         allocated_memory=c.memoryAllocatedForDegreeCentrality)
 
                 # Connect resampled (to template/mask resolution)
@@ -3724,14 +3722,9 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
                 # Subject mask/parcellation image
                 network_centrality.inputs.inputspec.template = \
                     c.templateSpecificationFile
-                # Give which method we're doing
-                network_centrality.inputs.inputspec.method_option = \
-                    methodOption
-                # Type of threshold
-                network_centrality.inputs.inputspec.threshold_option = \
-                    thresholdOption
-                # Connect threshold value (float)
-                network_centrality.inputs.inputspec.threshold = threshold
+                # Give which methods, with their type of threshold and
+                # threshold value (float)
+                network_centrality.inputs.inputspec.measures = measures
 
                 # Merge output with others via merge_node connection
                 workflow.connect(network_centrality,
@@ -3801,6 +3794,11 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
                                  merge_node,
                                  out_list)
 
+            # Measures (and their merge_node inputs) for the CPAC python 
+            # workflow, which are all calculated together
+            python_measures = []
+            python_mlists = []
+
             # Degree/eigen check
             if afni_centrality_found:
                 if c.degWeightOptions.count(True) > 0:
@@ -3815,18 +3813,16 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
             else:
                 # If we're calculating degree centrality
                 if c.degWeightOptions.count(True) > 0:
-                    connectCentralityWorkflow('degree',
-                                              c.degCorrelationThresholdOption,
-                                              c.degCorrelationThreshold,
-                                              c.degWeightOptions,
-                                              'deg_list')
+                    python_measures.append(('degree',
+                                            c.degCorrelationThresholdOption,
+                                            c.degCorrelationThreshold))
+                    python_mlists.append('deg_list')
                 # If we're calculating eigenvector centrality
                 if c.eigWeightOptions.count(True) > 0:
-                    connectCentralityWorkflow('eigenvector',
-                                              c.eigCorrelationThresholdOption,
-                                              c.eigCorrelationThreshold,
-                                              c.eigWeightOptions,
-                                              'eig_list')
+                    python_measures.append(('eigenvector',
+                                            c.eigCorrelationThresholdOption,
+                                            c.eigCorrelationThreshold))
+                    python_mlists.append('eig_list')
             # LFCD check
             if afni_lfcd_found:
                 # If we're calculating lFCD
@@ -3838,11 +3834,16 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
             else:
                 # If we're calculating lFCD
                 if c.lfcdWeightOptions.count(True) > 0:
-                    connectCentralityWorkflow('lfcd',
-                                              c.lfcdCorrelationThresholdOption,
-                                              c.lfcdCorrelationThreshold,
-                                              c.lfcdWeightOptions,
-                                              'lfcd_list')
+                    python_measures.append(('lfcd',
+                                            c.lfcdCorrelationThresholdOption,
+                                            c.lfcdCorrelationThreshold))
+                    python_mlists.append('lfcd_list')
+
+            # One CPAC python workflow for all of its measures; its outputs
+            # are in (degree, eigenvector, lfcd) order, so they go to the
+            # merge_node input of the first measure
+            if python_measures:
+                connectCentralityWorkflow(python_measures, python_mlists[0])
 
             # Update resource pool with centrality outputs
             try:
@@ -576,6 +576,7 @@ def gen_roi_timeseries(data_file, template, output_type):
     import numpy as np
     import os
     import shutil
+    from CPAC.utils.utils import parcel_mean_timeseries
 
     unit_data = nib.load(template).get_data()
     # Cast as rounded-up integer
@@ -589,7 +590,6 @@ def gen_roi_timeseries(data_file, template, output_type):
                         'Please check the voxel dimensions. '
                         'Data and roi should have the same shape.\n\n')
 
-    nodes = np.unique(unit_data).tolist()
     sorted_list = []
     node_dict = {}
     out_list = []
@@ -603,16 +603,14 @@ def gen_roi_timeseries(data_file, template, output_type):
     csv_file = os.path.abspath('roi_' + tmp_file + '.csv')
     numpy_file = os.path.abspath('roi_' + tmp_file + '.npz')
     
-    nodes.sort()
-    for n in nodes:
-        if n > 0:
-            node_array = img_data[unit_data == n]
-            node_str = 'node_{0}'.format(n)
-            avg = np.mean(node_array, axis=0)
-            avg = np.round(avg, 6)
-            list1 = [n] + avg.tolist()
-            sorted_list.append(list1)
-            node_dict[node_str] = avg.tolist()
+    # mean timeseries of all the nodes in one pass over the data
+    nodes, node_means = parcel_mean_timeseries(img_data, unit_data)
+    for n, avg in zip(nodes.tolist(), node_means):
+        node_str = 'node_{0}'.format(n)
+        avg = np.round(avg, 6)
+        list1 = [n] + avg.tolist()
+        sorted_list.append(list1)
+        node_dict[node_str] = avg.tolist()
 
     # writing to 1Dfile
     print("writing 1D file..")
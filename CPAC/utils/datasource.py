@@ -131,10 +131,10 @@ def check_for_s3(file_path, creds_path, dl_dir=None, img_type='anat'):
 
     # Import packages
     import os
-    import nibabel as nib
     import botocore.exceptions
 
     from indi_aws import fetch_creds
+    from CPAC.utils.utils import get_nifti_header_info
 
     # Init variables
     s3_str = 's3://'
@@ -193,7 +193,7 @@ def check_for_s3(file_path, creds_path, dl_dir=None, img_type='anat'):
     # Check image dimensionality
     if '.nii' in local_path:
         try:
-            img_nii = nib.load(local_path)
+            img_shape = get_nifti_header_info(local_path)['shape']
         except Exception as e:
             # TODO: come up with a better option for handling rogue S3 files
             # TODO: that Nibabel chokes on
@@ -201,15 +201,15 @@ def check_for_s3(file_path, creds_path, dl_dir=None, img_type='anat'):
             return local_path
 
         if img_type == 'anat':
-            if len(img_nii.shape) != 3:
+            if len(img_shape) != 3:
                 raise IOError('File: %s must be an anatomical image with 3 '\
                               'dimensions but %d dimensions found!'
-                              % (local_path, len(img_nii.shape)))
+                              % (local_path, len(img_shape)))
         elif img_type == 'func':
-            if len(img_nii.shape) != 4:
+            if len(img_shape) != 4:
                 raise IOError('File: %s must be a functional image with 4 '\
                               'dimensions but %d dimensions found!'
-                              % (local_path, len(img_nii.shape)))
+                              % (local_path, len(img_shape)))
         elif img_type == "other":
             pass
 
@@ -496,6 +496,123 @@ def safe_shape(*vol_data):
     return same_volume
 
 
+def parcel_mean_timeseries(img_data, labels, nodes=None, vox_mask=None,
+                           chunk_size=100):
+    """
+    Computes the mean timeseries of every parcel (label) of a label image in
+    one pass over the data, rather than one scan of the volume per label.
+    The voxels are gathered once and reduced with a sparse one-hot matrix of
+    their labels, in chunks of timepoints.
+
+    Parameters
+    ----------
+    img_data : ndarray
+        4D functional data (x, y, z, timepoints)
+    labels : ndarray
+        3D label (parcellation) image with the same volume as `img_data`
+    nodes : list (optional)
+        label values to compute the means of, in the order of the rows of
+        `means`; by default all of the labels greater than zero, sorted
+    vox_mask : ndarray (optional)
+        3D boolean mask of the voxels to include
+    chunk_size : integer (optional)
+        number of timepoints to reduce at a time
+
+    Returns
+    -------
+    nodes : ndarray
+        label value of each row of `means`
+    means : ndarray
+        (nodes x timepoints) mean timeseries, nan for a node without voxels
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix
+
+    if not safe_shape(img_data, labels):
+        raise Exception('Data and labels should have the same shape.')
+
+    if nodes is None:
+        nodes = np.unique(labels[labels > 0])
+    nodes = np.asarray(nodes)
+    ntpts = img_data.shape[3]
+
+    # Voxels in any of the nodes, and the node of each
+    in_nodes = np.in1d(labels.ravel(), nodes).reshape(labels.shape)
+    if vox_mask is not None:
+        in_nodes &= vox_mask.astype('bool')
+    vox_xyz = np.nonzero(in_nodes)
+    node_order = np.argsort(nodes, kind='mergesort')
+    node_idx = node_order[np.searchsorted(nodes[node_order], labels[vox_xyz])]
+    counts = np.bincount(node_idx, minlength=len(nodes)).astype('float64')
+
+    # One-hot matrix of the voxels' nodes, scaled to average them
+    nvoxs = len(node_idx)
+    weights = 1.0/counts[node_idx]
+    onehot = csr_matrix((weights, (node_idx, np.arange(nvoxs))),
+                        shape=(len(nodes), nvoxs))
+
+    means = np.zeros((len(nodes), ntpts))
+    for start in xrange(0, ntpts, chunk_size):
+        stop = min(start + chunk_size, ntpts)
+        chunk = img_data[vox_xyz + (slice(start, stop),)]
+        means[:, start:stop] = onehot.dot(chunk.astype('float64'))
+    means[counts == 0] = np.nan
+
+    return nodes, means
+
+
+# Header metadata of nifti images, keyed by path, with the modification time
+# and size they were read at
+nifti_header_cache = {}
+
+
+def get_nifti_header_info(file_path):
+    """
+    Reads the metadata of a nifti image from its header only, without
+    loading (or decompressing) the image data. The metadata is cached per
+    path, and read again only if the file's modification time or size
+    changes.
+
+    Parameters
+    ----------
+    file_path : string
+        path to the nifti image
+
+    Returns
+    -------
+    info : dict
+        'shape' : tuple of the image dimensions
+        'zooms' : tuple of the voxel sizes and, for 4D images, the TR
+        'tr' : float TR from the header (in its own units), or None for
+        images with less than 4 dimensions
+        'units' : tuple of the (spatial, temporal) units of the header
+        'dtype' : numpy dtype of the image data
+    """
+    import os
+    import nibabel as nb
+
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    key = (stat.st_mtime, stat.st_size)
+
+    cached = nifti_header_cache.get(file_path)
+    if cached is None or cached[0] != key:
+        # nibabel reads the header and leaves the data as a proxy
+        hdr = nb.load(file_path).get_header()
+        shape = tuple(int(dim) for dim in hdr.get_data_shape())
+        zooms = tuple(float(zoom) for zoom in hdr.get_zooms())
+        info = {'shape': shape,
+                'zooms': zooms,
+                'tr': zooms[3] if len(zooms) > 3 else None,
+                'units': hdr.get_xyzt_units(),
+                'dtype': hdr.get_data_dtype()}
+        with global_lock:
+            nifti_header_cache[file_path] = (key, info)
+        cached = (key, info)
+
+    return dict(cached[1])
+
+
 def extract_one_d(list_timeseries):
     if isinstance(list_timeseries, basestring):
         if '.1D' in list_timeseries or '.csv' in list_timeseries:
@@ -55,12 +55,11 @@ def get_img_nvols(in_files):
     """
 
     out = None
-    from nibabel import load
-    img = load(in_files)
-    hdr = img.get_header()
+    from CPAC.utils.utils import get_nifti_header_info
+    shape = get_nifti_header_info(in_files)['shape']
     nvols = None
-    if len(hdr.get_data_shape()) > 3:
-        nvols = int(hdr.get_data_shape()[3])
+    if len(shape) > 3:
+        nvols = int(shape[3])
     else:
         nvols = 1
     out = nvols
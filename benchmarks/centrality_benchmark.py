@@ -0,0 +1,635 @@
+# benchmarks/centrality_benchmark.py
+#
+# Micro-benchmarks for CPAC.network_centrality
+
+'''
+This module benchmarks the network centrality measures on synthetic masked
+timeseries. Every combination of method, threshold option, dtype and block
+size is run in its own process, and its wall time, CPU time and peak
+resident memory are written out as JSON, so results from before and after
+an upgrade of numpy, scipy or nipype can be compared.
+
+Example
+-------
+python centrality_benchmark.py --nvoxs 5000 --ntpts 150 \\
+    --block_sizes 500 2000 --out results.json
+python centrality_benchmark.py --nvoxs 5000 --ntpts 150 \\
+    --out new.json --compare results.json
+'''
+
+# Import packages
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+# Default thresholds for each threshold option
+THRESHOLDS = {'correlation' : 0.3,
+              'sparsity' : 0.01}
+
+# Methods and threshold options supported by each implementation
+NATIVE_CASES = [('degree', 'correlation'),
+                ('degree', 'sparsity'),
+                ('eigenvector', 'correlation'),
+                ('eigenvector', 'sparsity'),
+                ('lfcd', 'correlation')]
+AFNI_COMMANDS = {'degree' : '3dDegreeCentrality',
+                 'eigenvector' : '3dECM',
+                 'lfcd' : '3dLFCD'}
+
+
+# Generate synthetic masked timeseries
+def make_synthetic_data(nvoxs, ntpts, nfactors=10, seed=0):
+    '''
+    Function to generate a mask and timeseries with a correlation structure
+    similar to resting-state data, from a few shared latent signals plus
+    noise
+
+    Parameters
+    ----------
+    nvoxs : integer
+        number of voxels in the mask
+    ntpts : integer
+        number of timepoints
+    nfactors : integer (optional)
+        number of latent signals the voxels are mixed from
+    seed : integer (optional)
+        seed of the random number generator
+
+    Returns
+    -------
+    mask : ndarray
+        3D boolean mask with nvoxs voxels in a contiguous block
+    ts_normd : ndarray
+        (ntpts x nvoxs) float64 timeseries, demeaned and divided by its
+        L2-norm
+    '''
+
+    # Import packages
+    import numpy as np
+
+    # Fill a cube with the mask
+    rng = np.random.RandomState(seed)
+    side = int(np.ceil(nvoxs**(1/3.0)))
+    mask = np.zeros((side, side, side), dtype='bool')
+    mask.flat[:nvoxs] = True
+
+    # Mix latent signals, then normalize each voxel
+    factors = rng.randn(ntpts, nfactors)
+    loadings = rng.randn(nfactors, nvoxs)*(rng.rand(nfactors, nvoxs) > 0.7)
+    ts = factors.dot(loadings) + rng.randn(ntpts, nvoxs)
+    ts -= ts.mean(0)
+    ts /= np.sqrt((ts**2).sum(0))
+
+    # Return the mask and timeseries
+    return mask, ts
+
+
+# Write the synthetic data as nifti files for the AFNI commands
+def write_synthetic_niftis(mask, ts_normd, out_dir):
+    '''
+    Function to write the synthetic mask and timeseries as nifti files
+
+    Parameters
+    ----------
+    mask : ndarray
+        3D boolean mask
+    ts_normd : ndarray
+        (ntpts x nvoxs) timeseries of the voxels in the mask
+    out_dir : string
+        directory to write the files in
+
+    Returns
+    -------
+    in_file : string
+        filepath to the 4D functional image
+    mask_file : string
+        filepath to the mask image
+    '''
+
+    # Import packages
+    import nibabel as nib
+    import numpy as np
+
+    # Map the timeseries back into the volume
+    func = np.zeros(mask.shape + (ts_normd.shape[0],), dtype='float32')
+    func[mask] = ts_normd.T
+    aff = np.eye(4)
+
+    in_file = os.path.join(out_dir, 'synthetic_func.nii.gz')
+    mask_file = os.path.join(out_dir, 'synthetic_mask.nii.gz')
+    nib.save(nib.Nifti1Image(func, aff), in_file)
+    nib.save(nib.Nifti1Image(mask.astype('uint8'), aff), mask_file)
+
+    # Return the filepaths
+    return in_file, mask_file
+
+
+# Peak resident memory of this process or its children, in MB
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''
+    Function to return the peak resident set size of this process, or of
+    the largest child process it has waited on
+
+    Parameters
+    ----------
+    who : integer (optional)
+        resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+
+    Returns
+    -------
+    peak_rss : float
+        peak resident memory (MB)
+    '''
+
+    peak = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is in bytes on OS X, and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak/1024.0**2
+    return peak/1024.0
+
+
+# CPU time of this process and its children, in seconds
+def cpu_seconds():
+    '''
+    Function to return the user and system time used by this process and
+    any child processes it has waited on
+
+    Returns
+    -------
+    cpu_time : float
+        CPU time (seconds)
+    '''
+
+    times = os.times()
+    return sum(times[:4])
+
+
+# Run the native centrality measure
+def run_native(case, mask, ts_normd):
+    '''
+    Function to run one case of the native centrality implementation
+
+    Parameters
+    ----------
+    case : dictionary
+        the benchmark case
+    mask : ndarray
+        3D boolean mask
+    ts_normd : ndarray
+        (ntpts x nvoxs) normalized timeseries
+    '''
+
+    # Import packages
+    from CPAC.network_centrality import get_centrality_by_rvalue,\
+                                        get_centrality_by_sparsity
+
+    ts_normd = ts_normd.astype(case['dtype'])
+    if case['threshold_option'] == 'sparsity':
+        get_centrality_by_sparsity(ts_normd, case['method'],
+                                   case['threshold'], case['block_size'])
+    else:
+        get_centrality_by_rvalue(ts_normd, mask, case['method'],
+                                 case['threshold'], case['block_size'])
+
+
+# Run the AFNI centrality interface
+def run_afni(case, in_file, mask_file, work_dir):
+    '''
+    Function to run one case of the AFNI centrality interfaces
+
+    Parameters
+    ----------
+    case : dictionary
+        the benchmark case
+    in_file : string
+        filepath to the 4D functional image
+    mask_file : string
+        filepath to the mask image
+    work_dir : string
+        directory to write the outputs in
+    '''
+
+    # Import packages
+    from CPAC.network_centrality.afni_network_centrality import \
+        DegreeCentrality, ECM, LFCD
+
+    interfaces = {'degree' : DegreeCentrality,
+                  'eigenvector' : ECM,
+                  'lfcd' : LFCD}
+    environ = {'OMP_NUM_THREADS' : str(case['num_threads'])}
+    centrality = interfaces[case['method']](environ=environ)
+    centrality.inputs.in_file = in_file
+    centrality.inputs.mask = mask_file
+    centrality.inputs.out_file = os.path.join(work_dir, 'centrality.nii.gz')
+    if case['threshold_option'] == 'sparsity':
+        centrality.inputs.sparsity = case['threshold']*100.0
+    else:
+        centrality.inputs.thresh = case['threshold']
+
+    os.chdir(work_dir)
+    centrality.run()
+
+
+# Time one case in the calling process
+def measure_case(case, mask, ts_normd, in_file, mask_file, queue):
+    '''
+    Function to time one benchmark case and put its measurements on a
+    queue; it is meant to be the target of its own process. A forked
+    process starts out with the pages of its parent in its peak memory, so
+    the peak memory reported is the increase over that at the start, or
+    the peak of a command run by the case if that is larger. The
+    implementation (with nipype) is imported before the timers and the
+    memory baseline, so its import cost is left out of every case
+
+    Parameters
+    ----------
+    case : dictionary
+        the benchmark case
+    mask : ndarray
+        3D boolean mask
+    ts_normd : ndarray
+        (ntpts x nvoxs) normalized timeseries
+    in_file : string
+        filepath to the 4D functional image, for AFNI
+    mask_file : string
+        filepath to the mask image, for AFNI
+    queue : multiprocessing.Queue
+        queue to put the measurements dictionary on
+    '''
+
+    result = {}
+    try:
+        if case['implementation'] == 'afni':
+            import CPAC.network_centrality.afni_network_centrality
+        else:
+            import CPAC.network_centrality
+    except Exception as exc:
+        queue.put({'error' : '%s: %s' % (type(exc).__name__, str(exc))})
+        return
+
+    rss_start = peak_rss_mb()
+    work_dir = tempfile.mkdtemp(prefix='centrality_benchmark_')
+    try:
+        cpu_start = cpu_seconds()
+        wall_start = time.time()
+        if case['implementation'] == 'afni':
+            run_afni(case, in_file, mask_file, work_dir)
+        else:
+            run_native(case, mask, ts_normd)
+        result['wall_time'] = time.time() - wall_start
+        result['cpu_time'] = cpu_seconds() - cpu_start
+        result['peak_rss_mb'] = max(peak_rss_mb() - rss_start,
+                                    peak_rss_mb(resource.RUSAGE_CHILDREN))
+    except Exception as exc:
+        result['error'] = '%s: %s' % (type(exc).__name__, str(exc))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    queue.put(result)
+
+
+# Wait for the measurements of a case process
+def wait_for_result(proc, queue, timeout=None, poll_interval=1.0):
+    '''
+    Function to wait for the measurements a case process puts on its
+    queue, without hanging if the process dies before it puts them there
+    (e.g. it is killed for running out of memory, or segfaults)
+
+    Parameters
+    ----------
+    proc : multiprocessing.Process
+        the started process running measure_case
+    queue : multiprocessing.Queue
+        the queue the process puts its measurements on
+    timeout : float (optional)
+        seconds after which the process is terminated; None waits as long
+        as the process runs
+    poll_interval : float (optional)
+        seconds between checks that the process is still running
+
+    Returns
+    -------
+    result : dictionary
+        the measurements, or an 'error' describing why there are none
+    '''
+
+    # Import packages
+    import Queue
+
+    start = time.time()
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except Queue.Empty:
+            pass
+        if not proc.is_alive():
+            # The measurements may have been put just before it exited
+            try:
+                return queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                break
+        if timeout is not None and time.time() - start > timeout:
+            proc.terminate()
+            proc.join()
+            return {'error' : 'timed out after %.0fs' % timeout}
+
+    proc.join()
+    if proc.exitcode < 0:
+        return {'error' : 'process killed by signal %d' % -proc.exitcode}
+    return {'error' : 'process exited with code %d without a result' % \
+                      proc.exitcode}
+
+
+# Build the list of benchmark cases
+def build_cases(methods, threshold_options, dtypes, block_sizes,
+                with_afni=True, num_threads=1):
+    '''
+    Function to build every supported combination of the benchmark
+    parameters
+
+    Parameters
+    ----------
+    methods : list
+        centrality methods, 'degree', 'eigenvector' and/or 'lfcd'
+    threshold_options : list
+        'correlation' and/or 'sparsity'
+    dtypes : list
+        dtypes of the native timeseries, e.g. 'float32'
+    block_sizes : list
+        number of voxels per block for the native implementation
+    with_afni : boolean (optional)
+        whether to include the AFNI commands found on the path
+    num_threads : integer (optional)
+        number of threads for the AFNI commands
+
+    Returns
+    -------
+    cases : list
+        list of benchmark case dictionaries
+    '''
+
+    # Import packages
+    from distutils.spawn import find_executable
+
+    cases = []
+    for method, thr_opt in NATIVE_CASES:
+        if method not in methods or thr_opt not in threshold_options:
+            continue
+        for dtype in dtypes:
+            for block_size in block_sizes:
+                cases.append({'implementation' : 'native',
+                              'method' : method,
+                              'threshold_option' : thr_opt,
+                              'threshold' : THRESHOLDS[thr_opt],
+                              'dtype' : dtype,
+                              'block_size' : block_size})
+        # AFNI reads the float32 nifti, and picks its own blocks
+        if with_afni and find_executable(AFNI_COMMANDS[method]):
+            cases.append({'implementation' : 'afni',
+                          'method' : method,
+                          'threshold_option' : thr_opt,
+                          'threshold' : THRESHOLDS[thr_opt],
+                          'dtype' : 'float32',
+                          'block_size' : None,
+                          'num_threads' : num_threads})
+
+    # Return the cases
+    return cases
+
+
+# Run all of the benchmarks
+def run_benchmarks(nvoxs, ntpts, cases, repeats=3, seed=0, timeout=None):
+    '''
+    Function to run each benchmark case in a fresh process the given
+    number of times
+
+    Parameters
+    ----------
+    nvoxs : integer
+        number of voxels of the synthetic data
+    ntpts : integer
+        number of timepoints of the synthetic data
+    cases : list
+        list of benchmark case dictionaries from build_cases
+    repeats : integer (optional)
+        number of times to run each case
+    seed : integer (optional)
+        seed of the synthetic data
+    timeout : float (optional)
+        seconds after which a run is stopped and recorded as an error
+
+    Returns
+    -------
+    results : list
+        the cases, each with its list of 'runs' measurements and the
+        minimum wall time, CPU time and peak memory over the runs
+    '''
+
+    # Import packages
+    import multiprocessing
+
+    mask, ts_normd = make_synthetic_data(nvoxs, ntpts, seed=seed)
+    data_dir = tempfile.mkdtemp(prefix='centrality_benchmark_data_')
+    in_file = mask_file = None
+    try:
+        if any([case['implementation'] == 'afni' for case in cases]):
+            in_file, mask_file = write_synthetic_niftis(mask, ts_normd,
+                                                        data_dir)
+        results = []
+        for case in cases:
+            runs = []
+            for rep in range(repeats):
+                queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(target=measure_case,
+                                               args=(case, mask, ts_normd,
+                                                     in_file, mask_file,
+                                                     queue))
+                proc.start()
+                runs.append(wait_for_result(proc, queue, timeout=timeout))
+                proc.join()
+                if 'error' in runs[-1]:
+                    break
+
+            result = dict(case, nvoxs=nvoxs, ntpts=ntpts, runs=runs)
+            if 'error' in runs[-1]:
+                result['error'] = runs[-1]['error']
+            else:
+                for key in ('wall_time', 'cpu_time', 'peak_rss_mb'):
+                    result[key] = min([run[key] for run in runs])
+            results.append(result)
+            print format_result(result)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    # Return the results
+    return results
+
+
+# Describe the environment the benchmarks were run in
+def environment_info():
+    '''
+    Function to return the versions and machine the benchmarks ran on
+
+    Returns
+    -------
+    info : dictionary
+        python, numpy, scipy and nipype versions and machine details
+    '''
+
+    # Import packages
+    import multiprocessing
+    import numpy as np
+    import scipy
+
+    info = {'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'scipy' : scipy.__version__,
+            'machine' : platform.machine(),
+            'platform' : platform.platform(),
+            'node' : platform.node(),
+            'cpu_count' : multiprocessing.cpu_count(),
+            'date' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        import nipype
+        info['nipype'] = nipype.__version__
+    except ImportError:
+        info['nipype'] = None
+
+    # Return the info
+    return info
+
+
+# Key identifying the same case across result files
+def case_key(result):
+    '''
+    Function to return the tuple of parameters that identifies a case
+    '''
+
+    return (result['implementation'], result['method'],
+            result['threshold_option'], result['dtype'],
+            result['block_size'], result['nvoxs'], result['ntpts'])
+
+
+# One-line summary of a result
+def format_result(result):
+    '''
+    Function to return a one-line summary of a benchmark result
+    '''
+
+    name = '%s %s/%s %s block=%s' % (result['implementation'],
+                                     result['method'],
+                                     result['threshold_option'],
+                                     result['dtype'], result['block_size'])
+    if 'error' in result:
+        return '%-50s failed: %s' % (name, result['error'])
+    return '%-50s wall %8.3fs  cpu %8.3fs  rss %8.1fMB' % \
+           (name, result['wall_time'], result['cpu_time'],
+            result['peak_rss_mb'])
+
+
+# Compare results against a baseline
+def compare_results(results, baseline):
+    '''
+    Function to print the ratio of the wall time and peak memory of each
+    result to those of the same case in a baseline
+
+    Parameters
+    ----------
+    results : list
+        list of benchmark results
+    baseline : list
+        list of benchmark results to compare against
+
+    Returns
+    -------
+    ratios : dictionary
+        (wall time ratio, peak memory ratio) for each case key
+    '''
+
+    base = dict([(case_key(res), res) for res in baseline
+                 if 'error' not in res])
+    ratios = {}
+    for res in results:
+        key = case_key(res)
+        if 'error' in res or key not in base:
+            continue
+        ratios[key] = (res['wall_time']/base[key]['wall_time'],
+                       res['peak_rss_mb']/base[key]['peak_rss_mb'])
+        print '%-50s wall x%.2f  rss x%.2f' % \
+              (format_result(res).split('  wall')[0].rstrip(),
+               ratios[key][0], ratios[key][1])
+
+    # Return the ratios
+    return ratios
+
+
+# Parse arguments and run
+def main():
+    '''
+    Function to parse the command line arguments, run the benchmarks and
+    write them to JSON
+    '''
+
+    parser = argparse.ArgumentParser(description='Benchmark the network '\
+                                     'centrality measures on synthetic data')
+    parser.add_argument('--nvoxs', type=int, default=5000,
+                        help='number of voxels in the synthetic mask')
+    parser.add_argument('--ntpts', type=int, default=150,
+                        help='number of timepoints of the synthetic data')
+    parser.add_argument('--methods', nargs='+',
+                        default=['degree', 'eigenvector', 'lfcd'],
+                        choices=['degree', 'eigenvector', 'lfcd'])
+    parser.add_argument('--threshold_options', nargs='+',
+                        default=['correlation', 'sparsity'],
+                        choices=['correlation', 'sparsity'])
+    parser.add_argument('--dtypes', nargs='+',
+                        default=['float32', 'float64'],
+                        choices=['float32', 'float64'])
+    parser.add_argument('--block_sizes', nargs='+', type=int,
+                        default=[1000],
+                        help='voxels per block for the native implementation')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='runs of each case; the minimum is reported')
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='threads for the AFNI commands')
+    parser.add_argument('--no_afni', action='store_true',
+                        help='skip the AFNI commands even if installed')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds after which a run is stopped')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='centrality_benchmark.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--compare',
+                        help='JSON file of earlier results to compare to')
+    args = parser.parse_args()
+
+    cases = build_cases(args.methods, args.threshold_options, args.dtypes,
+                        args.block_sizes, with_afni=not args.no_afni,
+                        num_threads=args.num_threads)
+    results = run_benchmarks(args.nvoxs, args.ntpts, cases,
+                             repeats=args.repeats, seed=args.seed,
+                             timeout=args.timeout)
+
+    with open(args.out, 'w') as out_file:
+        json.dump({'environment' : environment_info(),
+                   'parameters' : vars(args),
+                   'results' : results}, out_file, indent=2)
+    print 'Wrote results to %s' % args.out
+
+    if args.compare:
+        with open(args.compare, 'r') as base_file:
+            baseline = json.load(base_file)['results']
+        print '\nCompared to %s' % args.compare
+        compare_results(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,61 +5,68 @@ import os
 from os import path
 
 import sys
-sys.path.insert(0, '/home2/data/Projects/CPAC_Regression_Test/nipype-installs/fcp-indi-nipype/running-install/lib/python2.7/site-packages')
-sys.path.insert(1, '/home2/data/Projects/CPAC_Regression_Test/zarrar/centrality_tests/lib/C-PAC')
-sys.path.append("/home/data/PublicProgram/epd-7.2-2-rh5-x86_64/lib/python2.7/site-packages")
-
-from CPAC.network_centrality import calc_centrality
 
 
 ###
 # Load command-line argument
 ###
 
-parser = argparse.ArgumentParser(description='Compute centrality for a given timeseries.')
+parser = argparse.ArgumentParser(description='Compute centrality for one or more timeseries on a common mask.')
 
 # Inputs
-parser.add_argument('-i', '--input', help='Input timeseries data file', 
-                    required=True)
-parser.add_argument('-m', '--mask', help='Brain mask (by default the program will create a mask where voxels have non-zero variance regardeless of the user specified mask).')
+parser.add_argument('-i', '--input', nargs='+', default=[],
+                    help='Input timeseries data file(s)')
+parser.add_argument('--input-list',
+                    help='Text file with one input timeseries data file per line (for batches of subjects)')
+parser.add_argument('--subject-ids', nargs='+',
+                    help='Name of each subject\'s output directory (by default the names of the input files)')
+parser.add_argument('-m', '--mask', required=True,
+                    help='Brain mask or parcellation common to all inputs (voxels without variance in an input are also excluded for that input).')
 
 # Option: Method
-parser.add_argument('--degree', help='Calculate degree centrality', 
+parser.add_argument('--degree', help='Calculate degree centrality',
+                    action="store_true")
+parser.add_argument('--eigen', help='Calculate eigen centrality',
                     action="store_true")
-parser.add_argument('--eigen', help='Calculate eigen centrality', 
+parser.add_argument('--lfcd', help='Calculate local functional connectivity density',
                     action="store_true")
 
 # Option: Outputs
-parser.add_argument('--binarize', action="store_true", 
+parser.add_argument('--binarize', action="store_true",
                     help='For a given voxel, save the number of connections that pass a threshold')
-parser.add_argument('--weighted', action="store_true", 
-                    help='For a given voxel, save the sum of all connection weights that pass a threshold.')
+parser.add_argument('--weighted', action="store_true",
+                    help='For a given voxel, save the sum of all connection weights that pass a threshold. (By default both outputs are saved.)')
 
 # Option: Threshold
-# TODO: explicitly check that only one is specified.
-parser.add_argument('--no-threshold', action='store_true', 
-                    help="The raw correlations will be used and the approach will be very fast and low memory usage.")
-parser.add_argument('--sparsity', type=float, 
-                    help="Sparsity based threshold. (Only one threshold option can be specified.)")
-parser.add_argument('--pvalue', type=float, 
+parser.add_argument('--no-threshold', action='store_true',
+                    help="The raw correlations will be used and the approach will be very fast and low memory usage (weighted degree/eigen centrality only).")
+parser.add_argument('--sparsity', type=float,
+                    help="Sparsity based threshold, as a fraction of connections. (Only one threshold option can be specified.)")
+parser.add_argument('--pvalue', type=float,
                     help='P-value threshold for each connection. (Only one threshold option can be specified.)')
-parser.add_argument('--rho', type=float, 
+parser.add_argument('--rho', type=float,
                     help="Regular correlation threshold. (Only one threshold option can be specified.)")
 
 # Option: Zcore
-parser.add_argument('--zscore', action='store_true', 
+parser.add_argument('--zscore', action='store_true',
                     help="Z-score each of the output centrality images (will create additional outputs)")
 
 # Option: Memory
-parser.add_argument('--memlimit', type=float, 
-                    help="Memory limit that should be set.")
+parser.add_argument('--memlimit', type=float,
+                    help="Memory limit (GB) of each worker.")
+parser.add_argument('--probe', action='store_true',
+                    help="Time blocks of the first input to pick the fastest block size within the memory limit.")
+parser.add_argument('--scratch-dir',
+                    help="Directory for out-of-core eigenvector centrality to cache correlation blocks in.")
 
 # Option: Threads
-parser.add_argument('--nthreads', type=int, default=1, 
-                    help="Number of threads to parallel processes for Intel MKL")
+parser.add_argument('--nthreads', type=int, default=1,
+                    help="Number of BLAS/OpenMP threads of each worker")
+parser.add_argument('--nworkers', type=int, default=1,
+                    help="Number of inputs to process at once")
 
 # Output
-parser.add_argument('-o', '--outdir', default=os.getcwd(), help="Output directory")
+parser.add_argument('-o', '--outdir', default=os.getcwd(), help="Output directory, with a subdirectory for each input")
 
 
 
@@ -69,47 +76,128 @@ parser.add_argument('-o', '--outdir', default=os.getcwd(), help="Output director
 
 args = parser.parse_args()
 
-try:
-    import mkl
-    mkl.set_num_threads(args.nthreads)
-except ImportError:
-    pass
-
-if not args.degree and not args.eigen:
-    raise SystemExit("--degree and/or --eigen must be specified")
-method_options = [args.degree, args.eigen]
-
-if not args.binarize and not args.weighted:
-    raise SystemExit("--binarize and/or --weighted must be specified")
-weight_options = [args.binarize, args.weighted]
+# Limit the threads before numpy loads its BLAS
+for env_var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']:
+    os.environ[env_var] = str(args.nthreads)
+
+from CPAC.network_centrality import calc_centrality, calc_centrality_batch
+
+in_files = list(args.input)
+if args.input_list:
+    with open(args.input_list, 'r') as f:
+        in_files += [ line.strip() for line in f if line.strip() ]
+if not in_files:
+    raise SystemExit("--input and/or --input-list must be specified")
+in_files = [ path.abspath(in_file) for in_file in in_files ]
+
+methods = []
+if args.degree:
+    methods.append('degree')
+if args.eigen:
+    methods.append('eigenvector')
+if args.lfcd:
+    methods.append('lfcd')
+if not methods:
+    raise SystemExit("--degree, --eigen and/or --lfcd must be specified")
 
 if args.pvalue is not None:
-    option = 0
+    option = 'significance'
     threshold = args.pvalue
 elif args.sparsity is not None:
-    option = 1
+    option = 'sparsity'
     threshold = args.sparsity
 elif args.rho is not None:
-    option = 2
+    option = 'correlation'
     threshold = args.rho
 elif args.no_threshold:
-    option = 3
+    option = 'none'
     threshold = None
 else:
     raise SystemExit("You must specify one threshold option: --pvalue, --sparsity, --rho, or --no-threshold.")
+if option in ['sparsity', 'none'] and 'lfcd' in methods:
+    raise SystemExit("--sparsity and --no-threshold are not supported for --lfcd")
+
+# Outputs to keep, both by default
+weight_options = []
+if args.binarize:
+    weight_options.append('binarize')
+if args.weighted:
+    weight_options.append('weighted')
+if not weight_options:
+    weight_options = ['binarize', 'weighted']
+if option == 'none' and 'weighted' not in weight_options:
+    raise SystemExit("--no-threshold only gives --weighted outputs")
+
+measures = [ (method, option, threshold) for method in methods ]
 
 
 ###
 # Call on the Big Guy/Gal (CPAC)
 ###
 
-curdir = os.getcwd()
-os.chdir(args.outdir)
-
-out_list = calc_centrality(args.input, args.mask, method_options, weight_options, option, 
-                           threshold, args.memlimit)
-
-os.chdir(curdir)
+def calc_centrality_unthresholded(in_files, mask, methods, allocated_memory,
+                                  out_dir, subject_ids=None):
+    """
+    Run the fast approach without a threshold through calc_centrality, one
+    input at a time (the batch runner only computes thresholded measures)
+    """
+    if subject_ids is None:
+        subject_ids = [ path.basename(in_file).split('.')[0]
+                        for in_file in in_files ]
+
+    curdir = os.getcwd()
+    out_lists = []
+    for in_file, subject_id in zip(in_files, subject_ids):
+        sub_dir = path.join(out_dir, subject_id)
+        if not path.exists(sub_dir):
+            os.makedirs(sub_dir)
+        os.chdir(sub_dir)
+        try:
+            out_list = []
+            for method in methods:
+                out_list += calc_centrality(in_file, mask, method, 'none',
+                                            None, allocated_memory)
+        except Exception as exc:
+            print "Centrality failed for %s: %s" % (in_file, exc)
+            out_list = None
+        finally:
+            os.chdir(curdir)
+        out_lists.append(out_list)
+
+    return out_lists
+
+if option == 'none':
+    out_lists = calc_centrality_unthresholded(in_files,
+                                              path.abspath(args.mask),
+                                              methods, args.memlimit,
+                                              path.abspath(args.outdir),
+                                              subject_ids=args.subject_ids)
+else:
+    out_lists = calc_centrality_batch(in_files, path.abspath(args.mask),
+                                      measures, args.memlimit,
+                                      path.abspath(args.outdir),
+                                      subject_ids=args.subject_ids,
+                                      num_workers=args.nworkers,
+                                      num_threads=args.nthreads,
+                                      scratch_dir=args.scratch_dir,
+                                      probe_block_size=args.probe)
+
+failed = [ in_file for in_file, out_list in zip(in_files, out_lists)
+           if out_list is None ]
+
+# Remove the outputs that weren't asked for
+for idx, out_list in enumerate(out_lists):
+    if out_list is None:
+        continue
+    keep = []
+    for out_file in out_list:
+        weight = path.basename(out_file).split('.')[0].split('_')[-1]
+        if weight in weight_options:
+            keep.append(out_file)
+        else:
+            os.remove(out_file)
+    out_lists[idx] = keep
 
 
 ###
@@ -118,33 +206,42 @@ os.chdir(curdir)
 
 def zscore_image(infile, mask, outfile):
     import os, commands
-    
+
     cmd     = "fslstats %s -k %s -m" % (infile, mask)
     print cmd
     mean    = commands.getstatusoutput(cmd)
     mean    = float(mean[1])
-    
+
     cmd     = "fslstats %s -k %s -s" % (infile, mask)
     print cmd
     sd      = commands.getstatusoutput(cmd)
     sd      = float(sd[1])
-    
+
     cmd = "3dcalc -a %s -b %s -expr '((a-%f)/%f)*step(b)' -prefix %s" % (infile, mask, mean, sd, outfile)
     print cmd
     os.system(cmd)
-    
+
     return
 
-print ''
-for centfile in out_list:
-    print "Z-score: %s" % os.path.basename(centfile)
-    
-    # New output filename
-    prefix,ext  = os.path.splitext(centfile)
-    if ext == '.gz':
-        prefix,ext  = os.path.splitext(prefix)
-        ext = ext + '.gz'
-    zfile       = "%s_zscore%s" % (prefix, ext)
-    
-    # Create zscore image
-    zscore_image(centfile, args.mask, zfile)
+if args.zscore:
+    print ''
+    for out_list in out_lists:
+        for centfile in out_list or []:
+            print "Z-score: %s" % centfile
+
+            # New output filename
+            prefix,ext  = os.path.splitext(centfile)
+            if ext == '.gz':
+                prefix,ext  = os.path.splitext(prefix)
+                ext = ext + '.gz'
+            zfile       = "%s_zscore%s" % (prefix, ext)
+
+            # Create zscore image
+            zscore_image(centfile, args.mask, zfile)
+
+if failed:
+    print ''
+    print "Centrality failed for %i of %i inputs:" % (len(failed), len(in_files))
+    for in_file in failed:
+        print "  %s" % in_file
+    sys.exit(1)
@@ -41,10 +41,17 @@ def configuration(parent_package='', top_path=None):
     config.get_version('CPAC/__init__.py')
     config.add_subpackage('CPAC')
 
-    # cython
+    # cython, with OpenMP if the compiler supports it (the check is shared
+    # with the pyximport build settings)
+    pyxbld = {}
+    exec(open(os.path.join('CPAC', 'network_centrality',
+                           'thresh_and_sum.pyxbld'), 'rt').read(), pyxbld)
+    compile_args, link_args = pyxbld['openmp_flags']()
     config.add_extension('CPAC.network_centrality.thresh_and_sum', 
                          sources=['CPAC/network_centrality/thresh_and_sum.pyx'], 
-                         include_dirs=[get_numpy_include_dirs()])
+                         include_dirs=[get_numpy_include_dirs()],
+                         extra_compile_args=compile_args,
+                         extra_link_args=link_args)
 
     return config
 
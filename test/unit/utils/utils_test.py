@@ -0,0 +1,191 @@
+# test/unit/utils/utils_test.py
+#
+
+'''
+This module performs unit testing on functions in the utils module in the
+CPAC/utils subpackage
+'''
+
+# Import packages
+import os
+import unittest
+
+import numpy as np
+
+
+# Test case for the parcel mean timeseries
+class ParcelMeanTimeseriesTestCase(unittest.TestCase):
+    '''
+    This class is a test case for the parcel_mean_timeseries function,
+    against the mean of every label taken one at a time
+
+    Inherits
+    --------
+    unittest.TestCase class
+    '''
+
+    # setUp method
+    def setUp(self):
+        '''
+        Init a random functional image, a label image whose label 4 only
+        has voxels outside of the voxel mask, and the voxel mask
+        '''
+
+        rng = np.random.RandomState(8)
+        self.img_data = rng.randn(6, 5, 4, 30)
+        self.labels = rng.randint(0, 4, (6, 5, 4))
+        self.labels[0, 0, :] = 4
+        self.vox_mask = rng.rand(6, 5, 4) > 0.3
+        self.vox_mask[0, 0, :] = False
+
+    # Reference means, one label at a time
+    def per_label_means(self, nodes, vox_mask=None):
+        '''
+        Mean timeseries of each node with a scan of the volume per label
+        '''
+
+        if vox_mask is None:
+            vox_mask = np.ones(self.labels.shape, dtype='bool')
+        means = []
+        for n in nodes:
+            node_mask = (self.labels == n) & vox_mask
+            if node_mask.any():
+                means.append(np.mean(self.img_data[node_mask], axis=0))
+            else:
+                means.append(np.nan*np.ones(self.img_data.shape[3]))
+
+        return np.array(means)
+
+    # Test the default nodes
+    def test_all_labels(self):
+        '''
+        Every label above zero, sorted, in chunks of timepoints
+        '''
+
+        # Import packages
+        from CPAC.utils.utils import parcel_mean_timeseries
+
+        nodes, means = parcel_mean_timeseries(self.img_data, self.labels,
+                                              chunk_size=7)
+
+        np.testing.assert_array_equal(nodes, [1, 2, 3, 4])
+        np.testing.assert_allclose(means, self.per_label_means(nodes))
+
+    # Test the voxel mask and unsorted nodes
+    def test_unsorted_nodes_in_mask(self):
+        '''
+        Rows follow the order of the given nodes, and the node without
+        voxels in the mask is nan
+        '''
+
+        # Import packages
+        from CPAC.utils.utils import parcel_mean_timeseries
+
+        nodes = [3, 4, 1, 2]
+        out_nodes, means = parcel_mean_timeseries(self.img_data, self.labels,
+                                                  nodes=nodes,
+                                                  vox_mask=self.vox_mask)
+        ref = self.per_label_means(nodes, self.vox_mask)
+
+        np.testing.assert_array_equal(out_nodes, nodes)
+        self.assertTrue(np.isnan(means[1]).all())
+        np.testing.assert_allclose(means, ref)
+
+
+# Test case for the nifti header cache
+class NiftiHeaderInfoTestCase(unittest.TestCase):
+    '''
+    This class is a test case for the get_nifti_header_info function and
+    its cache of the header values per path
+
+    Inherits
+    --------
+    unittest.TestCase class
+    '''
+
+    # setUp method
+    def setUp(self):
+        '''
+        Init a temporary directory for the images
+        '''
+
+        # Import packages
+        import tempfile
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nii_file = os.path.join(self.tmp_dir, 'func.nii')
+
+    # tearDown method
+    def tearDown(self):
+        '''
+        Remove the temporary directory
+        '''
+
+        # Import packages
+        import shutil
+
+        shutil.rmtree(self.tmp_dir)
+
+    # Write an image
+    def write_image(self, shape, zooms):
+        '''
+        Write a float32 image of the given shape and voxel sizes
+        '''
+
+        # Import packages
+        import nibabel as nb
+
+        img = nb.Nifti1Image(np.zeros(shape, dtype='float32'), np.eye(4))
+        img.get_header().set_zooms(zooms)
+        img.to_filename(self.nii_file)
+
+    # Compare the info to the header
+    def assert_header_info(self, info):
+        '''
+        Check the info against the header loaded with nibabel
+        '''
+
+        # Import packages
+        import nibabel as nb
+
+        hdr = nb.load(self.nii_file).get_header()
+        zooms = tuple(float(zoom) for zoom in hdr.get_zooms())
+        self.assertEqual(info['shape'], hdr.get_data_shape())
+        self.assertEqual(info['zooms'], zooms)
+        self.assertEqual(info['tr'], zooms[3] if len(zooms) > 3 else None)
+        self.assertEqual(info['units'], hdr.get_xyzt_units())
+        self.assertEqual(info['dtype'], hdr.get_data_dtype())
+
+    # Test the cached values
+    def test_header_info(self):
+        '''
+        The values match the header, and are read again when the file is
+        rewritten with a new size, or with the same size and a new mtime
+        '''
+
+        # Import packages
+        from CPAC.utils.utils import get_nifti_header_info
+
+        self.write_image((4, 5, 6, 10), (2.0, 2.0, 3.0, 1.5))
+        info = get_nifti_header_info(self.nii_file)
+        self.assert_header_info(info)
+        self.assertEqual(get_nifti_header_info(self.nii_file), info)
+
+        # A new size
+        self.write_image((4, 5, 6), (2.0, 2.0, 3.0))
+        info = get_nifti_header_info(self.nii_file)
+        self.assert_header_info(info)
+        self.assertEqual(info['tr'], None)
+
+        # The same size, with a later mtime
+        mtime = os.stat(self.nii_file).st_mtime
+        self.write_image((4, 6, 5), (1.0, 2.0, 2.5))
+        os.utime(self.nii_file, (mtime + 10, mtime + 10))
+        info = get_nifti_header_info(self.nii_file)
+        self.assert_header_info(info)
+        self.assertEqual(info['shape'], (4, 6, 5))
+
+
+# Make module executable
+if __name__ == '__main__':
+    unittest.main()